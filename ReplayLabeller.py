@@ -1,32 +1,149 @@
 import math
 import pickle
 import datetime
-import calendar
-import pytz
 import sys
+import multiprocessing
+import os
+import contextlib
+import numpy as np
 from scipy.stats import norm
-from swiglpk import *
 
 import data
 import config
+import store
+import profiling
+import skew
+from mip import DecomposedMIP, mip_size, prune_labels
+import marginals
 
 INF = float('inf')
 
-class ReplayLabeller:
-  def __init__(self, player_file, challonge_file, setup_file):
-    with open(challonge_file, 'rb') as cfile:
-      dat = pickle.load(cfile)
-      self.matches = dat['matches']
-      self.participants = dat['participants']
+# log of the smallest positive float; densities whose log is below this
+# underflow to 0 when computed directly, which compute_time_ll treats as
+# infeasible
+LOG_MIN_PDF = math.log(5e-324)
+
+# vectorized log of the normal pdf with the given mean and standard deviation
+def norm_logpdf(x, mean, sd):
+  return -0.5 * ((x - mean) / sd)**2 - math.log(sd * math.sqrt(2*math.pi))
+
+# the largest value x such that norm_logpdf(x, mean, sd) >= LOG_MIN_PDF, i.e.
+# the largest time difference that compute_time_ll doesn't treat as
+# infeasible. Rounded up by a second to be safe
+def max_time_diff(mean, sd):
+  return mean + sd * math.sqrt(-2 * (LOG_MIN_PDF + math.log(sd * math.sqrt(2*math.pi)))) + 1.0
+
+# per-replay arrays of the ports and wins of a setup's replays, given their
+# port_char, port_dead and numplayers columns in the replay store, from which
+# the port and win checks of compute_char_logprob can be done for any window
+# in O(1). Returns a tuple of:
+#  - run_ends, where run_ends[ri] is the end of the run of replays from ri
+#    that have REQ_NUM_PLAYERS players on the same two ports (or ri itself if
+#    replay ri doesn't), so that the window of ngames replays from ri is usable
+#    iff run_ends[ri] >= ri + ngames
+#  - pair_ports, where pair_ports[ri] are the two ports of replay ri, in
+#    increasing order
+#  - wins, where wins[ri, p] is whether the player on port p won replay ri
+#  - win_counts, where win_counts[ri, p] is the number of wins on port p
+#    before replay ri
+def port_runs(port_char, port_dead, numplayers):
+  used = port_char >= 0
+  wins = used & ~port_dead
+  portsets = (used * np.array([1, 2, 4, 8])).sum(axis=1)
+  ok = (numplayers == config.REQ_NUM_PLAYERS) & (used.sum(axis=1) == 2)
+
+  # replays that can't be in any window get a portset of their own, so they
+  # end the runs around them
+  n = len(portsets)
+  portsets = np.where(ok, portsets, -1 - np.arange(n))
+  boundaries = np.append(np.flatnonzero(portsets[1:] != portsets[:-1]) + 1, n)
+  run_ends = boundaries[np.searchsorted(boundaries, np.arange(n), side='right')]
+  run_ends[~ok] = np.flatnonzero(~ok)
+
+  pair_ports = np.argsort(~used, axis=1, kind='stable')[:, :2]
+  win_counts = np.concatenate([np.zeros((1, 4), dtype=int), np.cumsum(wins, axis=0)])
+  return run_ends, pair_ports, wins, win_counts
+
+# the settings that the results in a label cache (see ReplayLabeller) depend
+# on, beyond the matches and replays themselves; a cache saved with different
+# settings is discarded. LABEL_CACHE_VERSION is bumped whenever the format of
+# the cache changes
+LABEL_CACHE_VERSION = 2
+def label_cache_settings():
+  return (LABEL_CACHE_VERSION, config.TIME_ZONE,
+          config.ANNOUNCE_TO_START_MEAN, config.ANNOUNCE_TO_START_SD,
+          config.END_TO_REPORT_MEAN, config.END_TO_REPORT_SD,
+          config.MIN_START_LL, config.MIN_END_LL, config.TIME_SLACK,
+          config.REQ_NUM_PLAYERS, config.DEFAULT_PROB, config.MAIN_CHAR_PROB,
+          config.SEC_CHAR_PROB, config.NOLABEL_OBJVAL)
+
+# load a label cache saved by save_label_cache, or return an empty one if
+# there is none or it can't be used
+def load_label_cache(cache_file):
+  if not os.path.exists(cache_file):
+    return {}
+
+  try:
+    with open(cache_file, 'rb') as fp:
+      cache = pickle.load(fp)
+  except Exception as e:
+    print("WARNING: could not read label cache %s (%s: %s); relabelling from scratch" %
+      (cache_file, type(e), e))
+    return {}
+
+  if cache.get('settings') != label_cache_settings():
+    print("Label cache %s was made with different settings; relabelling from scratch" % cache_file)
+    return {}
+  return cache
+
+def save_label_cache(cache, cache_file):
+  cache['settings'] = label_cache_settings()
+  with open(cache_file, 'wb') as fp:
+    pickle.dump(cache, fp)
 
-    with open(setup_file, 'rb') as sfile:
-      self.setups = pickle.load(sfile)
+class ReplayLabeller:
+  # solver is the name of the solver to use for the labelling MIP (see
+  # mip.SOLVERS), defaulting to config.MIP_SOLVER. cache is an optional dict
+  # of results kept from a previous ReplayLabeller (e.g. by mmrl.py --watch); it
+  # is read and updated, so that the scores, solutions and rankings of
+  # unchanged matches and replays (and the parsed player file, if unchanged)
+  # are reused rather than recomputed, and the previous solution is used to
+  # warm-start the MIP. See load_label_cache and
+  # save_label_cache for keeping it on disk between runs
+  def __init__(self, player_file, challonge_file, setup_file, solver=None, cache=None):
+    self.solver = solver if solver != None else config.MIP_SOLVER
+    self.cache = cache
+    if self.cache != None:
+      for name in ['labels', 'solutions', 'rankings', 'assignment', 'players']:
+        self.cache.setdefault(name, {})
+
+    # challonge_file and setup_file are stores (see store.py), or pickles
+    # written by earlier versions
+    challonge = store.load_challonge(challonge_file)
+    self.matches = store.match_list(challonge)
+
+    self.replays = store.load_setups(setup_file)
+    self.setups = store.setup_list(self.replays)
+
+    # the character names of the codes in the replays' Ports
+    self.char_names = self.replays['char_names'].tolist()
 
     # dict mapping a challonge player id to their challonge display name
-    self.playerid_map = {p['id']:p['display-name'] for p in self.participants}
+    self.playerid_map = store.participant_names(challonge)
 
     # dict mapping a tag fingerprint to their mains/secondaries
-    self.main_map = data.parse_player_file(player_file)
+    self.main_map = data.parse_player_file(player_file,
+                                           self.cache['players'] if self.cache != None else None)
+
+    # dict mapping a challonge player id to their mains/secondaries, or None if
+    # they aren't in main_map
+    self.player_mains = {pid : self.main_map.get(data.tag_fingerprint(tag))
+                         for pid, tag in self.playerid_map.items()}
+
+    # dict mapping a challonge player id to a table of the log-probability of
+    # them playing each character of char_names (see char_logprob_table)
+    self.char_logprobs = {pid : self.char_logprob_table(mains)
+                          for pid, mains in self.player_mains.items()}
 
     # setup the distribution pdfs for the differences between challonge
     # start/end time and replay start/end time
@@ -35,6 +152,111 @@ class ReplayLabeller:
     self.start_pdf = norm(config.ANNOUNCE_TO_START_MEAN, config.ANNOUNCE_TO_START_SD).pdf
     self.end_pdf = norm(config.END_TO_REPORT_MEAN, config.END_TO_REPORT_SD).pdf
 
+    # the ranges of start_diff and end_diff (see compute_time_ll) that have
+    # finite log-likelihood
+    self.max_start_diff = max_time_diff(config.ANNOUNCE_TO_START_MEAN, config.ANNOUNCE_TO_START_SD)
+    self.max_end_diff = max_time_diff(config.END_TO_REPORT_MEAN, config.END_TO_REPORT_SD)
+
+    # how far the first replay of a label may start before its match started,
+    # and its last replay end after the match was reported; config.TIME_SLACK,
+    # except while estimating clock offsets
+    self.time_slack = config.TIME_SLACK
+
+    # per-setup arrays of the character codes of each replay's ports
+    # (setup_port_chars) and the output of port_runs, used by the vectorized
+    # scoring in compute_all_labels. The slices of the store's columns are
+    # viewed as plain arrays, since indexing a np.memmap is much slower
+    self.setup_port_runs = []
+    self.window_check_cache = {} # see window_checks
+    self.setup_port_chars = []
+    offsets = self.replays['setup_offsets'].tolist()
+    for si in range(len(self.setups)):
+      a, b = offsets[si], offsets[si+1]
+      self.setup_port_chars.append(np.asarray(self.replays['port_char'][a:b]))
+      self.setup_port_runs.append(port_runs(self.setup_port_chars[-1],
+                                            np.asarray(self.replays['port_dead'][a:b]),
+                                            np.asarray(self.replays['numplayers'][a:b])))
+
+    # the replay times of the store, and the clock offset (in seconds) of
+    # each replay of each setup that is subtracted from them; see
+    # set_clock_offsets
+    self.store_times = (self.replays['start'], self.replays['end'])
+    self.clock_offsets = [np.zeros(len(setup['replays']), dtype=np.int64) for setup in self.setups]
+
+    # keys identifying each match across runs, for self.cache. A match's key
+    # covers everything its labels' scores depend on, including the players'
+    # mains
+    self.match_keys = [self.match_key(match) for match in self.matches]
+    self.index_times()
+
+    if self.cache != None:
+      self.diff_inputs()
+
+  # build the per-setup arrays of replay start/end times (UTC epoch seconds)
+  # used by the vectorized scoring in compute_all_labels, and the keys of the
+  # replays for self.cache. Replays are in order of their start times in the
+  # store, but clock offsets can shift them out of order, so windows are
+  # found by the running maximum setup_max_starts and the running minimum
+  # from the end setup_min_starts of the start times (which are both just the
+  # start times when they're in order). End times needn't be in order either,
+  # so their running maximum setup_max_ends is the index for window ends
+  def index_times(self):
+    self.setup_starts = []
+    self.setup_ends = []
+    self.setup_max_starts = []
+    self.setup_min_starts = []
+    self.setup_max_ends = []
+    offsets = self.replays['setup_offsets'].tolist()
+    for si in range(len(self.setups)):
+      a, b = offsets[si], offsets[si+1]
+      self.setup_starts.append(np.asarray(self.replays['start'][a:b]))
+      self.setup_ends.append(np.asarray(self.replays['end'][a:b]))
+      self.setup_max_starts.append(np.maximum.accumulate(self.setup_starts[-1]))
+      self.setup_min_starts.append(np.minimum.accumulate(self.setup_starts[-1][::-1])[::-1])
+      self.setup_max_ends.append(np.maximum.accumulate(self.setup_ends[-1]))
+
+    # keys identifying each replay across runs, for self.cache
+    self.replay_keys = [list(zip(self.replays['filename'][offsets[si]:offsets[si+1]].tolist(),
+                                 self.setup_starts[si].tolist(), self.setup_ends[si].tolist()))
+                        for si in range(len(self.setups))]
+
+  # shift the replay times of each setup si by offsets[si], an array of the
+  # clock offset (in seconds) of each of its replays, which are subtracted
+  # from the times in the replay store. Everything from then on, including
+  # the output, sees the shifted times
+  def set_clock_offsets(self, offsets):
+    self.clock_offsets = offsets
+    shift = np.concatenate([np.zeros(0, dtype=np.int64)] + list(offsets))
+    self.replays['start'] = self.store_times[0] - shift
+    self.replays['end'] = self.store_times[1] - shift
+    self.setups = store.setup_list(self.replays)
+    self.index_times()
+
+  # report how the matches and replays have changed since the run that made
+  # self.cache, and record the current ones in it
+  def diff_inputs(self):
+    matches = {key[0] : key for key in self.match_keys}
+    replays = {key[0] : key for keys in self.replay_keys for key in keys}
+
+    if 'matches' in self.cache:
+      for name, old, new in [('matches', self.cache['matches'], matches),
+                             ('replays', self.cache['replays'], replays)]:
+        added = len([k for k in new if k not in old])
+        removed = len([k for k in old if k not in new])
+        changed = len([k for k in new if k in old and new[k] != old[k]])
+        print("Since the last run: %s new, %s removed and %s changed %s" %
+          (added, removed, changed, name))
+
+    self.cache['matches'] = matches
+    self.cache['replays'] = replays
+
+  def match_key(self, match):
+    players = []
+    for pid in match.player_ids:
+      mains, secs = self.player_mains[pid] or (set(), set())
+      players.append((self.playerid_map[pid], tuple(sorted(mains)), tuple(sorted(secs))))
+    return (match.id, match.start, match.end) + match.scores + (tuple(players),)
+
   # compute the log-likelihood of a match having produced the given replays
   def compute_total_ll(self, match, replays):
     time_ll = self.compute_time_ll(match, replays)
@@ -44,17 +266,12 @@ class ReplayLabeller:
 
     return total_ll
 
-  # I hate python's date/time handling so much :|
-  def time_diff(self, dt1, dt2):
-    return calendar.timegm(dt1.astimezone(pytz.timezone(config.TIME_ZONE)).timetuple()) -\
-           calendar.timegm(dt2.astimezone(pytz.timezone(config.TIME_ZONE)).timetuple())
-
   # compute the log-likelihood of a match having produced these replay timings
   def compute_time_ll(self, match, replays):
-    start_diff = self.time_diff(replays[0]['start_time'], match['started-at'])
-    end_diff = self.time_diff(match['completed-at'], replays[-1]['end_time'])
+    start_diff = replays[0].start - match.start
+    end_diff = match.end - replays[-1].end
 
-    if start_diff < -config.TIME_SLACK or end_diff < -config.TIME_SLACK:
+    if start_diff < -self.time_slack or end_diff < -self.time_slack:
       return -INF
 
     start_l = self.start_pdf(start_diff)
@@ -71,77 +288,147 @@ class ReplayLabeller:
 
     return time_ll
 
-  # compute the log-probability of a match having produced these ports,
-  # characters, and win pattern
-  def compute_char_logprob(self, match, replays):
+  # vectorized version of compute_time_ll; computes the time log-likelihoods of
+  # a match with the given start/end epochs having produced the ngames replays
+  # starting at each replay index in the array ris of setup si
+  def compute_time_lls(self, match_start, match_end, si, ngames, ris):
+    start_diff = self.setup_starts[si][ris] - match_start
+    end_diff = match_end - self.setup_ends[si][ris + ngames - 1]
+
+    start_ll = norm_logpdf(start_diff, config.ANNOUNCE_TO_START_MEAN, config.ANNOUNCE_TO_START_SD)
+    end_ll = norm_logpdf(end_diff, config.END_TO_REPORT_MEAN, config.END_TO_REPORT_SD)
+
+    time_ll = np.maximum(config.MIN_START_LL, start_ll) + np.maximum(config.MIN_END_LL, end_ll)
+
+    infeasible = (start_diff < -self.time_slack) | (end_diff < -self.time_slack) |\
+                 (start_ll < LOG_MIN_PDF) | (end_ll < LOG_MIN_PDF)
+    time_ll[infeasible] = -INF
+
+    return time_ll
+
+  # find the range of replay indices ri on setup si that could start a
+  # ngames-replay window for a match with the given start/end epochs, i.e.
+  # that start no earlier than TIME_SLACK before the match started, no later
+  # than the match ended (plus TIME_SLACK), and close enough to the match start
+  # to have a finite time log-likelihood, and whose last replay doesn't end
+  # too long before the match was reported to have a finite time
+  # log-likelihood. Returns an array of those indices
+  def candidate_windows(self, match_start, match_end, si, ngames):
+    nwindows = len(self.setup_starts[si]) - ngames + 1
+    if nwindows <= 0:
+      return np.arange(0)
+
+    # the first replay that can end a window is the first one by which some
+    # replay has ended late enough, and likewise for starting one; a window
+    # can only start at a replay from which on some replay starts early
+    # enough. Windows in this range that don't fit are scored as infeasible
+    first_end = np.searchsorted(self.setup_max_ends[si], match_end - self.max_end_diff, side='left')
+    lo = max(np.searchsorted(self.setup_max_starts[si], match_start - self.time_slack, side='left'),
+             first_end - ngames + 1)
+    hi = np.searchsorted(self.setup_min_starts[si], min(match_end + self.time_slack,
+                                                        match_start + self.max_start_diff), side='right')
+
+    return np.arange(lo, min(hi, nwindows))
+
+  # find which ports the two players of a match were on in these replays.
+  # Returns the pair (p1port, p2port), or None if the ports and win pattern of
+  # the replays can't have come from the match
+  def window_ports(self, match, replays):
     # assume that controller ports are never changed within a match
-    portsets = {tuple([i for i,p in enumerate(game['ports']) if p != None])
+    portsets = {tuple([i for i,p in enumerate(game.ports) if p != None])
                 for game in replays}
     if len(portsets) > 1:
-      return -INF # inconsistent ports
+      return None # inconsistent ports
     a, b = list(portsets)[0]
 
-    awins = sum([not game['ports'][a]['dead_at_end'] for game in replays])
-    bwins = sum([not game['ports'][b]['dead_at_end'] for game in replays])
+    awins = sum([not game.ports[a].dead_at_end for game in replays])
+    bwins = sum([not game.ports[b].dead_at_end for game in replays])
 
     # based on match score, infer which player was on which port
-    if awins == match['player1_score'] and bwins == match['player2_score']:
+    p1score, p2score = match.scores
+    if awins == p1score and bwins == p2score:
       p1port = a
       p2port = b
-    elif awins == match['player2_score'] and bwins == match['player1_score']:
+    elif awins == p2score and bwins == p1score:
       p1port = b
       p2port = a
     else:
       # match score does not make sense with the wins that each port had
-      return -INF
+      return None
 
     # filter out impossible cases like win-win-loss in a bo3, by verifying that
     # the winner won the last game
     winner = a if awins > bwins else b
-    if replays[-1]['ports'][winner]['dead_at_end']:
-      return -INF # invalid best-of-n results
+    if replays[-1].ports[winner].dead_at_end:
+      return None # invalid best-of-n results
+
+    return p1port, p2port
+
+  # split up the probability between a player's mains and secondaries. e.g. if
+  # MAIN_CHAR_PROB=.8 and SEC_CHAR_PROB=.1, then .8 probability is split up
+  # evenly among all the player's mains, and .1 probability is split up
+  # between the secondaries, but if the player has no secondaries, .9
+  # probability is split up among the mains (and vice-versa). Returns the
+  # total probability of the mains and of the secondaries
+  def main_sec_probs(self, mains, secs):
+    if len(secs) == 0:
+      return config.MAIN_CHAR_PROB + config.SEC_CHAR_PROB, 0
+    elif len(mains) == 0:
+      return 0, config.MAIN_CHAR_PROB + config.SEC_CHAR_PROB
+    else:
+      return config.MAIN_CHAR_PROB, config.SEC_CHAR_PROB
+
+  # the log-probability of a player with the given mains/secondaries (an entry
+  # of main_map, or None if they aren't in it) playing each character of
+  # char_names, as an array indexed by character code
+  def char_logprob_table(self, player_mains):
+    table = np.full(len(self.char_names), math.log(config.DEFAULT_PROB))
+    if player_mains == None or (len(player_mains[0]) == 0 and len(player_mains[1]) == 0):
+      return table
+
+    mains, secs = player_mains
+    main_prob, sec_prob = self.main_sec_probs(mains, secs)
+    for code, char in enumerate(self.char_names):
+      if char in mains:
+        table[code] = math.log(main_prob / len(mains))
+      elif char in secs:
+        table[code] = math.log(sec_prob / len(secs))
+      else:
+        table[code] = math.log( (1 - main_prob - sec_prob) * config.DEFAULT_PROB )
+    return table
+
+  # compute the log-probability of a match having produced these ports,
+  # characters, and win pattern
+  def compute_char_logprob(self, match, replays):
+    ports = self.window_ports(match, replays)
+    if ports == None:
+      return -INF
 
     # compute the total log-probability of these character selections,
     # normalized by the match length so that sets of different lengths are
     # comparable to each other
     total_char_logprob = 0
-    for player in [1,2]:
-      port = p1port if player == 1 else p2port
-      tagfp = data.tag_fingerprint(self.playerid_map[match['player%s-id' % player]])
-
+    for pid, port in zip(match.player_ids, ports):
       # if we don't know what this player's mains are, use the default
       # probability
-      if tagfp not in self.main_map:
+      if self.player_mains[pid] == None:
         total_char_logprob += math.log(config.DEFAULT_PROB)
         continue
 
-      mains, secs = self.main_map[tagfp]
-
-      # split up the probability between mains and secondaries. e.g. if
-      # MAIN_CHAR_PROB=.8 and SEC_CHAR_PROB=.1, then .8 probability is split up
-      # evenly among all the player's mains, and .1 probability is split up
-      # between the secondaries, but if the player has no secondaries, .9
-      # probability is split up among the mains (and vice-versa)
+      mains, secs = self.player_mains[pid]
       if len(mains) == 0 and len(secs) == 0:
         total_char_logprob += math.log(config.DEFAULT_PROB)
         continue
-      elif len(secs) == 0:
-        main_prob = config.MAIN_CHAR_PROB + config.SEC_CHAR_PROB
-        sec_prob = 0
-      elif len(mains) == 0:
-        main_prob = 0
-        sec_prob = config.MAIN_CHAR_PROB + config.SEC_CHAR_PROB
-      else:
-        main_prob = config.MAIN_CHAR_PROB
-        sec_prob = config.SEC_CHAR_PROB
+      main_prob, sec_prob = self.main_sec_probs(mains, secs)
 
       # based on the above assumptions, sum the log_probability for each of this
       # player's selections, and divide by number of replays. This is equivalent
       # to taking the log of the geometric mean of the character probabilities
       for game in replays:
-        if game['ports'][port]['char'] in mains:
+        char = self.char_names[game.ports[port].char]
+        if char in mains:
           total_char_logprob += math.log(main_prob / len(mains)) / len(replays)
-        elif game['ports'][port]['char'] in secs:
+        elif char in secs:
           total_char_logprob += math.log(sec_prob / len(secs)) / len(replays)
         else:
           total_char_logprob += math.log( (1 - main_prob - sec_prob) * config.DEFAULT_PROB )\
@@ -156,8 +443,118 @@ class ReplayLabeller:
   def compute_all_labels(self):
     label_counts = {si:0 for si in range(len(self.setups))}
     all_labels = [[] for match in self.matches]
+
+    # the scores of each (match, setup) pair are kept in self.cache, keyed by
+    # the match and the replays its candidate windows cover, so they're only
+    # recomputed when one of those changes
+    old_cache = self.cache['labels'] if self.cache != None else {}
+    new_cache = {}
+    npairs = 0
+    nreused = 0
+
     for mi, match in enumerate(self.matches):
-      ngames = match['num_games']
+      ngames = match.num_games
+      for si, setup in enumerate(self.setups):
+        ris = self.candidate_windows(match.start, match.end, si, ngames)
+        if len(ris) == 0:
+          continue
+
+        lo = int(ris[0])
+        key = (self.match_keys[mi], setup['drive'],
+               tuple(self.replay_keys[si][lo : int(ris[-1]) + ngames]))
+        npairs += 1
+        if key in old_cache:
+          scores = old_cache[key]
+          nreused += 1
+        else:
+          scores = self.score_windows(match, si, ris)
+          profiling.count('candidates', len(ris))
+        new_cache[key] = scores
+
+        for total_ll, k in scores:
+          all_labels[mi].append(( total_ll, si, lo + k ))
+          label_counts[si] += 1
+      all_labels[mi].sort(reverse=True)
+
+    if self.cache != None:
+      self.cache['labels'] = new_cache
+      print("Reused scores of %s/%s (match, setup) pairs" % (nreused, npairs))
+
+    for si in range(len(self.setups)):
+      print("Setup '%s': has %s replays -> %s labels" %
+        (self.setups[si]['drive'], len(self.setups[si]['replays']), label_counts[si]))
+
+    return all_labels
+
+  # the port and win checks of window_ports for every window on setup si
+  # that could be a match with the given scores, from the output of
+  # port_runs. Returns arrays feasible, p1ports and p2ports, where
+  # feasible[ri] is whether the window of replays from ri passes the checks,
+  # and if so, p1ports[ri] and p2ports[ri] are the ports of players 1 and 2.
+  # The checks only depend on the scores, so they're computed once for each
+  # setup and distinct scores, and kept in self.window_check_cache
+  def window_checks(self, si, scores):
+    if (si, scores) in self.window_check_cache:
+      return self.window_check_cache[si, scores]
+
+    run_ends, pair_ports, wins, win_counts = self.setup_port_runs[si]
+    ngames = sum(scores)
+    starts = np.arange(max(0, len(run_ends) - ngames + 1))
+    ends = starts + ngames
+    a = pair_ports[starts, 0]
+    b = pair_ports[starts, 1]
+    awins = win_counts[ends, a] - win_counts[starts, a]
+    bwins = win_counts[ends, b] - win_counts[starts, b]
+
+    # the ports must be the same throughout, the wins of each port must match
+    # the match's score one way or the other, and the winner must have won
+    # the last game
+    a_is_p1 = (awins == scores[0]) & (bwins == scores[1])
+    b_is_p1 = (awins == scores[1]) & (bwins == scores[0])
+    winner = np.where(awins > bwins, a, b)
+    feasible = (run_ends[starts] >= ends) & (a_is_p1 | b_is_p1) & wins[ends - 1, winner]
+
+    checks = (feasible, np.where(a_is_p1, a, b), np.where(a_is_p1, b, a))
+    self.window_check_cache[si, scores] = checks
+    return checks
+
+  # score the windows of match starting at each replay index in ris (the
+  # output of candidate_windows) on setup si. Returns a list of pairs
+  # (total_ll, k) for the windows ris[0] + k that score at least NOLABEL_OBJVAL
+  def score_windows(self, match, si, ris):
+    ngames = match.num_games
+
+    # score the timestamps of every plausible window at once, and only look at
+    # the characters of windows that pass the port and win checks of
+    # window_ports and can still score above NOLABEL_OBJVAL (char log-probs
+    # are never positive)
+    time_lls = self.compute_time_lls(match.start, match.end, si, ngames, ris)
+    feasible, p1ports, p2ports = self.window_checks(si, match.scores)
+    ks = np.flatnonzero(feasible[ris] & (time_lls >= config.NOLABEL_OBJVAL))
+    if len(ks) == 0:
+      return []
+    starts = ris[ks]
+
+    # the character term of every feasible window at once, as the mean over
+    # its games of each player's log-probability of the character on their
+    # port (see compute_char_logprob)
+    games = starts[:, None] + np.arange(ngames)
+    port_chars = self.setup_port_chars[si]
+    char_logprobs = sum([self.char_logprobs[pid][port_chars[games, ports[:, None]]].sum(axis=1)
+                         for pid, ports in zip(match.player_ids, [p1ports[starts], p2ports[starts]])]) / ngames
+    total_lls = time_lls[ks] + char_logprobs
+
+    return [(total_ll, k) for total_ll, k in zip(total_lls.tolist(), ks.tolist())
+            if total_ll >= config.NOLABEL_OBJVAL]
+
+  # the straightforward, unvectorized version of compute_all_labels, which
+  # scores every window with compute_total_ll. Kept as a reference
+  # implementation to check compute_all_labels against
+  def compute_all_labels_reference(self):
+    label_counts = {si:0 for si in range(len(self.setups))}
+    all_labels = [[] for match in self.matches]
+    for mi, match in enumerate(self.matches):
+      ngames = match.num_games
       for si, setup in enumerate(self.setups):
         for ri, replay in enumerate(setup['replays']):
           if len(setup['replays']) <= ri + ngames - 1:
@@ -165,7 +562,7 @@ class ReplayLabeller:
 
           replays = setup['replays'][ri : ri+ngames]
 
-          if any([r['numplayers'] != config.REQ_NUM_PLAYERS for r in replays]):
+          if any([r.numplayers != config.REQ_NUM_PLAYERS for r in replays]):
             continue
 
           total_ll = self.compute_total_ll(match, replays)
@@ -181,144 +578,264 @@ class ReplayLabeller:
 
     return all_labels
 
+  # keep only the k best labels of each match from all_labels (the output of
+  # compute_all_labels), plus any more that might be needed for an optimal
+  # solution, so that the MIP and the probability pass have fewer labels to
+  # deal with; see mip.prune_labels. The MIPs solved on the way use and fill
+  # self.cache like mip_solve. The output has the same format as
+  # compute_all_labels
+  def prune_labels(self, all_labels, k):
+    num_games = [m.num_games for m in self.matches]
+
+    def optimum(labels):
+      model = DecomposedMIP(num_games, labels, self.solver,
+                            self.label_keys(labels) if self.cache != None else None,
+                            self.cache['solutions'] if self.cache != None else None)
+      return sum([comp_objval for comp_objval, _ in model.unforced_solutions()])
+
+    pruned, final_k, rounds = prune_labels(num_games, all_labels, k, optimum)
+
+    nkept = sum([len(lbls) for lbls in pruned])
+    ntotal = sum([len(lbls) for lbls in all_labels])
+    profiling.count('labels', ntotal)
+    print("Kept %s/%s labels (the top %s of each match, plus %s more needed for optimality) after %s rounds" %
+      (nkept, ntotal, final_k, nkept - sum([min(final_k, len(lbls)) for lbls in all_labels]), rounds))
+    return pruned
+
+  # estimate the clock offset of each setup from the labels of the optimal
+  # labelling (see skew.py and config.SKEW_MAX etc.), and shift the replay
+  # times by them with set_clock_offsets, relabelling and estimating again
+  # until the offsets stop changing. The labellings done here allow replays
+  # to be off by up to SKEW_MAX seconds more than TIME_SLACK, so that labels
+  # on setups whose clocks are far off are still found, and don't use or
+  # update self.cache. Returns the offsets, as for set_clock_offsets
+  def estimate_clock_offsets(self):
+    grid = skew.offset_grid(config.SKEW_MAX, config.SKEW_STEP)
+    cache, self.cache = self.cache, None
+    self.time_slack = config.TIME_SLACK + config.SKEW_MAX
+    try:
+      for _ in range(config.SKEW_ROUNDS):
+        all_labels = self.compute_all_labels()
+        _, soln = self.mip_solve(all_labels)
+        residuals = self.skew_residuals(all_labels, soln, grid)
+        if not any([r.any() for r in residuals]):
+          break
+        self.set_clock_offsets([offs + r for offs, r in zip(self.clock_offsets, residuals)])
+    finally:
+      self.cache = cache
+      self.time_slack = config.TIME_SLACK
+
+    for si, offs in enumerate(self.clock_offsets):
+      changes = [ri for ri in range(len(offs)) if ri == 0 or offs[ri] != offs[ri-1]]
+      print("Setup '%s': estimated clock offset %s" % (self.setups[si]['drive'],
+        ', '.join(['%+ds from game %s' % (offs[ri], ri) for ri in changes])))
+    return self.clock_offsets
+
+  # the clock offsets of each setup relative to its current replay times, as
+  # for set_clock_offsets, estimated from the confident labels of soln, the
+  # MIP solution for all_labels, with offsets from grid
+  def skew_residuals(self, all_labels, soln, grid):
+    confident = [[] for _ in self.setups] # (ri, mi) of each confident label
+    for mi, lbl in enumerate(soln):
+      if lbl == None:
+        continue
+      next_best = max([config.NOLABEL_OBJVAL] +
+                      [ll for ll, si, ri in all_labels[mi] if (si, ri) != lbl[1:]])
+      if lbl[0] - next_best >= config.SKEW_MIN_MARGIN:
+        confident[lbl[1]].append((lbl[2], mi))
+
+    residuals = [np.zeros(len(setup['replays']), dtype=np.int64) for setup in self.setups]
+    for si, lbls in enumerate(confident):
+      if len(lbls) < config.SKEW_MIN_LABELS:
+        continue
+
+      lbls.sort()
+      ris = np.array([ri for ri, _ in lbls])
+      matches = [self.matches[mi] for _, mi in lbls]
+      ngames = np.array([match.num_games for match in matches])
+      start_diff = self.setup_starts[si][ris] - np.array([match.start for match in matches])
+      end_diff = np.array([match.end for match in matches]) - self.setup_ends[si][ris + ngames - 1]
+
+      # the time log-likelihood of compute_time_lls of every label with every
+      # offset at once, leaving out the cutoffs so that a wrong label can't
+      # rule an offset out
+      lls = (np.maximum(config.MIN_START_LL, norm_logpdf(start_diff[None, :] - grid[:, None],
+                        config.ANNOUNCE_TO_START_MEAN, config.ANNOUNCE_TO_START_SD)) +
+             np.maximum(config.MIN_END_LL, norm_logpdf(end_diff[None, :] + grid[:, None],
+                        config.END_TO_REPORT_MEAN, config.END_TO_REPORT_SD)))
+
+      for j, g in skew.fit_pieces(lls, config.SKEW_MIN_LABELS, config.SKEW_MIN_GAIN):
+        residuals[si][0 if j == 0 else ris[j]:] = grid[g]
+    return residuals
+
+  # build the labelling MIP for the matches, from output of compute_all_labels.
+  # With a cache, the unforced solutions of its components are kept in it, and
+  # anything cached for components that no longer exist is dropped
+  def build_mip(self, all_labels):
+    num_games = [m.num_games for m in self.matches]
+    if self.cache == None:
+      return DecomposedMIP(num_games, all_labels, self.solver)
+
+    # the previous run's label of each match, if it still has it, to start
+    # the solver from
+    hints = []
+    for mi, lbls in enumerate(all_labels):
+      prev = self.cache['assignment'].get(self.match_keys[mi][0])
+      hints.append(next((lbl for lbl in lbls
+                         if (self.setups[lbl[1]]['drive'], self.replay_keys[lbl[1]][lbl[2]]) == prev),
+                        None))
+
+    model = DecomposedMIP(num_games, all_labels, self.solver, self.label_keys(all_labels),
+                          self.cache['solutions'], hints)
+    signatures = {model.signature(ci) for ci in range(len(model.components))}
+    for name in ['solutions', 'rankings']:
+      for sig in [sig for sig in self.cache[name] if sig not in signatures]:
+        del self.cache[name][sig]
+    return model
+
+  # keys identifying each match together with its labels across runs, for
+  # DecomposedMIP.signature
+  def label_keys(self, all_labels):
+    return [(self.match_keys[mi],
+             tuple([(ll, self.setups[si]['drive'], self.replay_keys[si][ri]) for ll, si, ri in lbls]))
+            for mi, lbls in enumerate(all_labels)]
+
   # given the list of matches, and output from ReplayLabeller.compute_all_labels,
-  # construct a glpk MIP instance for the problem and solve it. forced_labels
+  # construct the MIP for the problem and solve it. forced_labels
   # is a set containing triples (mi, si, ri) indicating that mi must be
   # labelled with (si, ri), and/or pairs (mi, None) indicating mi must be left
   # unlabelled.
   def mip_solve(self, all_labels, forced_labels = set()):
-    replays = list({(si, ri) for lbls in all_labels for _, si, ri in lbls})
-
-    N = sum([len(lbls) for lbls in all_labels]) + len(self.matches) # number of variables
-    M = len(self.matches) + len(replays) # number of constraints
-
-    # number of nonzero entries in constraint matrix
-    nze = sum([(m['num_games']+1)*len(lbls)+1 for m,lbls in zip(self.matches, all_labels)])
-
-    ia = intArray(1+nze) # primal constraint indices
-    ja = intArray(1+nze) # primal variable indices
-    ar = doubleArray(1+nze) # nonzero values of constraint matrix
-    a_idx = 1 # the next index in ar to use
-
-    # update the state of ia, ja, ar, a_idx to add the entry A[i,j] = val to the
-    # constraint matrix A
-    def add_cm_entry(i, j, val, a_idx):
-      ia[a_idx] = i
-      ja[a_idx] = j
-      ar[a_idx] = val
-
-    mip = glp_create_prob()
-    glp_set_prob_name(mip, "replay_label_MIP")
-    glp_set_obj_dir(mip, GLP_MAX)
-
-    # initialize primal variables
-    glp_add_cols(mip, N)
-    lvars = {} # dict mapping a triple mi, si, ri to its glpk variable index
-    var_idx = 1
-    for mi, lbls in enumerate(all_labels):
-      for ll, si, ri in lbls:
-        lvars[mi, si, ri] = var_idx
-        glp_set_col_name(mip, var_idx, "M%s_s%sr%s" % (mi, si, ri))
-        if (mi, si, ri) in forced_labels:
-          glp_set_col_bnds(mip, var_idx, GLP_FX, 1.0, 1.0)
-        else:
-          glp_set_col_bnds(mip, var_idx, GLP_DB, 0.0, 1.0)
-        glp_set_obj_coef(mip, var_idx, ll)
-        glp_set_col_kind(mip, var_idx, GLP_IV)
-        var_idx += 1
-    for mi in range(len(self.matches)):
-      glp_set_col_name(mip, var_idx, "M%s_unlabelled" % mi)
-      if (mi, None) in forced_labels:
-        glp_set_col_bnds(mip, var_idx, GLP_FX, 1.0, 1.0)
-      else:
-        glp_set_col_bnds(mip, var_idx, GLP_DB, 0.0, 1.0)
-      glp_set_obj_coef(mip, var_idx, config.NOLABEL_OBJVAL)
-      var_idx += 1
-
-
-    # initialize primal constraints, and populate constraint matrix
-    # the constraint population is pretty inefficient, but probably isn't a
-    # bottleneck anyway
-    glp_add_rows(mip, M)
-    row_idx = 1
-    a_idx = 1
-    # match constraints: each match has total probability 1 for its labels
-    for mi, lbls in enumerate(all_labels):
-      glp_set_row_name(mip, row_idx, "M%s=1" % mi)
-      glp_set_row_bnds(mip, row_idx, GLP_FX, 1.0, 1.0)
-
-      add_cm_entry(row_idx, len(lvars)+mi+1, 1.0, a_idx)
-      a_idx += 1
-      for (vmi, vsi, vri), j in lvars.items():
-        if vmi == mi:
-          add_cm_entry(row_idx, j, 1.0, a_idx)
-          a_idx += 1
-      row_idx += 1
-    # replay constraints: each replay has total probability at most 1 for its
-    # labels
-    for si, ri in replays:
-      glp_set_row_name(mip, row_idx, "s%sr%s<=1" % (si,ri))
-      glp_set_row_bnds(mip, row_idx, GLP_UP, 1.0, 1.0)
-
-      for (vmi, vsi, vri), j in lvars.items():
-        if vsi == si and vri <= ri < vri + self.matches[vmi]['num_games']:
-          add_cm_entry(row_idx, j, 1.0, a_idx)
-          a_idx += 1
-      row_idx += 1
-
-    glp_load_matrix(mip, a_idx-1, ia, ja, ar)
-
-    parm = glp_iocp()
-    glp_init_iocp(parm)
-    parm.presolve = GLP_ON
-    glp_intopt(mip, parm)
-
-    # extract the solution from the mip
-    soln = [None for _ in self.matches]
-    llmap = {(mi, si, ri) : ll
-             for mi in range(len(self.matches))
-             for ll, si, ri in all_labels[mi]}
-    for (mi, si, ri), j in lvars.items():
-      val = glp_mip_col_val(mip, j)
-      assert val in [0,1]
-      if val == 1:
-        soln[mi] = llmap[mi,si,ri], si, ri
-
-    objval = glp_mip_obj_val(mip)
-    print("MIP solved; objval=%.2f, labelled %s/%s matches" %
-      (objval, len([s for s in soln if s != None]), len(self.matches)))
+    num_games = [m.num_games for m in self.matches]
+    variables, constraints, nonzeros = mip_size(num_games, all_labels)
+    with profiling.stage('mip_solve', solver=self.solver, variables=variables,
+                         constraints=constraints, nonzeros=nonzeros):
+      objval, soln = self.build_mip(all_labels).solve(forced_labels)
+
+    # remember the unforced solution, by match id and first replay, as the
+    # starting point for the next run
+    if self.cache != None and len(forced_labels) == 0:
+      self.cache['assignment'] = {self.match_keys[mi][0] :
+                                    (self.setups[lbl[1]]['drive'], self.replay_keys[lbl[1]][lbl[2]])
+                                  for mi, lbl in enumerate(soln) if lbl != None}
     return objval, soln
 
   # for a given match, find the log-likelihood of the best solution for each of
-  # its labels, and use this to estimate the probability of each label. If
-  # include_nolabel is true-ish, then the option of providing no label is also
-  # included. Omit results with probability less than threshold
-  def get_indiv_rankings(self, all_labels, mi, include_nolabel=True, normalize=True, threshold=0.0):
-    labels = []
-    for _, si, ri in all_labels[mi]:
-      objval, soln = self.mip_solve(all_labels, forced_labels = {(mi, si, ri)})
-      labels.append([objval, si, ri])
-
-    if include_nolabel:
-      ul_objval, ul_soln = self.mip_solve(all_labels, forced_labels = {(mi, None)})
-      labels.append([ul_objval, None, None])
-
-    if normalize:
-      # compute the relative probability of each solution
-      mean = sum([lbl[0] for lbl in labels]) * 1.0 / len(labels)
-      for lbl in labels:
-        lbl[0] = math.exp(lbl[0] - mean)
-      total_l = sum([lbl[0] for lbl in labels])
-      for lbl in labels:
-        lbl[0] /= total_l
-      labels.sort(reverse=True)
-
-    return [lbl for lbl in labels if lbl[0] >= threshold]
+  # its labels, and use this to estimate the probability of each label; see
+  # rank_labels. The forced solves are done by re-solving model, a
+  # DecomposedMIP for all_labels, which is built if not given
+  def get_indiv_rankings(self, all_labels, mi, include_nolabel=True, normalize=True, threshold=0.0,
+                         model=None):
+    if model == None:
+      model = self.build_mip(all_labels)
+    return rank_labels(model, mi, include_nolabel, normalize, threshold)
 
   # given the likelihoods of each label, estimate the *probability* of each
   # label. Does this at the match level by comparing the likelihoods of each
-  # feasible label (including having no label at all) for this match.
-  def get_all_labels_probs(self, all_labels, include_nolabel=True, normalize=True, threshold=0.0):
-    soln = [self.get_indiv_rankings(all_labels, mi, include_nolabel, normalize, threshold)
-            for mi in range(len(self.matches))]
-    return soln
+  # feasible label (including having no label at all) for this match. If jobs
+  # > 1, the matches are split up between a pool of that many processes, each
+  # with its own copy of the MIP; the result is the same either way. With a
+  # cache, matches whose component is unchanged since a previous run aren't
+  # re-ranked
+  def get_all_labels_probs(self, all_labels, include_nolabel=True, normalize=True, threshold=0.0,
+                           jobs=1):
+    return [lbls for _, lbls in self.iter_all_labels_probs(all_labels, include_nolabel, normalize,
+                                                           threshold, jobs)]
+
+  # get_all_labels_probs as a generator of the pairs (mi, probs[mi]), in match
+  # order, yielding each match as soon as it's ranked so that it can be
+  # written out before the rest are done
+  def iter_all_labels_probs(self, all_labels, include_nolabel=True, normalize=True, threshold=0.0,
+                            jobs=1):
+    model = self.build_mip(all_labels)
+    options = (include_nolabel, normalize, threshold)
+
+    # cached rankings refer to labels by their index in all_labels[mi], since
+    # setup and replay indices can shift between runs
+    cached = [None for _ in self.matches]
+    if self.cache != None:
+      for mi in range(len(self.matches)):
+        ci, k = model.component_of[mi]
+        ranking = self.cache['rankings'].get(model.signature(ci), {}).get((k,) + options)
+        if ranking != None:
+          cached[mi] = [[p, None, None] if j == None else [p] + list(all_labels[mi][j][1:])
+                        for p, j in ranking]
+    todo = [mi for mi in range(len(self.matches)) if cached[mi] == None]
+    profiling.count('matches', len(todo))
+
+    with contextlib.ExitStack() as stack:
+      if jobs <= 1:
+        rankings = (rank_labels(model, mi, *options) for mi in todo)
+      else:
+        # consecutive matches tend to be in the same component, so hand them
+        # out in chunks to make the most of each worker's solved components.
+        # The unforced solutions are solved once here and shared with the
+        # workers, which then only solve forced components
+        num_games = [m.num_games for m in self.matches]
+        tasks = [(mi,) + options for mi in todo]
+        chunksize = max(1, len(tasks) // (4*jobs))
+        pool = stack.enter_context(multiprocessing.Pool(jobs, init_rank_worker,
+                                                        (num_games, all_labels, self.solver,
+                                                         model.unforced_solutions())))
+        rankings = pool.imap(rank_worker, tasks, chunksize)
+
+      rankings = iter(rankings)
+      for mi in range(len(self.matches)):
+        if cached[mi] != None:
+          yield mi, cached[mi]
+          continue
+
+        lbls = next(rankings)
+        if self.cache != None:
+          ci, k = model.component_of[mi]
+          index = {lbl[1:] : j for j, lbl in enumerate(all_labels[mi])}
+          self.cache['rankings'].setdefault(model.signature(ci), {})[(k,) + options] = \
+            [[p, None if si == None else index[(si, ri)]] for p, si, ri in lbls]
+        yield mi, lbls
+
+    if self.cache != None:
+      print("Reused label rankings of %s/%s matches" % (len(self.matches) - len(todo), len(self.matches)))
+
+  # estimate the posterior probability of each label, rather than comparing
+  # the best solutions using each label like get_all_labels_probs does; see
+  # marginals.py. The output has the same format as get_all_labels_probs
+  def get_all_labels_marginals(self, all_labels, threshold=0.0):
+    return marginals.label_marginals([m.num_games for m in self.matches], all_labels, threshold)
+
+# for match mi, find the log-likelihood of the best solution of model (a
+# DecomposedMIP) for each of its labels, and use this to estimate the
+# probability of each label. If include_nolabel is true-ish, then the option of
+# providing no label is also included. Omit results with probability less than
+# threshold
+def rank_labels(model, mi, include_nolabel=True, normalize=True, threshold=0.0):
+  labels = []
+  for _, si, ri in model.all_labels[mi]:
+    objval, soln = model.solve(forced_labels = {(mi, si, ri)})
+    labels.append([objval, si, ri])
+
+  if include_nolabel:
+    ul_objval, ul_soln = model.solve(forced_labels = {(mi, None)})
+    labels.append([ul_objval, None, None])
+
+  if normalize:
+    # compute the relative probability of each solution
+    mean = sum([lbl[0] for lbl in labels]) * 1.0 / len(labels)
+    for lbl in labels:
+      lbl[0] = math.exp(lbl[0] - mean)
+    total_l = sum([lbl[0] for lbl in labels])
+    for lbl in labels:
+      lbl[0] /= total_l
+    labels.sort(reverse=True)
+
+  return [lbl for lbl in labels if lbl[0] >= threshold]
+
+# the MIP of a worker process of get_all_labels_probs
+worker_model = None
+
+def init_rank_worker(num_games, all_labels, solver, solutions):
+  global worker_model
+  worker_model = DecomposedMIP(num_games, all_labels, solver)
+  worker_model.solutions = list(solutions)
+
+def rank_worker(task):
+  return rank_labels(worker_model, *task)
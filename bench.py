@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+# benchmarks of the replay labeller on synthetic tournaments. A synthetic
+# tournament is a single elimination bracket whose matches are played on a
+# number of setups as soon as both players and a setup are free, with
+# challonge timestamps and replays that follow the labeller's timing model,
+# and with clock skew between the setups and noise (friendlies between
+# matches, counterpicks) added on top. Since the replays of each match are
+# known, the labeller's accuracy can be measured alongside its runtime
+import os
+import io
+import sys
+import math
+import time
+import random
+import argparse
+import datetime
+import tempfile
+import contextlib
+import pytz
+import numpy as np
+import swiglpk
+
+import config
+import store
+from ReplayLabeller import ReplayLabeller
+
+CHARS = ['FOX', 'FALCO', 'MARTH', 'SHEIK', 'CAPTAIN_FALCON', 'PEACH', 'JIGGLYPUFF',
+         'SAMUS', 'GANONDORF', 'LUIGI', 'ICE_CLIMBERS', 'PIKACHU', 'YOSHI', 'DR_MARIO']
+
+desc = """
+Benchmark the replay labeller on synthetic tournaments, timing
+compute_all_labels, mip_solve and get_all_labels_probs and measuring how many
+matches get their true replays, for each number of entrants given. With more
+than one number of entrants, a growth curve time = a * entrants^b is fitted to
+each stage's times.
+
+Example:
+%(prog)s -e 32 64 128 256 --setups 8 --skew 60
+"""
+
+def make_replay(rnd, start, duration, ports, chars, winner, numplayers=2):
+  replay_ports = [None, None, None, None]
+  for k, port in enumerate(ports):
+    replay_ports[port] = {'char' : chars[k], 'dead_at_end' : k != winner}
+  return {
+    'start_time' : start,
+    'end_time'   : start + datetime.timedelta(seconds = duration),
+    'filename'   : 'Game_%012x.slp' % rnd.getrandbits(48),
+    'drive'      : None,
+    'ports'      : replay_ports,
+    'stage'      : rnd.choice(['BATTLEFIELD', 'FINAL_DESTINATION', 'DREAM_LAND_N64',
+                               'YOSHIS_STORY', 'FOUNTAIN_OF_DREAMS', 'POKEMON_STADIUM']),
+    'numplayers' : numplayers,
+  }
+
+# generate a synthetic tournament with the given number of entrants, played on
+# the given number of setups, where every match is a best-of-best_of. Each
+# setup's clock is off by a normally distributed offset with standard
+# deviation skew (in seconds), and noise (between 0 and 1) is the probability
+# of a friendly being played on a setup between two matches, and of a player
+# counterpicking away from their main in a game. Returns the challonge data
+# and list of setups, in the formats written by data.fetch_brackets_to_file and
+# data.parse_all_slp_drives, a dict mapping each player's tag to their
+# mains/secondaries (as parsed by data.parse_player_file), and the true label
+# of each match, as the drive and filename of its first replay
+def make_tournament(entrants=64, setups=8, best_of=3, skew=0.0, noise=0.1, seed=0):
+  rnd = random.Random(seed)
+  tz = pytz.timezone(config.TIME_ZONE)
+  t0 = tz.localize(datetime.datetime(2019, 5, 18, 12, 0, 0))
+
+  participants = [{'id' : 1000+i, 'display-name' : 'Player %s' % i} for i in range(entrants)]
+  mains = [rnd.sample(CHARS, rnd.choice([1, 1, 2])) for _ in range(entrants)]
+  secs = [[c for c in rnd.sample(CHARS, rnd.choice([0, 1, 2])) if c not in m] for m in mains]
+  main_map = {p['display-name'] : (set(m), set(s)) for p, m, s in zip(participants, mains, secs)}
+
+  setup_list = [{'drive' : 'Drive #%s' % (si+1), 'replays' : []} for si in range(setups)]
+  setup_free = [t0 for _ in range(setups)]
+  clock_offsets = [datetime.timedelta(seconds = rnd.gauss(0, skew)) for _ in range(setups)]
+  matches = []
+  truth = []
+
+  # play the bracket round by round; each match waits for a free setup and for
+  # both its players to finish their previous match
+  player_free = {p : t0 for p in range(entrants)}
+  players = list(range(entrants))
+  rnd.shuffle(players)
+  while len(players) > 1:
+    # with an odd number of players left, the first gets a bye
+    bye = len(players) % 2
+    winners = players[:bye]
+    for a, b in zip(players[bye::2], players[bye+1::2]):
+      si = min(range(setups), key = lambda s: setup_free[s])
+      called = max(setup_free[si], player_free[a], player_free[b])
+      t = called + datetime.timedelta(seconds = max(0, rnd.gauss(config.ANNOUNCE_TO_START_MEAN,
+                                                                 config.ANNOUNCE_TO_START_SD / 3)))
+      replays = setup_list[si]['replays']
+      if rnd.random() < noise:
+        replays.append(make_replay(rnd, t + clock_offsets[si], rnd.uniform(60, 300),
+                                   sorted(rnd.sample(range(4), 2)), rnd.sample(CHARS, 2), 0))
+        t += datetime.timedelta(seconds = rnd.uniform(320, 400))
+
+      # the stronger player (by seed, i.e. lower index) usually wins
+      winner = 0 if rnd.random() < 0.5 + 0.3 * (b - a) / entrants else 1
+      wins_needed = best_of // 2 + 1
+      results = [1 - winner] * rnd.randrange(wins_needed) + [winner] * wins_needed
+      results = results[:-1]
+      rnd.shuffle(results)
+      results.append(winner)
+
+      ports = sorted(rnd.sample(range(4), 2))
+      first = len(replays)
+      for result in results:
+        duration = rnd.uniform(120, 420)
+        chars = [mains[p][0] if rnd.random() >= noise else rnd.choice(CHARS) for p in (a, b)]
+        replays.append(make_replay(rnd, t + clock_offsets[si], duration, ports, chars, result))
+        t += datetime.timedelta(seconds = duration + rnd.uniform(10, 60))
+      truth.append((setup_list[si]['drive'], replays[first]['filename']))
+
+      reported = t + datetime.timedelta(seconds = rnd.gauss(config.END_TO_REPORT_MEAN,
+                                                            config.END_TO_REPORT_SD / 3))
+      setup_free[si] = t
+      player_free[a] = player_free[b] = reported
+
+      # players are randomly player 1 or player 2 in challonge
+      awins = sum([r == 0 for r in results])
+      bwins = len(results) - awins
+      p1, p2, s1, s2 = (a, b, awins, bwins) if rnd.random() < 0.5 else (b, a, bwins, awins)
+      matches.append({
+        'id'            : 5000 + len(matches),
+        'player1-id'    : 1000 + p1,
+        'player2-id'    : 1000 + p2,
+        'scores-csv'    : '%s-%s' % (s1, s2),
+        'player1_score' : s1,
+        'player2_score' : s2,
+        'num_games'     : s1 + s2,
+        'started-at'    : called,
+        'completed-at'  : reported,
+      })
+      winners.append(a if winner == 0 else b)
+    players = winners
+
+  for setup in setup_list:
+    setup['replays'].sort(key = lambda r: r['start_time'])
+  return {'matches' : matches, 'participants' : participants}, setup_list, main_map, truth
+
+# the fraction of matches whose label (a triple (ll, si, ri), or None) in soln
+# is their true label
+def accuracy(labeller, soln, truth):
+  correct = 0
+  for lbl, (drive, filename) in zip(soln, truth):
+    if lbl != None and lbl[1] != None:
+      setup = labeller.setups[lbl[1]]
+      correct += setup['drive'] == drive and setup['replays'][lbl[2]].filename == filename
+  return correct / len(truth)
+
+# time the labeller's stages on a synthetic tournament made with the given
+# keyword arguments for make_tournament, estimating the setups' clock offsets
+# first if estimate_skew, and pruning the labels with
+# ReplayLabeller.prune_labels if top_k is given. Returns a dict of the times
+# and accuracies
+def run(probs=True, mains=False, jobs=1, top_k=None, estimate_skew=False, **kwargs):
+  challonge_data, setups, main_map, truth = make_tournament(**kwargs)
+  result = {'matches' : len(challonge_data['matches']),
+            'replays' : sum([len(s['replays']) for s in setups])}
+
+  with tempfile.TemporaryDirectory() as tmp:
+    challonge_file = os.path.join(tmp, config.CHALLONGE_FILE)
+    slippi_file = os.path.join(tmp, config.SLIPPI_FILE)
+    store.write_challonge(challonge_data, challonge_file)
+    store.write_setups(setups, slippi_file)
+
+    player_file = None
+    if mains:
+      player_file = os.path.join(tmp, 'players.csv')
+      with open(player_file, 'w') as fp:
+        fp.write('TAG,Main,Secondaries\n')
+        for tag, (m, s) in main_map.items():
+          fp.write('%s,%s,%s\n' % (tag, ' '.join(sorted(m)), ' '.join(sorted(s))))
+
+    with contextlib.redirect_stdout(io.StringIO()):
+      t = time.perf_counter()
+      labeller = ReplayLabeller(player_file, challonge_file, slippi_file)
+      result['load'] = time.perf_counter() - t
+
+      if estimate_skew:
+        t = time.perf_counter()
+        labeller.estimate_clock_offsets()
+        result['estimate_skew'] = time.perf_counter() - t
+
+      t = time.perf_counter()
+      all_labels = labeller.compute_all_labels()
+      result['compute_all_labels'] = time.perf_counter() - t
+
+      if top_k != None:
+        t = time.perf_counter()
+        all_labels = labeller.prune_labels(all_labels, top_k)
+        result['prune_labels'] = time.perf_counter() - t
+
+      t = time.perf_counter()
+      objval, soln = labeller.mip_solve(all_labels)
+      result['mip_solve'] = time.perf_counter() - t
+
+      if probs:
+        t = time.perf_counter()
+        probs_labels = labeller.get_all_labels_probs(all_labels, jobs = jobs)
+        result['get_all_labels_probs'] = time.perf_counter() - t
+
+  result['labels'] = sum([len(lbls) for lbls in all_labels])
+  result['labelled'] = sum([lbl != None for lbl in soln]) / len(soln)
+  result['accuracy'] = accuracy(labeller, soln, truth)
+  if probs:
+    result['top_prob_accuracy'] = accuracy(labeller, [lbls[0] if len(lbls) > 0 else None
+                                                      for lbls in probs_labels], truth)
+  return result
+
+# fit time = a * n^b to the times of a stage, returning a and b
+def fit_growth(ns, times):
+  b, log_a = np.polyfit(np.log(ns), np.log(times), 1)
+  return math.exp(log_a), b
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description = desc,
+    formatter_class=argparse.RawTextHelpFormatter)
+  parser.add_argument("-e", "--entrants", metavar="N", type=int, nargs="+", default=[32, 64, 128],
+    help="numbers of entrants to benchmark (default: 32 64 128)")
+  parser.add_argument("--setups", type=int, default=8, help="number of setups (default: 8)")
+  parser.add_argument("--best-of", type=int, default=3, help="games per match (default: 3)")
+  parser.add_argument("--skew", type=float, default=0.0,
+    help="standard deviation of each setup's clock offset, in seconds (default: 0)")
+  parser.add_argument("--noise", type=float, default=0.1,
+    help="probability of a friendly between matches, and of a counterpick\n"
+         "in a game (default: 0.1)")
+  parser.add_argument("--mains", action="store_true",
+    help="give the labeller the players' mains through a player csv")
+  parser.add_argument("--estimate-skew", action="store_true",
+    help="estimate the setups' clock offsets first (see mmrl.py --estimate-skew)")
+  parser.add_argument("--top-k", metavar="K", type=int,
+    help="prune the labels to the K best of each match (see mmrl.py --top-k)")
+  parser.add_argument("--no-probs", action="store_true",
+    help="don't time get_all_labels_probs")
+  parser.add_argument("-j", "--jobs", metavar="N", type=int, default=1,
+    help="processes for get_all_labels_probs (default: 1)")
+  parser.add_argument("--seed", type=int, default=0, help="random seed (default: 0)")
+  args = parser.parse_args()
+
+  swiglpk.glp_term_out(swiglpk.GLP_OFF)
+  stages = (['load'] +
+            (['estimate_skew'] if args.estimate_skew else []) +
+            ['compute_all_labels'] +
+            ([] if args.top_k == None else ['prune_labels']) +
+            ['mip_solve'] +
+            ([] if args.no_probs else ['get_all_labels_probs']))
+  results = []
+  print("%8s %8s %8s %8s " % ('entrants', 'matches', 'replays', 'labels') +
+        ' '.join(['%20s' % s for s in stages]) + " %9s %9s" % ('labelled', 'accuracy') +
+        ('' if args.no_probs else ' %9s' % 'top prob'))
+  for entrants in args.entrants:
+    result = run(probs = not args.no_probs, mains = args.mains, jobs = args.jobs, top_k = args.top_k,
+                 estimate_skew = args.estimate_skew,
+                 entrants = entrants, setups = args.setups, best_of = args.best_of,
+                 skew = args.skew, noise = args.noise, seed = args.seed)
+    results.append(result)
+    print("%8s %8s %8s %8s " % (entrants, result['matches'], result['replays'], result['labels']) +
+          ' '.join(['%19.3fs' % result[s] for s in stages]) +
+          " %8.1f%% %8.1f%%" % (result['labelled']*100, result['accuracy']*100) +
+          ('' if args.no_probs else ' %8.1f%%' % (result['top_prob_accuracy']*100)))
+    sys.stdout.flush()
+
+  if len(results) > 1:
+    print("\nGrowth curves, time = a * entrants^b:")
+    for s in stages:
+      a, b = fit_growth(args.entrants, [max(r[s], 1e-6) for r in results])
+      print("  %-22s a = %.3g, b = %.2f" % (s, a, b))
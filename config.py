@@ -2,6 +2,15 @@
 CHALLONGE_USER = None
 CHALLONGE_API_KEY = None
 
+# the base url of the challonge API (e.g. to point -c at a local stub server),
+# and how it's fetched: the number of requests made at once, the timeout of each
+# request in seconds, and how many seconds a cached response is used for
+# before asking challonge whether it changed
+CHALLONGE_API_URL = 'https://api.challonge.com/v1/'
+CHALLONGE_FETCH_THREADS = 8
+CHALLONGE_TIMEOUT = 30
+CHALLONGE_CACHE_TTL = 15
+
 
 # the parameters for the gaussian distributions of how time differences (in
 # seconds) are distributed. ANNOUNCE_TO_START is for challonge start time to
@@ -44,13 +53,19 @@ MAIN_CHAR_PROB = 0.8
 # probability of someone choosing one of their secondaries
 SEC_CHAR_PROB = 0.1
 
+# if True, replays are parsed by only reading their game start event, metadata
+# and final post-frame updates, rather than decoding every frame with py-slippi.
+# Replays that can't be read this way still fall back to a full py-slippi parse
+SLP_FAST_PARSE = True
+
 # a dict supplying time offsets for each drive; each drive has the specified
 # number of seconds subtracted from each of its timestamps. Strings should
 # match the name of the folder for the drive's replay files
 # TODO: the usb drives sometimes float from wii to wii, messing up these
 # offsets. I think the .slp files have some kind of identifier for the wii, but
 # py-slippi doesn't pick it up; could maybe fix this by switching to the js
-# slippi parser
+# slippi parser. In the meantime, mmrl.py --estimate-skew estimates offsets
+# from the labels themselves, including ones that change during the day
 DRIVE_TIME_OFFSETS = {
   'Drive #1' : 60,
   'Drive #2' : 60,
@@ -69,15 +84,66 @@ DRIVE_TIME_OFFSETS = {
 # understandable by pytz.timezone()
 TIME_ZONE = 'America/Los_Angeles'
 
+# settings for estimating the clock offset of each setup (mmrl.py
+# --estimate-skew), on top of DRIVE_TIME_OFFSETS. The matches are labelled
+# with TIME_SLACK widened by SKEW_MAX, and each setup's offset is the one
+# (from a grid of SKEW_STEP seconds up to SKEW_MAX seconds either way) that
+# maximizes the summed time log-likelihood of its confident labels, i.e. the
+# labels of the MIP solution that score at least SKEW_MIN_MARGIN above their
+# match's next best option, as long as that raises the summed log-likelihood
+# by more than SKEW_MIN_GAIN over no offset. A setup's labels are split into
+# pieces of time with their own offsets if that raises it by more than
+# SKEW_MIN_GAIN as well, keeping at least SKEW_MIN_LABELS labels in each
+# piece; setups with fewer confident labels than that keep their offset. This
+# is repeated with the new offsets up to SKEW_ROUNDS times, until the offsets
+# stop changing
+SKEW_MAX = 900
+SKEW_STEP = 5
+SKEW_MIN_MARGIN = 0.5
+SKEW_MIN_LABELS = 5
+SKEW_MIN_GAIN = 2.0
+SKEW_ROUNDS = 3
+
 # objective value of leaving a match unlabelled. Acts as a threshold; labels
 # below this score will not be used, and matches that cannot score higher than
 # this will end up unlabelled
 NOLABEL_OBJVAL = -25.0
 
 
+# the solver used for each component of the labelling MIP: 'glpk' for a general
+# MIP solver, or 'lagrangian' for a Lagrangian relaxation specialised to this
+# problem (see mip.py). The Lagrangian solver stops once its solution is within
+# LAGRANGIAN_GAP of optimal, and falls back to glpk for a component (for good)
+# if that takes more than LAGRANGIAN_ITERS iterations. The Lagrangian solver is
+# experimental, and usually slower than glpk on large components
+MIP_SOLVER = 'glpk'
+LAGRANGIAN_ITERS = 60
+LAGRANGIAN_GAP = 1e-6
+
+# parameters for estimating label probabilities from the posterior over
+# assignments (the --probs sample option). Components of the conflict graph
+# with at most EXACT_ENUM_LIMIT feasible assignments are enumerated exactly;
+# larger ones are sampled with MCMC_CHAINS Gibbs sampler chains of
+# MCMC_SWEEPS sweeps each (after MCMC_BURNIN burn-in sweeps). A warning is
+# printed if the Gelman-Rubin R-hat of a sampled component exceeds
+# MCMC_MAX_RHAT
+EXACT_ENUM_LIMIT = 100000
+MCMC_CHAINS = 4
+MCMC_SWEEPS = 500
+MCMC_BURNIN = 100
+MCMC_MAX_RHAT = 1.1
+MCMC_SEED = 0
+
+# default number of seconds between passes in watch mode (mmrl.py --watch)
+WATCH_INTERVAL = 30
+
 # file locations, relative to the output_dir from the command line invocation
-CHALLONGE_FILE = 'challonge_data.p' # file containing bracket match data
-SLIPPI_FILE = 'slippi_data.p' # file containing parsed replay data
+CHALLONGE_FILE = 'challonge_data' # store (see store.py) containing bracket match data
+CHALLONGE_CACHE_FILE = 'challonge_cache.p' # cache of challonge API responses, for refetching with -c
+SLIPPI_FILE = 'slippi_data' # store containing parsed replay data
+SLIPPI_CACHE_FILE = 'slippi_cache.p' # cache of parsed replays, for reparsing with -s
+LABEL_CACHE_FILE = 'label_cache.p' # cache of label scores and solutions, for relabelling with -l
 FULL_OUTPUT_FILE = 'full_output.txt' # file containing all feasible label scores
 SINGLE_OUTPUT_FILE = 'single_output.txt' # file containing LP solution output
 PROB_OUTPUT_FILE = 'prob_output.txt' # file containing all feasible label probabilities
+PROFILE_OUTPUT_FILE = 'profile.json' # timing report written with --profile
@@ -1,5 +1,4 @@
 # code for fetching and parsing the data needed for replay labelling
-import challonge
 import slippi
 import pandas as pd
 import datetime
@@ -8,8 +7,20 @@ import calendar
 import pickle
 import os
 import re
+import struct
+import multiprocessing
+import json
+import time
+import base64
+import hashlib
+import io
+import urllib.request
+import urllib.error
+import concurrent.futures
 
 import config
+import store
+import profiling
 
 # special cases where the regex for a character isn't just their lower case name
 char_special_cases = {
@@ -23,7 +34,7 @@ char_special_cases = {
   'jigglypuff'                : '(jigg|puff)',
   'young_link'                : '(yo?ung|yl)',
   'link'                      : '(?<!young )link',
-  'mario'                     : '(?<!dr\. )mario', # TODO: make this more robust
+  'mario'                     : r'(?<!dr\. )mario', # TODO: make this more robust
   'ganondorf'                 : '(gann?on|dorf)',
 }
 
@@ -31,20 +42,29 @@ char_special_cases = {
 invalid_chars = ['master_hand', 'wireframe_male', 'wireframe_female',
                  'giga_bowser', 'crazy_hand', 'sandbag', 'popo']
 
+# a regex matching the names of the given characters (slippi.event.CSSCharacter
+# names), where the character whose name matched is the name of the group that
+# matched. It's a lookahead, so that finditer finds every position where some
+# character's name starts, even if it overlaps another's (no two characters'
+# regexes can match at the same position)
+def char_regex(names):
+  regexes = ['(?P<%s>%s)' % (name, char_special_cases.get(name.lower(), name.lower()))
+             for name in names if name.lower() not in invalid_chars]
+  return re.compile('(?=%s)' % '|'.join(regexes))
+
+# the regex of char_regex for all characters, compiled the first time it's
+# needed
+all_chars_regex = None
+
 # parse the melee characters from a string
 def get_chars(charstr):
+  global all_chars_regex
   if pd.isnull(charstr):
     return set()
 
-  charstr = charstr.lower()
-  chars = set()
-  for char in slippi.event.CSSCharacter:
-    name = char.name.lower()
-    regex = char_special_cases[name] if name in char_special_cases else name
-    if name not in invalid_chars and re.search(regex, charstr):
-      chars.add(char.name)
-
-  return chars
+  if all_chars_regex == None:
+    all_chars_regex = char_regex([char.name for char in slippi.event.CSSCharacter])
+  return {m.lastgroup for m in all_chars_regex.finditer(charstr.lower())}
 
 # given a tag, produce a fingerprint, so that two tags can be compared via
 # their fingerprints. Currently this just removes whitespace and lowercases the
@@ -54,39 +74,143 @@ def tag_fingerprint(tag):
 
 # parse a .csv containing player tags with their mains/secondaries, i.e. parse
 # a csv from go/smashers. Expects the 'TAG', 'Main', and 'Secondaries' columns
-# to exist, and parses character names from the latter 2 columns
-def parse_player_file(fname):
+# to exist, and parses character names from the latter 2 columns. If cache is
+# given, it's a dict that the parsed players are kept in, keyed by the
+# SHA-256 of the file, so that an unchanged file isn't parsed again
+def parse_player_file(fname, cache = None):
   if fname == None:
     print("No player file specified; not using any player info")
     return {}
 
-  df = pd.read_csv(fname)
+  with open(fname, 'rb') as fp:
+    contents = fp.read()
+  digest = hashlib.sha256(contents).hexdigest()
+  if cache != None and digest in cache:
+    print("Player file unchanged; %s tags found" % len(cache[digest]))
+    return cache[digest]
+
+  df = pd.read_csv(io.BytesIO(contents))
+  df = df[df['TAG'].notnull()]
+
+  # the same few strings (e.g. 'Fox') make up most of the Main and Secondaries
+  # columns, so each distinct one is only parsed once
+  chars = {}
+  for col in ['Main', 'Secondaries']:
+    for charstr in df[col].dropna().unique().tolist():
+      chars[charstr] = get_chars(charstr)
+
   dct = {}
-  for _, row in df.iterrows():
-    if pd.isnull(row['TAG']):
-      continue
-    tagfp = tag_fingerprint(row['TAG'])
+  for tag, mains, secs in zip(df['TAG'].tolist(), df['Main'].tolist(), df['Secondaries'].tolist()):
+    tagfp = tag_fingerprint(tag)
 
     if tagfp in dct:
       print("Duplicate tag: '%s'; taking later occurrence" % tagfp)
 
-    dct[tagfp] = get_chars(row['Main']), get_chars(row['Secondaries'])
+    dct[tagfp] = (set(chars[mains]) if not pd.isnull(mains) else set(),
+                  set(chars[secs]) if not pd.isnull(secs) else set())
   print("Parsed player file; %s tags found" % len(dct))
+
+  if cache != None:
+    cache.clear()
+    cache[digest] = dct
   return dct
 
-# read some tournament brackets from challonge, add some metadata, and output
-# them to a JSON file
-def fetch_brackets_to_file(challonge_ids, outfile):
+# parse a timestamp from the challonge API, e.g. 2019-01-19T16:57:17.000-08:00
+def parse_challonge_time(timestr):
+  return datetime.datetime.strptime(re.sub(r'\.\d+', '', timestr), '%Y-%m-%dT%H:%M:%S%z')
+
+# convert a record from the challonge API's JSON, e.g. {"match": {...}}, to a
+# dict with hyphenated keys (e.g. 'completed-at') and datetime timestamps
+def challonge_record(obj):
+  (fields,) = obj.values()
+  record = {}
+  for key, val in fields.items():
+    key = key.replace('_', '-')
+    if key.endswith('-at') and isinstance(val, str):
+      val = parse_challonge_time(val)
+    record[key] = val
+  return record
+
+# GET a path from the challonge API, returning the response body. If
+# http_cache (a dict mapping urls to their last response) has a response for
+# the url that is less than CHALLONGE_CACHE_TTL seconds old, it's used without
+# asking challonge; otherwise the request is made conditional on the cached
+# response's ETag/Last-Modified, so that an unchanged bracket costs a 304. The
+# cached response is also used if challonge can't be reached
+def challonge_get(path, http_cache):
+  url = config.CHALLONGE_API_URL + path
+  cached = http_cache.get(url)
+  if cached != None and time.time() - cached['fetched'] < config.CHALLONGE_CACHE_TTL:
+    return cached['body']
+
+  request = urllib.request.Request(url)
+  credentials = '%s:%s' % (config.CHALLONGE_USER, config.CHALLONGE_API_KEY)
+  request.add_header('Authorization', 'Basic ' + base64.b64encode(credentials.encode()).decode())
+  if cached != None and cached['etag'] != None:
+    request.add_header('If-None-Match', cached['etag'])
+  if cached != None and cached['last-modified'] != None:
+    request.add_header('If-Modified-Since', cached['last-modified'])
+
+  try:
+    with urllib.request.urlopen(request, timeout = config.CHALLONGE_TIMEOUT) as response:
+      body = response.read()
+      http_cache[url] = {'body' : body, 'fetched' : time.time(),
+                         'etag' : response.headers.get('ETag'),
+                         'last-modified' : response.headers.get('Last-Modified')}
+      return body
+  except urllib.error.HTTPError as e:
+    if cached == None or (e.code != 304 and e.code < 500):
+      raise
+    if e.code == 304:
+      cached['fetched'] = time.time()
+    else:
+      print("WARNING: challonge returned %s for %s; using the cached response" % (e.code, url))
+    return cached['body']
+  except OSError as e:
+    if cached == None:
+      raise
+    print("WARNING: could not reach challonge for %s (%s); using the cached response" % (url, e))
+    return cached['body']
+
+def load_http_cache(cache_file):
+  if cache_file == None or not os.path.exists(cache_file):
+    return {}
+
+  try:
+    with open(cache_file, 'rb') as fp:
+      return pickle.load(fp)
+  except Exception as e:
+    print("WARNING: could not read challonge cache %s (%s: %s); fetching everything" %
+      (cache_file, type(e), e))
+    return {}
+
+# read some tournament brackets from challonge, add some metadata, and write
+# them to the store directory outfile (see store.py). The matches and
+# participants of every bracket are fetched concurrently. If cache_file is
+# given, responses are cached in it (see challonge_get). If since is given,
+# only the matches updated after that time are taken from challonge, and
+# merged into the matches already in outfile; since may be a datetime, or
+# 'last' for the last update of a match in outfile. Matches without an update
+# time are never taken as updated
+def fetch_brackets_to_file(challonge_ids, outfile, since = None, cache_file = None):
   if config.CHALLONGE_USER == None or config.CHALLONGE_API_KEY == None:
     raise Exception("Put your challonge username and api key in config.py")
 
+  http_cache = load_http_cache(cache_file)
+  paths = ['tournaments/%s/%s.json' % (cid, endpoint)
+           for cid in challonge_ids for endpoint in ['matches', 'participants']]
+  with concurrent.futures.ThreadPoolExecutor(config.CHALLONGE_FETCH_THREADS) as pool:
+    bodies = list(pool.map(lambda path: challonge_get(path, http_cache), paths))
+
+  if cache_file != None:
+    with open(cache_file, 'wb') as fp:
+      pickle.dump(http_cache, fp)
+
   all_matches = []
   all_participants = []
-  challonge.set_credentials(config.CHALLONGE_USER, config.CHALLONGE_API_KEY)
-  for cid in challonge_ids:
-    tournament = challonge.tournaments.show(cid)
-    matches = challonge.matches.index(cid)
-    participants = challonge.participants.index(cid)
+  for ci, cid in enumerate(challonge_ids):
+    matches = [challonge_record(obj) for obj in json.loads(bodies[2*ci])]
+    participants = [challonge_record(obj) for obj in json.loads(bodies[2*ci+1])]
 
     # add some metadata to each challonge match
     for match in matches:
@@ -106,45 +230,203 @@ def fetch_brackets_to_file(challonge_ids, outfile):
       match['player2_score'] = scores[1]
       match['num_games'] = scores[0] + scores[1]
 
-    all_matches.extend([m for m in matches if m['num_games'] > 0])
+    if since != None:
+      all_matches.extend(matches)
+    else:
+      all_matches.extend([m for m in matches if m['num_games'] > 0])
     all_participants.extend([p for p in participants if p not in all_participants])
 
-  all_data = {'matches' : all_matches, 'participants' : all_participants}
+  if since != None and os.path.exists(store.find_store(outfile)):
+    old_matches = store.challonge_dicts(store.load_challonge(store.find_store(outfile)))['matches']
+    if since == 'last':
+      since = max([m['updated-at'] for m in old_matches if m['updated-at'] != None], default=None)
+
+    # matches updated since then replace their old versions (or are dropped,
+    # e.g. if they were reopened), and the rest are kept as they were
+    if since != None:
+      updated = [m for m in all_matches if m.get('updated-at') != None and m['updated-at'] > since]
+      updated_ids = {m['id'] for m in updated}
+      all_matches = [m for m in old_matches if m['id'] not in updated_ids] + \
+                    [m for m in updated if m['num_games'] > 0]
+      print("Merged %s matches updated since %s into %s" % (len(updated), since, outfile))
+  all_matches = [m for m in all_matches if m['num_games'] > 0]
 
-  with open(outfile, 'wb') as fp:
-    #json.dump(all_data, fp, indent=2, sort_keys=True, default=str)
-    pickle.dump(all_data, fp)
+  all_data = {'matches' : all_matches, 'participants' : all_participants}
+  store.write_challonge(all_data, outfile)
 
   print("Finished fetching challonge data; %s matches and %s participants written to %s" %
     (len(all_matches), len(all_participants), outfile))
 
-# read a .slp replay file, extract necessary info into a dict
+# index of the first frame of a slippi replay, and the format of the startAt
+# date in its metadata (the offset may be negative, unlike in py-slippi's)
+FIRST_FRAME_INDEX = -123
+slp_date_regex = r'(\d{4})-(\d{2})-(\d{2})T(\d{2}):(\d{2}):(\d{2})(?:\.(\d+))?(?:Z|([+-])(\d{2})(\d{2}))?$'
+
+# read a single UBJSON value from buf starting at pos, returning the value and
+# the position just after it. Only supports what slippi writes in its
+# metadata block
+ubjson_ints = {b'i' : '>b', b'U' : '>B', b'I' : '>h', b'l' : '>i', b'L' : '>q',
+               b'd' : '>f', b'D' : '>d'}
+def read_ubjson(buf, pos, marker = None):
+  if marker == None:
+    marker = buf[pos:pos+1]
+    pos += 1
+
+  if marker in ubjson_ints:
+    fmt = ubjson_ints[marker]
+    return struct.unpack_from(fmt, buf, pos)[0], pos + struct.calcsize(fmt)
+  elif marker == b'T':
+    return True, pos
+  elif marker == b'F':
+    return False, pos
+  elif marker == b'Z':
+    return None, pos
+  elif marker == b'C':
+    return buf[pos:pos+1].decode('utf-8'), pos+1
+  elif marker in (b'S', b'H'):
+    length, pos = read_ubjson(buf, pos)
+    return buf[pos:pos+length].decode('utf-8'), pos+length
+  elif marker in (b'{', b'['):
+    is_obj = marker == b'{'
+    end = b'}' if is_obj else b']'
+
+    # optimized containers have a fixed type and/or a count
+    vtype, count = None, None
+    if buf[pos:pos+1] == b'$':
+      vtype = buf[pos+1:pos+2]
+      pos += 2
+    if buf[pos:pos+1] == b'#':
+      count, pos = read_ubjson(buf, pos+1)
+
+    items = {} if is_obj else []
+    while (count > 0) if count != None else (buf[pos:pos+1] != end):
+      if is_obj:
+        key, pos = read_ubjson(buf, pos, b'S')
+      val, pos = read_ubjson(buf, pos, vtype)
+      if is_obj:
+        items[key] = val
+      else:
+        items.append(val)
+      if count != None:
+        count -= 1
+    if count == None:
+      pos += 1
+
+    return items, pos
+  raise ValueError("unsupported UBJSON marker %r at %s" % (marker, pos))
+
+# read the parts of a .slp replay file that parse_slp_file needs, without
+# decoding every frame like slippi.Game does. The raw event stream is scanned
+# using the payload sizes from its Event Payloads event, and only the Game
+# Start event, the last leader Post-Frame Update of each port, and the
+# metadata block are decoded. Returns a tuple (date, duration, stage, ports),
+# where ports has, for each port, None if the port isn't in the last frame,
+# otherwise the pair (character name, stocks remaining) from the last frame
+def read_slp_summary(slp_file):
+  with open(slp_file, 'rb') as fp:
+    buf = fp.read()
+
+  if not buf.startswith(b'{U\x03raw[$U#l'):
+    raise ValueError("not a slippi replay file")
+  raw_len = struct.unpack_from('>I', buf, 11)[0]
+  raw_start = 15
+  raw_end = raw_start + raw_len
+
+  # the first event gives the payload size of each event type
+  if buf[raw_start] != 0x35:
+    raise ValueError("missing Event Payloads event")
+  sizes = [None] * 256
+  sizes[0x35] = buf[raw_start+1]
+  for i in range(raw_start+2, raw_start+1+sizes[0x35], 3):
+    sizes[buf[i]] = struct.unpack_from('>H', buf, i+1)[0]
+
+  stage = None
+  last_post = [None] * 4 # (frame, internal character id, stocks) per port
+  last_frame = None
+  pos = raw_start
+  while pos < raw_end:
+    cmd = buf[pos]
+    if cmd == 0x38: # Post-Frame Update
+      frame, port, follower, char = struct.unpack_from('>iB?B', buf, pos+1)
+      if not follower and port < 4:
+        last_post[port] = (frame, char, buf[pos+0x21])
+        if last_frame == None or frame > last_frame:
+          last_frame = frame
+    elif cmd == 0x36: # Game Start
+      stage = struct.unpack_from('>H', buf, pos+0x13)[0]
+    elif cmd == 0x39: # Game End
+      break
+    pos += sizes[cmd] + 1
+
+  if stage == None or last_frame == None:
+    raise ValueError("missing Game Start or Post-Frame Update events")
+
+  metadata = {}
+  if buf[raw_end:raw_end+10] == b'U\x08metadata':
+    metadata, _ = read_ubjson(buf, raw_end+10)
+
+  # parse the date the same way py-slippi does, since the timezone and
+  # fractional seconds aren't always present
+  m = re.search(slp_date_regex, metadata['startAt'].rstrip('\x00')).groups()
+  offset = datetime.timedelta(hours=int(m[8] or '0'), minutes=int(m[9] or '0'))
+  date = datetime.datetime(*[int(g or '0') for g in m[:7]],
+                           datetime.timezone(-offset if m[7] == '-' else offset))
+  duration = 1 + metadata.get('lastFrame', last_frame) - FIRST_FRAME_INDEX
+
+  ports = [None if post == None or post[0] != last_frame
+           else (slippi.id.InGameCharacter(post[1]).name, post[2])
+           for post in last_post]
+
+  return date, duration, slippi.id.Stage(stage).name, ports
+
+# read a .slp replay file, extract necessary info into a dict. If
+# config.SLP_FAST_PARSE is set, the file is first read with read_slp_summary,
+# falling back to a full slippi.Game parse if that fails
 # TODO: for some reason, py-slippi  throws exceptions for a lot of our replays;
 # maybe we should use the JS parser instead?
 def parse_slp_file(slp_file, drive):
-  try:
-    game = slippi.Game(slp_file)
-  except Exception as e:
-    print("WARNING: slippi parsing exception while reading %s:" % slp_file)
-    print("%s: %s" % (type(e), e))
-    print("Skipping this replay")
-    return None
-
-  #start_date = pytz.timezone(config.TIME_ZONE).localize(game.metadata.date)
-  start_time = game.metadata.date.replace(tzinfo = pytz.timezone(config.TIME_ZONE))
-  end_time = start_time + datetime.timedelta(seconds = game.metadata.duration / 60.)
-  stage = game.start.stage
+  summary = None
+  if config.SLP_FAST_PARSE:
+    try:
+      summary = read_slp_summary(slp_file)
+    except Exception:
+      summary = None
+
+  if summary == None:
+    try:
+      game = slippi.Game(slp_file)
+    except Exception as e:
+      print("WARNING: slippi parsing exception while reading %s:" % slp_file)
+      print("%s: %s" % (type(e), e))
+      print("Skipping this replay")
+      return None
+
+    summary = (game.metadata.date, game.metadata.duration, game.start.stage.name,
+               [None if port == None else
+                (port.leader.post.character.name, port.leader.post.stocks)
+                for port in game.frames[-1].ports])
+
+  date, duration, stage, last_ports = summary
+
+  # the replay's timestamp is the Wii's wall-clock time in TIME_ZONE, whatever
+  # offset it claims to have. It's localized (tagging it with
+  # replace(tzinfo=...) would give it the zone's LMT offset) and normalized to
+  # UTC here, once, less the offset of the drive's folder, if any
+  tz = pytz.timezone(config.TIME_ZONE)
+  time_offset = datetime.timedelta(seconds = config.DRIVE_TIME_OFFSETS.get(os.path.basename(drive), 0))
+  start_time = tz.localize(date.replace(tzinfo = None)).astimezone(pytz.utc) - time_offset
+  end_time = start_time + datetime.timedelta(seconds = duration / 60.)
 
   ports = []
   numplayers = 0
-  for i, port in enumerate(game.frames[-1].ports):
+  for port in last_ports:
     if port == None:
       ports.append(None)
       continue
 
     # TODO: more robust win/lose logic, e.g. handle timeouts and LRAstart
-    isdead = port.leader.post.stocks == 0
-    charname = port.leader.post.character.name
+    charname, stocks = port
+    isdead = stocks == 0
 
     # address a weird edge case with ICs where popo dies last
     if charname == 'POPO':
@@ -154,36 +436,29 @@ def parse_slp_file(slp_file, drive):
                   'dead_at_end' : isdead})
     numplayers += 1
 
-  time_offset = datetime.timedelta(0)
-  if drive in config.DRIVE_TIME_OFFSETS:
-    time_offset = datetime.timedelta(seconds = config.DRIVE_TIME_OFFSETS[drive])
-
   dct = {
-    'start_time' : start_time - time_offset,
-    'end_time'   : end_time - time_offset,
+    'start_time' : start_time,
+    'end_time'   : end_time,
     'filename'   : slp_file,
     'drive'      : drive,
     'ports'      : ports,
-    'stage'      : stage.name,
+    'stage'      : stage,
     'numplayers' : numplayers,
   }
 
   return dct
 
-# given a directory and a subdirectory of it, all the replays in the
-# subdirectory and order them by start time
-# TODO: it takes quite a while to parse slippi replays; might be better if we
-# can parallelize this
-def parse_slp_drive(all_drives_dir, setup_dir):
+# list the .slp files of a drive directory, as (slp_file, drive) pairs suitable
+# for passing to parse_slp_file
+def list_slp_drive(all_drives_dir, setup_dir):
   drive_dir = os.path.join(all_drives_dir, setup_dir)
-  print("Parsing replays from directory: %s" % drive_dir)
-  replays = []
-
-  for fname in os.listdir(drive_dir):
-    slp_file = os.path.join(drive_dir, fname)
-    replay = parse_slp_file(slp_file, drive_dir)
-    if replay != None:
-      replays.append(replay)
+  return [(os.path.join(drive_dir, fname), drive_dir)
+          for fname in os.listdir(drive_dir)]
+
+# given the name of a drive directory and the parsed replays from it (with None
+# for replays that failed to parse), order them by start time and make a setup
+def make_setup(setup_dir, replays):
+  replays = [r for r in replays if r != None]
   replays.sort(key = lambda r: r['start_time'])
 
   setup = {
@@ -193,15 +468,88 @@ def parse_slp_drive(all_drives_dir, setup_dir):
 
   return setup
 
+# parse a list of (slp_file, drive) pairs, returning the parsed replays (or
+# None for replays that failed to parse) in the same order. If jobs > 1, the
+# files are handed out to a pool of that many processes
+def parse_slp_files(slp_files, jobs = 1):
+  if jobs <= 1 or len(slp_files) <= 1:
+    return [parse_slp_file(slp_file, drive) for slp_file, drive in slp_files]
+
+  chunksize = max(1, len(slp_files) // (4*jobs))
+  with multiprocessing.Pool(jobs) as pool:
+    return pool.starmap(parse_slp_file, slp_files, chunksize)
+
+# the settings that the parsed replays in a replay cache depend on, beyond the
+# files themselves; a cache saved with different settings is discarded.
+# PARSE_CACHE_VERSION is bumped whenever the format of the cache or of the
+# parsed replays changes
+PARSE_CACHE_VERSION = 2
+def parse_cache_settings():
+  return (PARSE_CACHE_VERSION, config.TIME_ZONE, config.SLP_FAST_PARSE,
+          tuple(sorted(config.DRIVE_TIME_OFFSETS.items())))
+
+# load the replay cache, a dict mapping the path of each cached replay to its
+# size, mtime and parsed replay
+def load_parse_cache(cache_file):
+  if cache_file == None or not os.path.exists(cache_file):
+    return {}
+
+  try:
+    with open(cache_file, 'rb') as fp:
+      cache = pickle.load(fp)
+  except Exception as e:
+    print("WARNING: could not read replay cache %s (%s: %s); reparsing everything" %
+      (cache_file, type(e), e))
+    return {}
+
+  if not isinstance(cache, dict) or cache.get('settings') != parse_cache_settings():
+    print("Replay cache %s was made with different settings; reparsing everything" % cache_file)
+    return {}
+  return cache['replays']
+
 # given a directory containing all the drive replay directories, parse each of
-# the directories, and write the list of setups to setup_file
-def parse_all_slp_drives(all_drives_dir, setup_file):
-  setups = [parse_slp_drive(all_drives_dir, setup_dir)
-            for setup_dir in os.listdir(all_drives_dir)]
-
-  with open(setup_file, 'wb') as fp:
-    #json.dump(setups, fp, indent=2, sort_keys=True, default=str)
-    pickle.dump(setups, fp)
+# the directories, and write the setups to the store directory setup_file (see
+# store.py). If jobs > 1, the replays are parsed in parallel by that many
+# processes. If cache_file is given, replays whose path, size and mtime match
+# an entry in it are not parsed again, and the cache is updated with the newly
+# parsed replays
+def parse_all_slp_drives(all_drives_dir, setup_file, jobs = 1, cache_file = None):
+  setup_dirs = os.listdir(all_drives_dir)
+  drive_files = []
+  for setup_dir in setup_dirs:
+    print("Parsing replays from directory: %s" % os.path.join(all_drives_dir, setup_dir))
+    drive_files.append(list_slp_drive(all_drives_dir, setup_dir))
+
+  cache = load_parse_cache(cache_file)
+  new_cache = {}
+  todo = []
+  for slp_file, drive in [f for files in drive_files for f in files]:
+    st = os.stat(slp_file)
+    entry = cache.get(slp_file)
+    if entry != None and entry[:2] == (st.st_size, st.st_mtime_ns):
+      new_cache[slp_file] = entry
+    else:
+      new_cache[slp_file] = (st.st_size, st.st_mtime_ns, None)
+      todo.append((slp_file, drive))
+
+  if cache_file != None:
+    print("%s replays cached, parsing %s new or changed replays" %
+      (len(new_cache) - len(todo), len(todo)))
+
+  with profiling.stage('parse_slp_files', jobs=jobs):
+    profiling.count('files', len(todo))
+    parsed = parse_slp_files(todo, jobs)
+  for (slp_file, _), replay in zip(todo, parsed):
+    new_cache[slp_file] = new_cache[slp_file][:2] + (replay,)
+
+  setups = [make_setup(setup_dir, [new_cache[slp_file][2] for slp_file, _ in files])
+            for setup_dir, files in zip(setup_dirs, drive_files)]
+
+  store.write_setups(setups, setup_file)
+
+  if cache_file != None:
+    with open(cache_file, 'wb') as fp:
+      pickle.dump({'settings' : parse_cache_settings(), 'replays' : new_cache}, fp)
 
   print("Finished parsing slippi data; %s setups with %s total replays written to %s" %
     (len(setups), sum([len(s['replays']) for s in setups]), setup_file))
@@ -0,0 +1,197 @@
+# estimates of the posterior probability of each label. Every feasible
+# assignment of labels to matches (see the README) is given probability
+# proportional to its likelihood, i.e. exp of its objective value in the MIP,
+# and the probability of a label is the total probability of the assignments
+# that use it. This is computed exactly for small components of the conflict
+# graph by enumerating their assignments, and estimated by Gibbs sampling for
+# the rest
+import math
+import random
+
+import config
+from mip import label_components
+
+# enumerate every feasible assignment of a component, given its matches'
+# options (see component_marginals). Returns a list with, for each match, the
+# total weight of the assignments using each of its options, or None if the
+# component has more than config.EXACT_ENUM_LIMIT assignments
+def enumerate_marginals(options, covers):
+  # weights are taken relative to the best objective value seen so far (and
+  # rescaled whenever it improves), so that they never overflow, and the best
+  # assignment always has weight 1 rather than underflowing
+  weights = [[0.0 for _ in opts] for opts in options]
+  choice = [None for _ in options]
+  occupied = set()
+  count = [0]
+  top = [-math.inf]
+
+  def visit(k, total):
+    if k == len(options):
+      count[0] += 1
+      if count[0] > config.EXACT_ENUM_LIMIT:
+        return False
+      if total > top[0]:
+        scale = math.exp(top[0] - total)
+        for ws in weights:
+          for j in range(len(ws)):
+            ws[j] *= scale
+        top[0] = total
+      w = math.exp(total - top[0])
+      for m, j in enumerate(choice):
+        weights[m][j] += w
+      return True
+
+    for j, (ll, _, _) in enumerate(options[k]):
+      if any([r in occupied for r in covers[k][j]]):
+        continue
+      choice[k] = j
+      occupied.update(covers[k][j])
+      ok = visit(k+1, total + ll)
+      occupied.difference_update(covers[k][j])
+      if not ok:
+        return False
+    return True
+
+  if not visit(0, 0.0):
+    return None
+  return weights
+
+# estimate the marginals of a component with config.MCMC_CHAINS chains of a
+# Gibbs sampler. Each step resamples either a single match's option, or the
+# options of a pair of conflicting matches jointly (so that two matches can
+# swap replays without passing through an unlikely intermediate state), from
+# their conditional distribution given every other match. Returns the visit
+# counts of each match's options summed over all chains, and the largest
+# Gelman-Rubin R-hat of the option indicators as a convergence diagnostic
+def sample_marginals(options, covers, rng):
+  nmatches = len(options)
+
+  # neighbours[m] is the list of matches that have an option conflicting with
+  # one of m's options
+  owners = {}
+  for m in range(nmatches):
+    for cov in covers[m]:
+      for r in cov:
+        owners.setdefault(r, set()).add(m)
+  neighbours = [sorted({n for cov in covers[m] for r in cov for n in owners[r]} - {m})
+                for m in range(nmatches)]
+
+  def free_options(m, occupied):
+    return [j for j in range(len(options[m]))
+            if not any([r in occupied for r in covers[m][j]])]
+
+  def pick(weighted):
+    top = max([ll for ll, _ in weighted])
+    ws = [math.exp(ll - top) for ll, _ in weighted]
+    x = rng.random() * sum(ws)
+    for w, (_, item) in zip(ws, weighted):
+      x -= w
+      if x <= 0:
+        return item
+    return weighted[-1][1]
+
+  chain_counts = []
+  for chain in range(config.MCMC_CHAINS):
+    # start each chain with every match unlabelled (the last option)
+    state = [len(opts)-1 for opts in options]
+    occupied = {}
+    counts = [[0 for _ in opts] for opts in options]
+
+    for sweep in range(config.MCMC_BURNIN + config.MCMC_SWEEPS):
+      for _ in range(nmatches):
+        m = rng.randrange(nmatches)
+        if len(neighbours[m]) > 0 and rng.random() < 0.5:
+          n = rng.choice(neighbours[m])
+          for k in (m, n):
+            for r in covers[k][state[k]]:
+              del occupied[r]
+          pairs = [(options[m][jm][0] + options[n][jn][0], (jm, jn))
+                   for jm in free_options(m, occupied)
+                   for jn in free_options(n, occupied)
+                   if covers[m][jm].isdisjoint(covers[n][jn])]
+          state[m], state[n] = pick(pairs)
+          for k in (m, n):
+            for r in covers[k][state[k]]:
+              occupied[r] = k
+        else:
+          for r in covers[m][state[m]]:
+            del occupied[r]
+          state[m] = pick([(options[m][j][0], j) for j in free_options(m, occupied)])
+          for r in covers[m][state[m]]:
+            occupied[r] = m
+
+      if sweep >= config.MCMC_BURNIN:
+        for m, j in enumerate(state):
+          counts[m][j] += 1
+    chain_counts.append(counts)
+
+  # R-hat of each option's indicator, treating each chain's samples as
+  # independent Bernoulli draws
+  n = config.MCMC_SWEEPS
+  max_rhat = 1.0
+  for m in range(nmatches):
+    for j in range(len(options[m])):
+      ps = [counts[m][j] / n for counts in chain_counts]
+      mean = sum(ps) / len(ps)
+      within = sum([p*(1-p) * n / max(1, n-1) for p in ps]) / len(ps)
+      between = n * sum([(p - mean)**2 for p in ps]) / max(1, len(ps)-1)
+      if within > 0:
+        rhat = math.sqrt(((n-1)/n * within + between/n) / within)
+      elif between > 0:
+        rhat = float('inf')
+      else:
+        continue
+      max_rhat = max(max_rhat, rhat)
+
+  total = [[sum([counts[m][j] for counts in chain_counts]) for j in range(len(options[m]))]
+           for m in range(nmatches)]
+  return total, max_rhat
+
+# compute the marginals of a component, given the number of games and labels of
+# each of its matches. Returns a list with, for each match, a list of [prob,
+# si, ri] for each of its labels and [prob, None, None] for leaving it
+# unlabelled, and the R-hat of the sampler (or None if the marginals are exact)
+def component_marginals(num_games, labels, rng):
+  # options[m] is the list of labels of m, followed by the no label option,
+  # and covers[m][j] is the set of replays covered by option j of m
+  options = [list(lbls) + [(config.NOLABEL_OBJVAL, None, None)] for lbls in labels]
+  covers = [[frozenset() if si == None else frozenset([(si, ri+k) for k in range(ng)])
+             for _, si, ri in opts]
+            for ng, opts in zip(num_games, options)]
+
+  rhat = None
+  weights = enumerate_marginals(options, covers)
+  if weights == None:
+    weights, rhat = sample_marginals(options, covers, rng)
+
+  probs = []
+  for opts, ws in zip(options, weights):
+    total = sum(ws)
+    probs.append([[w / total, si, ri] for w, (_, si, ri) in zip(ws, opts)])
+  return probs, rhat
+
+# estimate the probability of each label of each match, in the same format as
+# ReplayLabeller.get_all_labels_probs. Omit results with probability less than
+# threshold
+def label_marginals(num_games, all_labels, threshold=0.0):
+  rng = random.Random(config.MCMC_SEED)
+  soln = [None for _ in num_games]
+  rhats = []
+  ncomponents = 0
+  for comp in label_components(num_games, all_labels):
+    probs, rhat = component_marginals([num_games[mi] for mi in comp],
+                                      [all_labels[mi] for mi in comp], rng)
+    if rhat != None:
+      rhats.append(rhat)
+      print("Sampled component of %s matches; R-hat=%.3f" % (len(comp), rhat))
+    for mi, lbls in zip(comp, probs):
+      lbls.sort(key = lambda lbl: lbl[0], reverse=True)
+      soln[mi] = [lbl for lbl in lbls if lbl[0] >= threshold]
+    ncomponents += 1
+
+  print("Computed label marginals: %s components enumerated exactly, %s sampled" %
+    (ncomponents - len(rhats), len(rhats)))
+  if len(rhats) > 0 and max(rhats) > config.MCMC_MAX_RHAT:
+    print("WARNING: sampler may not have converged (max R-hat %.3f > %.3f); consider increasing MCMC_SWEEPS" %
+      (max(rhats), config.MCMC_MAX_RHAT))
+  return soln
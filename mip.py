@@ -0,0 +1,641 @@
+# the MIP model of the replay labelling problem; see the README for a
+# description of the formulation
+import numpy as np
+from swiglpk import *
+
+import config
+
+INF = float('inf')
+
+# the objective value of a solution, i.e. a list with the label (ll, si, ri) of
+# each match or None for unlabelled matches
+def objective(soln):
+  return sum([config.NOLABEL_OBJVAL if lbl == None else lbl[0] for lbl in soln])
+
+# the number of variables, constraints and nonzero entries of the constraint
+# matrix of the LabelMIP for the given number of games of each match and
+# output from ReplayLabeller.compute_all_labels
+def mip_size(num_games, all_labels):
+  replays = {(si, ri) for lbls in all_labels for _, si, ri in lbls}
+  N = sum([len(lbls) for lbls in all_labels]) + len(num_games)
+  M = len(num_games) + len(replays)
+  nze = sum([(ng+1)*len(lbls)+1 for ng,lbls in zip(num_games, all_labels)])
+  return N, M, nze
+
+class LabelMIP:
+  # construct a glpk MIP instance for the labelling problem given the number
+  # of games of each match, and output from ReplayLabeller.compute_all_labels.
+  # The instance is built once, and can then be solved repeatedly with
+  # different forced labels by solve()
+  def __init__(self, num_games, all_labels):
+    self.num_games = num_games
+    self.all_labels = all_labels
+
+    replays = list({(si, ri) for lbls in all_labels for _, si, ri in lbls})
+
+    # number of variables, constraints and nonzero entries in constraint matrix
+    N, M, nze = mip_size(num_games, all_labels)
+
+    ia = intArray(1+nze) # primal constraint indices
+    ja = intArray(1+nze) # primal variable indices
+    ar = doubleArray(1+nze) # nonzero values of constraint matrix
+
+    # update the state of ia, ja, ar to add the entry A[i,j] = val to the
+    # constraint matrix A
+    def add_cm_entry(i, j, val, a_idx):
+      ia[a_idx] = i
+      ja[a_idx] = j
+      ar[a_idx] = val
+
+    mip = glp_create_prob()
+    glp_set_prob_name(mip, "replay_label_MIP")
+    glp_set_obj_dir(mip, GLP_MAX)
+
+    # initialize primal variables
+    glp_add_cols(mip, N)
+    lvars = {} # dict mapping a triple mi, si, ri to its glpk variable index
+    var_idx = 1
+    for mi, lbls in enumerate(all_labels):
+      for ll, si, ri in lbls:
+        lvars[mi, si, ri] = var_idx
+        glp_set_col_name(mip, var_idx, "M%s_s%sr%s" % (mi, si, ri))
+        glp_set_col_bnds(mip, var_idx, GLP_DB, 0.0, 1.0)
+        glp_set_obj_coef(mip, var_idx, ll)
+        glp_set_col_kind(mip, var_idx, GLP_IV)
+        var_idx += 1
+    for mi in range(len(num_games)):
+      glp_set_col_name(mip, var_idx, "M%s_unlabelled" % mi)
+      glp_set_col_bnds(mip, var_idx, GLP_DB, 0.0, 1.0)
+      glp_set_obj_coef(mip, var_idx, config.NOLABEL_OBJVAL)
+      var_idx += 1
+
+    # initialize primal constraints; rows 1..len(num_games) are the match
+    # constraints, and the rest are the replay constraints, in the order of
+    # replays
+    glp_add_rows(mip, M)
+    # match constraints: each match has total probability 1 for its labels
+    for mi in range(len(num_games)):
+      row_idx = mi+1
+      glp_set_row_name(mip, row_idx, "M%s=1" % mi)
+      glp_set_row_bnds(mip, row_idx, GLP_FX, 1.0, 1.0)
+    # replay constraints: each replay has total probability at most 1 for its
+    # labels
+    replay_rows = {} # dict mapping a pair si, ri to its constraint index
+    for row_idx, (si, ri) in enumerate(replays, len(num_games)+1):
+      replay_rows[si, ri] = row_idx
+      glp_set_row_name(mip, row_idx, "s%sr%s<=1" % (si,ri))
+      glp_set_row_bnds(mip, row_idx, GLP_UP, 1.0, 1.0)
+
+    # populate the constraint matrix in a single pass over the variables; each
+    # label variable appears in its match's row and in the row of every replay
+    # it covers (replays that don't start any label can't be covered by two
+    # different labels, so they have no row)
+    a_idx = 1
+    for (mi, si, ri), j in lvars.items():
+      add_cm_entry(mi+1, j, 1.0, a_idx)
+      a_idx += 1
+      for k in range(num_games[mi]):
+        if (si, ri+k) in replay_rows:
+          add_cm_entry(replay_rows[si, ri+k], j, 1.0, a_idx)
+          a_idx += 1
+    for mi in range(len(num_games)):
+      add_cm_entry(mi+1, len(lvars)+mi+1, 1.0, a_idx)
+      a_idx += 1
+
+    glp_load_matrix(mip, a_idx-1, ia, ja, ar)
+
+    self.mip = mip
+    self.lvars = lvars
+    self.replay_rows = replay_rows
+    self.llmap = {(mi, si, ri) : ll
+                  for mi in range(len(num_games))
+                  for ll, si, ri in all_labels[mi]}
+
+  def __del__(self):
+    if getattr(self, 'mip', None) != None:
+      glp_delete_prob(self.mip)
+      self.mip = None
+
+  # the glpk variable index of a forced label, i.e. a triple (mi, si, ri) or a
+  # pair (mi, None)
+  def var_index(self, label):
+    if label[1] == None:
+      return len(self.lvars) + label[0] + 1
+    return self.lvars[label]
+
+  # solve the LP relaxation with the dual simplex, starting from the basis
+  # left by the previous solve
+  def solve_lp(self):
+    smcp = glp_smcp()
+    glp_init_smcp(smcp)
+    smcp.meth = GLP_DUALP
+    if glp_simplex(self.mip, smcp) != 0:
+      # the stored basis is unusable; start over from a fresh one
+      glp_adv_basis(self.mip, 0)
+      glp_simplex(self.mip, smcp)
+
+  # the optimal dual values of the LP relaxation: a list with the dual value
+  # of each match constraint, and a dict mapping each pair si, ri with a
+  # replay constraint to its dual value. Replay duals are never negative, up
+  # to rounding, which is clipped off so they're always a valid bound. The
+  # LP is solved without the upper bounds of 1 on the variables, which the
+  # match constraints imply anyway: otherwise a variable at its upper bound
+  # can have a positive reduced cost, whose dual value isn't counted in the
+  # row duals, and their sum would be less than the LP optimum
+  def lp_duals(self):
+    N = glp_get_num_cols(self.mip)
+    for j in range(1, N+1):
+      glp_set_col_bnds(self.mip, j, GLP_LO, 0.0, 0.0)
+    self.solve_lp()
+    match_duals = [glp_get_row_dual(self.mip, mi+1) for mi in range(len(self.num_games))]
+    replay_duals = {r : max(0.0, glp_get_row_dual(self.mip, row_idx))
+                    for r, row_idx in self.replay_rows.items()}
+    for j in range(1, N+1):
+      glp_set_col_bnds(self.mip, j, GLP_DB, 0.0, 1.0)
+    return match_duals, replay_duals
+
+  # solve the MIP, where forced_labels is a set containing triples (mi, si, ri)
+  # indicating that mi must be labelled with (si, ri), and/or pairs (mi, None)
+  # indicating mi must be left unlabelled. The forced variables are fixed to 1
+  # for this solve only. The LP relaxation is re-solved with the dual simplex
+  # starting from the basis left by the previous solve, and the integer search
+  # then starts from that basis rather than presolving from scratch. incumbent
+  # is an optional feasible solution (e.g. from a previous run) in the format
+  # of the return value; glpk has no way to start its search from it through
+  # swiglpk, but if it already attains the LP bound it is returned without
+  # running the integer search at all. Returns the objective value and a list
+  # with the label (ll, si, ri) of each match, or None for unlabelled matches
+  def solve(self, forced_labels = set(), incumbent = None):
+    forced_vars = [self.var_index(lbl) for lbl in forced_labels]
+    for j in forced_vars:
+      glp_set_col_bnds(self.mip, j, GLP_FX, 1.0, 1.0)
+
+    self.solve_lp()
+
+    if incumbent != None and objective(incumbent) >= glp_get_obj_val(self.mip) - 1e-9:
+      for j in forced_vars:
+        glp_set_col_bnds(self.mip, j, GLP_DB, 0.0, 1.0)
+      return objective(incumbent), list(incumbent)
+
+    parm = glp_iocp()
+    glp_init_iocp(parm)
+    parm.presolve = GLP_OFF
+    glp_intopt(self.mip, parm)
+
+    # extract the solution from the mip
+    soln = [None for _ in self.num_games]
+    for (mi, si, ri), j in self.lvars.items():
+      val = glp_mip_col_val(self.mip, j)
+      assert val in [0,1]
+      if val == 1:
+        soln[mi] = self.llmap[mi,si,ri], si, ri
+
+    # recompute the objective value from the solution rather than using
+    # glp_mip_obj_val, so that it doesn't depend on the path glpk took to it
+    objval = objective(soln)
+
+    for j in forced_vars:
+      glp_set_col_bnds(self.mip, j, GLP_DB, 0.0, 1.0)
+
+    return objval, soln
+
+# a solver for the labelling problem that exploits its structure instead of
+# using a general MIP solver. Relaxing the match constraints (each match gets
+# exactly one label or none) with Lagrange multipliers mu leaves, for each
+# setup, a weighted interval scheduling problem over its replays, where label
+# (ll, si, ri) of match mi is the interval ri..ri+num_games[mi]-1 with weight
+# ll - mu[mi]. Each of these is solved exactly by a DP over the labels of
+# positive weight in order of their last replay, and the sum gives an upper
+# bound on the optimal objective value. The multipliers start from each
+# match's best score, which is what they'd be without any conflicts, and are
+# improved by subgradient steps, and each relaxed solution is repaired into a
+# feasible one. Once the best feasible solution is within
+# config.LAGRANGIAN_GAP of the bound it is optimal; if that doesn't happen
+# within config.LAGRANGIAN_ITERS iterations, the problem is solved with glpk
+# instead, so the result is always optimal, and later solves go straight to
+# glpk too, since the relaxation is unlikely to do better on them. Otherwise
+# the multipliers are kept between solves, so re-solving with different
+# forced labels starts from the previous solve's. Has the same interface as
+# LabelMIP
+class LagrangianSolver:
+  def __init__(self, num_games, all_labels):
+    self.num_games = num_games
+    self.all_labels = all_labels
+    self.fallback = None
+    self.mu = [max([config.NOLABEL_OBJVAL] + [ll for ll, _, _ in lbls]) for lbls in all_labels]
+
+    # covers[mi][lbl] is the list of replays covered by label lbl of mi
+    self.covers = [{lbl : [(lbl[1], lbl[2]+k) for k in range(ng)] for lbl in lbls}
+                   for ng, lbls in zip(num_games, all_labels)]
+
+    # the labels of each setup, in order of their last replay, as arrays of
+    # their first and last replays, matches and scores
+    self.setups = {}
+    for mi, lbls in enumerate(all_labels):
+      for ll, si, ri in lbls:
+        self.setups.setdefault(si, []).append((ri + num_games[mi] - 1, ri, mi, ll))
+    for si, lbls in self.setups.items():
+      lbls.sort()
+      self.setups[si] = {
+        'ends'   : np.array([end for end, _, _, _ in lbls]),
+        'starts' : np.array([start for _, start, _, _ in lbls]),
+        'mis'    : np.array([mi for _, _, mi, _ in lbls]),
+        'lls'    : np.array([ll for _, _, _, ll in lbls]),
+        'labels' : [(ll, si, start) for _, start, _, ll in lbls],
+      }
+
+  # solve the relaxation for multipliers mu, where allowed(mi, label) says
+  # whether a label may be used. Returns the bound, and the list of labels
+  # chosen for each match
+  def relaxation(self, mu, allowed, nolabel_ok):
+    bound = sum(mu) + sum([max(0.0, config.NOLABEL_OBJVAL - m) if ok else 0.0
+                           for m, ok in zip(mu, nolabel_ok)])
+    picks = [[] for _ in self.num_games]
+    mu = np.array(mu)
+    for setup in self.setups.values():
+      # labels of weight at most 0 are never worth taking, so the DP only
+      # runs over the rest. For the k-th of them, prev[k] is the number of
+      # them ending before it starts
+      idx = np.flatnonzero(setup['lls'] - mu[setup['mis']] > 0)
+      if len(idx) == 0:
+        continue
+      prev = np.searchsorted(setup['ends'][idx], setup['starts'][idx]).tolist()
+      weights = (setup['lls'][idx] - mu[setup['mis'][idx]]).tolist()
+      mis = setup['mis'][idx].tolist()
+      labels = [setup['labels'][i] for i in idx.tolist()]
+
+      dp = [0.0]
+      take = []
+      for k in range(len(mis)):
+        if allowed[mis[k]] == None or allowed[mis[k]] == labels[k]:
+          val = dp[prev[k]] + weights[k]
+          if val > dp[k]:
+            dp.append(val)
+            take.append(True)
+            continue
+        dp.append(dp[k])
+        take.append(False)
+      bound += dp[-1]
+
+      k = len(mis)
+      while k > 0:
+        if take[k-1]:
+          picks[mis[k-1]].append(labels[k-1])
+          k = prev[k-1]
+        else:
+          k -= 1
+    return bound, picks
+
+  # turn a relaxed solution into a feasible one: forced labels are placed
+  # first, then the best relaxed pick of each match, and then the remaining
+  # matches greedily take their best label whose replays are still free
+  def repair(self, picks, allowed, nolabel_ok):
+    occupied = set()
+    soln = [None for _ in self.num_games]
+
+    def place(mi, lbl):
+      covers = self.covers[mi][lbl]
+      for r in covers:
+        if r in occupied:
+          return False
+      occupied.update(covers)
+      soln[mi] = lbl
+      return True
+
+    for mi, lbl in enumerate(allowed):
+      if lbl and not place(mi, lbl):
+        return None
+    for mi, lbls in enumerate(picks):
+      if allowed[mi] == None and len(lbls) > 0:
+        place(mi, max(lbls))
+    for mi, lbls in enumerate(self.all_labels):
+      if soln[mi] == None:
+        for lbl in lbls:
+          if lbl[0] > config.NOLABEL_OBJVAL or not nolabel_ok[mi]:
+            if (allowed[mi] == None or allowed[mi] == lbl) and place(mi, lbl):
+              break
+        if soln[mi] == None and not nolabel_ok[mi]:
+          return None
+    return soln
+
+  # solve the problem, as in LabelMIP.solve. A feasible incumbent is used as
+  # the initial best solution, which also sets the first step sizes
+  def solve(self, forced_labels = set(), incumbent = None):
+    if self.fallback != None:
+      return self.fallback.solve(forced_labels, incumbent)
+
+    # allowed[mi] is the label mi is forced to use, if any, and nolabel_ok[mi]
+    # says whether mi may be left unlabelled
+    allowed = [None for _ in self.num_games]
+    nolabel_ok = [True for _ in self.num_games]
+    for lbl in forced_labels:
+      mi = lbl[0]
+      nolabel_ok[mi] = lbl[1] == None
+      if lbl[1] != None:
+        allowed[mi] = next(l for l in self.all_labels[mi] if l[1:] == tuple(lbl[1:]))
+    # a match forced to be unlabelled is simply left out of the relaxation
+    mu = list(self.mu)
+    for lbl in forced_labels:
+      if lbl[1] == None:
+        allowed[lbl[0]] = ()
+
+    best = incumbent
+    best_bound = INF
+    step_scale = 2.0
+    since_improved = 0
+    for it in range(config.LAGRANGIAN_ITERS):
+      bound, picks = self.relaxation(mu, allowed, nolabel_ok)
+      if bound < best_bound - 1e-9:
+        best_bound = bound
+        since_improved = 0
+        self.mu = list(mu)
+      else:
+        since_improved += 1
+        if since_improved >= 10:
+          step_scale /= 2
+          since_improved = 0
+
+      soln = self.repair(picks, allowed, nolabel_ok)
+      if soln != None and (best == None or objective(soln) > objective(best) + 1e-9):
+        best = soln
+
+      if best != None and best_bound - objective(best) <= config.LAGRANGIAN_GAP:
+        return objective(best), best
+
+      # subgradient of the bound with respect to mu, and a Polyak step
+      # towards the best feasible solution found so far
+      grad = [1 - len(picks[mi]) -
+              (1 if nolabel_ok[mi] and mu[mi] < config.NOLABEL_OBJVAL else 0)
+              for mi in range(len(mu))]
+      norm2 = sum([g*g for g in grad])
+      if norm2 == 0:
+        break
+      target = objective(best) if best != None else bound - 1.0
+      step = step_scale * (bound - target) / norm2
+      mu = [m - step*g for m, g in zip(mu, grad)]
+
+    if self.fallback == None:
+      self.fallback = LabelMIP(self.num_games, self.all_labels)
+    return self.fallback.solve(forced_labels, best)
+
+# the available solvers for components of the labelling problem, by name
+SOLVERS = {
+  'glpk' : LabelMIP,
+  'lagrangian' : LagrangianSolver,
+}
+
+# find the connected components of the conflict graph of the labelling problem,
+# in which two matches are adjacent if they have labels that cover a common
+# replay. Matches in different components never compete for replays, so each
+# component can be solved on its own. Returns a list of the components, each a
+# sorted list of match indices, ordered by their first match
+def label_components(num_games, all_labels):
+  parent = list(range(len(num_games)))
+  def find(mi):
+    while parent[mi] != mi:
+      parent[mi] = parent[parent[mi]]
+      mi = parent[mi]
+    return mi
+
+  replay_owner = {} # dict mapping a pair si, ri to some match covering it
+  for mi, lbls in enumerate(all_labels):
+    for _, si, ri in lbls:
+      for k in range(num_games[mi]):
+        other = replay_owner.setdefault((si, ri+k), mi)
+        parent[find(other)] = find(mi)
+
+  components = {}
+  for mi in range(len(num_games)):
+    components.setdefault(find(mi), []).append(mi)
+
+  return sorted(components.values())
+
+# the optimal dual values of the LP relaxation of the labelling problem, in
+# the format of LabelMIP.lp_duals, solving each component of label_components
+# on its own. By LP duality, the sum of all the dual values is an upper bound
+# on the objective value of any solution, and the reduced cost
+#   ll - match_duals[mi] - (sum of replay_duals of the replays it covers)
+# of a label (ll, si, ri) of mi is at most 0 if the label is in all_labels.
+# For a label that isn't, the bound plus its reduced cost (if that is more
+# than 0) bounds the objective value of any solution that uses it as well;
+# see prune_labels. Replays without a constraint have dual value 0
+def lp_duals(num_games, all_labels):
+  match_duals = [None for _ in num_games]
+  replay_duals = {}
+  for comp in label_components(num_games, all_labels):
+    if len(comp) == 1:
+      # the LP of a single match just picks its best option
+      match_duals[comp[0]] = max([config.NOLABEL_OBJVAL] + [ll for ll, _, _ in all_labels[comp[0]]])
+      continue
+
+    model = LabelMIP([num_games[mi] for mi in comp], [all_labels[mi] for mi in comp])
+    comp_match_duals, comp_replay_duals = model.lp_duals()
+    for mi, dual in zip(comp, comp_match_duals):
+      match_duals[mi] = dual
+    replay_duals.update(comp_replay_duals)
+  return match_duals, replay_duals
+
+# tolerance for the LP bounds of prune_labels, well above the rounding error of
+# glpk's dual values
+PRUNE_TOL = 1e-6
+
+# the k best labels of each match from all_labels (sorted best first, as
+# output by ReplayLabeller.compute_all_labels), plus any more that might be
+# needed for an optimal solution. Whether a dropped label could be needed is
+# decided with lp_duals of the kept labels: a label whose score doesn't make
+# up for the prices of its match and of the replays it would take from other
+# matches (its reduced cost) bounds the objective value of any solution
+# using it. Labels are added until the LP relaxation is optimal for all the
+# labels, and every dropped label's bound is below the optimal objective
+# value of the kept labels. optimum(labels) is the optimal objective value
+# for the given labels of each match, and as a final check the optimum of the
+# kept labels is compared with that of all_labels; if it's worse (which the
+# bounds rule out, up to rounding), k is doubled and the labels pruned
+# again. The kept labels of each match stay in order. Returns the kept
+# labels, the final k and the number of rounds of LP solves
+def prune_labels(num_games, all_labels, k, optimum):
+  kept = [list(range(min(k, len(lbls)))) for lbls in all_labels]
+  full_objval = None
+  rounds = 0
+
+  while True:
+    rounds += 1
+    pruned = [[lbls[j] for j in js] for lbls, js in zip(all_labels, kept)]
+    match_duals, replay_duals = lp_duals(num_games, pruned)
+
+    # the reduced cost of each dropped label, by its index in all_labels
+    reduced = []
+    for mi, (lbls, js) in enumerate(zip(all_labels, kept)):
+      dropped = sorted(set(range(len(lbls))) - set(js))
+      reduced.append({j : lbls[j][0] - match_duals[mi] -
+                          sum([replay_duals.get((lbls[j][1], lbls[j][2]+g), 0.0)
+                               for g in range(num_games[mi])])
+                      for j in dropped})
+
+    # first price in the dropped labels with positive reduced cost, until
+    # the duals are feasible for all the labels and the bound holds
+    if expand_kept(kept, reduced, PRUNE_TOL):
+      continue
+
+    # then keep any label whose bound doesn't rule it out
+    bound = sum(match_duals) + sum(replay_duals.values())
+    objval = optimum(pruned)
+    if expand_kept(kept, reduced, objval - bound - PRUNE_TOL):
+      continue
+
+    if full_objval == None:
+      full_objval = optimum(all_labels)
+    if objval >= full_objval - PRUNE_TOL:
+      return pruned, k, rounds
+    k *= 2
+    kept = [sorted(set(js) | set(range(min(k, len(lbls)))))
+            for lbls, js in zip(all_labels, kept)]
+
+# for prune_labels, add the dropped labels of each match with reduced cost
+# (in reduced) above threshold to its kept labels in kept. Returns whether
+# any were added
+def expand_kept(kept, reduced, threshold):
+  expanded = False
+  for mi, rcs in enumerate(reduced):
+    needed = [j for j, rc in rcs.items() if rc > threshold]
+    if len(needed) > 0:
+      kept[mi] = sorted(kept[mi] + needed)
+      expanded = True
+  return expanded
+
+# the labelling MIP, split up into the connected components given by
+# label_components. Each component is solved by its own instance of the solver
+# named by solver (one of SOLVERS, built the first time it's needed), and the
+# objective values and solutions of the components are stitched together. The
+# unforced solution of each component is kept, so that a solve with forced
+# labels only re-solves the components containing the forced matches. If keys
+# is given, keys[mi] is a hashable key identifying match mi and its labels,
+# and the unforced solution of each component is also kept in the dict cache
+# under the component's signature, so that a DecomposedMIP built later with
+# the same component can reuse it. hints[mi] is an optional label of mi (e.g.
+# its label in a previous run), and components that aren't cached start their
+# search from these labels
+class DecomposedMIP:
+  def __init__(self, num_games, all_labels, solver = 'glpk', keys = None, cache = None,
+               hints = None):
+    self.num_games = num_games
+    self.all_labels = all_labels
+    self.solver = SOLVERS[solver]
+    self.keys = keys
+    self.cache = cache
+    self.hints = hints
+    self.components = label_components(num_games, all_labels)
+
+    # component_of[mi] is the pair (ci, k) such that mi is the k-th match of
+    # component ci
+    self.component_of = [None for _ in num_games]
+    for ci, comp in enumerate(self.components):
+      for k, mi in enumerate(comp):
+        self.component_of[mi] = (ci, k)
+
+    self.models = [None for _ in self.components]
+    self.solutions = [None for _ in self.components]
+
+    print("Split labelling MIP for %s matches into %s independent components (largest has %s matches)" %
+      (len(num_games), len(self.components), max([len(c) for c in self.components], default=0)))
+
+  # a key identifying component ci and its labels, or None if no keys were
+  # given
+  def signature(self, ci):
+    if self.keys == None:
+      return None
+    return tuple([self.keys[mi] for mi in self.components[ci]])
+
+  # the unforced objective value and solution of every component, solving
+  # the ones that haven't been solved yet
+  def unforced_solutions(self):
+    for ci in range(len(self.components)):
+      if self.solutions[ci] == None:
+        self.solutions[ci] = self.unforced_solution(ci)
+    return self.solutions
+
+  # the unforced objective value and solution of component ci, from the cache
+  # if possible. The cache stores the index of each match's label in its list
+  # of labels, since setup and replay indices can shift between runs
+  def unforced_solution(self, ci):
+    comp = self.components[ci]
+    sig = self.signature(ci)
+    if self.cache != None and sig in self.cache:
+      objval, choice = self.cache[sig]
+      return objval, [None if j == None else self.all_labels[mi][j] for mi, j in zip(comp, choice)]
+
+    objval, comp_soln = self.solve_component(ci, incumbent = self.incumbent(ci))
+    if self.cache != None:
+      self.cache[sig] = (objval, [None if lbl == None else self.all_labels[mi].index(lbl)
+                                  for mi, lbl in zip(comp, comp_soln)])
+    return objval, comp_soln
+
+  # a feasible solution of component ci made from the hints, leaving out any
+  # hint that conflicts with an earlier one, or None if there are no hints
+  def incumbent(self, ci):
+    if self.hints == None:
+      return None
+
+    occupied = set()
+    soln = []
+    for mi in self.components[ci]:
+      lbl = self.hints[mi]
+      covers = [] if lbl == None else [(lbl[1], lbl[2]+k) for k in range(self.num_games[mi])]
+      if any([r in occupied for r in covers]):
+        lbl = None
+      else:
+        occupied.update(covers)
+      soln.append(lbl)
+    return soln
+
+  # solve component ci, where forced_labels and incumbent are as in
+  # LabelMIP.solve but with match indices local to the component. Components
+  # with a single match are solved directly, without glpk. Returns the
+  # objective value and the list of labels of the component's matches
+  def solve_component(self, ci, forced_labels = set(), incumbent = None):
+    comp = self.components[ci]
+
+    if len(comp) == 1:
+      lbls = self.all_labels[comp[0]]
+      if len(forced_labels) == 0:
+        if len(lbls) > 0 and lbls[0][0] > config.NOLABEL_OBJVAL:
+          return lbls[0][0], [lbls[0]]
+        return config.NOLABEL_OBJVAL, [None]
+      forced = next(iter(forced_labels))
+      if forced[1] == None:
+        return config.NOLABEL_OBJVAL, [None]
+      lbl = next(lbl for lbl in lbls if lbl[1:] == forced[1:])
+      return lbl[0], [lbl]
+
+    if self.models[ci] == None:
+      self.models[ci] = self.solver([self.num_games[mi] for mi in comp],
+                                    [self.all_labels[mi] for mi in comp])
+    return self.models[ci].solve(forced_labels, incumbent)
+
+  # solve the MIP, where forced_labels is as in LabelMIP.solve. Returns the
+  # objective value and a list with the label (ll, si, ri) of each match, or
+  # None for unlabelled matches
+  def solve(self, forced_labels = set()):
+    # translate the forced labels to per-component local match indices
+    forced = {}
+    for lbl in forced_labels:
+      ci, k = self.component_of[lbl[0]]
+      forced.setdefault(ci, set()).add((k,) + tuple(lbl[1:]))
+
+    objval = 0.0
+    soln = [None for _ in self.num_games]
+    for ci, comp in enumerate(self.components):
+      if ci in forced:
+        comp_objval, comp_soln = self.solve_component(ci, forced[ci])
+      else:
+        if self.solutions[ci] == None:
+          self.solutions[ci] = self.unforced_solution(ci)
+        comp_objval, comp_soln = self.solutions[ci]
+
+      objval += comp_objval
+      for mi, lbl in zip(comp, comp_soln):
+        soln[mi] = lbl
+
+    print("MIP solved; objval=%.2f, labelled %s/%s matches" %
+      (objval, len([s for s in soln if s != None]), len(self.num_games)))
+    return objval, soln
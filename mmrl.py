@@ -5,10 +5,14 @@ import datetime
 import pytz
 import pickle
 import argparse
+import time
 
-from ReplayLabeller import ReplayLabeller
+from ReplayLabeller import ReplayLabeller, load_label_cache, save_label_cache
 import data
+import store
 import config
+import profiling
+import output
 
 desc = """ 
 A tool for fetching challonge data, parsing slippi replays, and matching
@@ -23,117 +27,173 @@ Example of a full run with a main bracket and an amateur bracket:
   labels_122
 """
 
+# parse the argument of --since
+def since_time(arg):
+  if arg == 'last':
+    return arg
+  dt = datetime.datetime.fromisoformat(arg)
+  if dt.tzinfo == None:
+    dt = pytz.timezone(config.TIME_ZONE).localize(dt)
+  return dt
+
+# label the replays in the output dir's challonge and slippi files, and write
+# the output files. The label scores and single best labels are written first,
+# and then each match's label probabilities as soon as they're computed. cache
+# is passed to ReplayLabeller to reuse results from a previous call
+def label_replays(args, cache=None):
+  challonge_file = store.find_store(os.path.join(args.output_dir, config.CHALLONGE_FILE))
+  slippi_file = store.find_store(os.path.join(args.output_dir, config.SLIPPI_FILE))
+  full_output_file = os.path.join(args.output_dir, config.FULL_OUTPUT_FILE)
+  single_output_file = os.path.join(args.output_dir, config.SINGLE_OUTPUT_FILE)
+  prob_output_file = os.path.join(args.output_dir, config.PROB_OUTPUT_FILE)
+
+  # with --watch, output files are replaced once fully written rather than
+  # written in place, so that the previous pass's output stays readable
+  atomic = args.watch != None
+
+  with profiling.stage('load'):
+    replayLabeller = ReplayLabeller(args.p, challonge_file, slippi_file, args.solver, cache)
+
+  if args.estimate_skew:
+    print("Estimating the clock offsets of %s setups..." % len(replayLabeller.setups))
+    with profiling.stage('estimate_skew'):
+      replayLabeller.estimate_clock_offsets()
+
+  print("Computing labels for %s matches..." % len(replayLabeller.matches))
+  with profiling.stage('compute_all_labels'):
+    all_labels = replayLabeller.compute_all_labels()
+  if args.top_k != None:
+    with profiling.stage('prune_labels', k=args.top_k):
+      all_labels = replayLabeller.prune_labels(all_labels, args.top_k)
+  sl_objval, single_labels = replayLabeller.mip_solve(all_labels)
+
+  with profiling.stage('output'):
+    with output.open_writers(full_output_file, replayLabeller, args.jsonl, atomic) as writers:
+      for mi, lbls in enumerate(all_labels):
+        for writer in writers:
+          writer.write_match(mi, lbls)
+
+    with output.open_writers(single_output_file, replayLabeller, args.jsonl, atomic) as writers:
+      for writer in writers:
+        writer.write_single_soln(single_labels)
+
+  print("Wrote label output to %s and %s" % (full_output_file, single_output_file))
+
+  with profiling.stage('probs', method=args.probs, jobs=args.jobs):
+    if args.probs == 'sample':
+      probs_labels = enumerate(replayLabeller.get_all_labels_marginals(all_labels, threshold=0.05))
+    else:
+      probs_labels = replayLabeller.iter_all_labels_probs(all_labels, threshold=0.05,
+                                                          jobs = args.jobs)
+
+    with output.open_writers(prob_output_file, replayLabeller, args.jsonl, atomic) as writers:
+      for mi, lbls in probs_labels:
+        for writer in writers:
+          writer.write_match(mi, lbls, format_pct = True)
+
+  print("Wrote label probabilities to %s" % prob_output_file)
+
 if __name__ == '__main__':
   parser = argparse.ArgumentParser(description = desc,
     formatter_class=argparse.RawTextHelpFormatter)
   parser.add_argument("-c", metavar="challonge_id", action="append",
     help="(repeatable) fetch challonge data from these bracket id(s)")
+  parser.add_argument("--since", metavar="T", type=since_time,
+    help="with -c, only take the matches updated after T (an ISO 8601 time, or\n"
+         "'last' for the last update already fetched), merging them into the\n"
+         "existing challonge data")
   parser.add_argument("-s", metavar="slippi_dir",
     help="parse slippi replays from this directory")
   parser.add_argument("-p", metavar="player_csv",
     help="use csv for hints about players' mains")
   parser.add_argument("-l", help="label replays", action="store_true")
+  parser.add_argument("-j", "--jobs", metavar="N", type=int, default=1,
+    help="use N processes for parsing slippi replays and estimating label\n"
+         "probabilities (default: 1)")
+  parser.add_argument("--probs", choices=["mip", "sample"], default="mip",
+    help="how to estimate label probabilities: 'mip' compares the best solution\n"
+         "using each label, 'sample' estimates the posterior probability of each\n"
+         "label over all assignments (default: mip)")
+  parser.add_argument("--solver", choices=["glpk", "lagrangian"], default=config.MIP_SOLVER,
+    help="solver for the labelling MIP (default: %(default)s). 'lagrangian' is\n"
+         "experimental, and usually slower than glpk")
+  parser.add_argument("--estimate-skew", action="store_true",
+    help="with -l, estimate each setup's clock offset (on top of\n"
+         "DRIVE_TIME_OFFSETS, and possibly changing during the day) from the\n"
+         "labels it's confident about, and label with the estimated offsets")
+  parser.add_argument("--top-k", metavar="K", type=int,
+    help="only keep the K best labels of each match, plus any others that could\n"
+         "be needed for the optimal labelling, which stays the same as without\n"
+         "this option. Makes the MIP and the probabilities faster on busy setups,\n"
+         "but label probabilities (and full_output.txt) only cover the kept labels")
+  parser.add_argument("--no-cache", action="store_true",
+    help="refetch every challonge bracket, reparse every slippi replay and\n"
+         "relabel every match from scratch, ignoring and not updating the caches")
+  parser.add_argument("--watch", metavar="SECONDS", type=float, nargs="?",
+    const=config.WATCH_INTERVAL,
+    help="keep running, repeating the requested steps every SECONDS seconds\n"
+         "(default: %s) and only processing new replays and matches" % config.WATCH_INTERVAL)
+  parser.add_argument("--jsonl", action="store_true",
+    help="also write each output file as JSON Lines (one object per match),\n"
+         "e.g. full_output.jsonl")
+  parser.add_argument("--profile", action="store_true",
+    help="time each stage of the run, and write a report to %s in the\n"
+         "output dir" % config.PROFILE_OUTPUT_FILE)
+  parser.add_argument("--profile-dump", metavar="FILE",
+    help="with --profile, also run under cProfile and dump its stats to FILE")
   parser.add_argument("output_dir", help="write output files to this dir")
   args = parser.parse_args()
 
   os.makedirs(args.output_dir, exist_ok=True)
   challonge_file = os.path.join(args.output_dir, config.CHALLONGE_FILE)
   slippi_file = os.path.join(args.output_dir, config.SLIPPI_FILE)
-  full_output_file = os.path.join(args.output_dir, config.FULL_OUTPUT_FILE)
-  single_output_file = os.path.join(args.output_dir, config.SINGLE_OUTPUT_FILE)
-  prob_output_file = os.path.join(args.output_dir, config.PROB_OUTPUT_FILE)
-
-  if args.c != None:
-    print("Fetching challonge brackets: %s" % (', '.join(args.c)))
-    data.fetch_brackets_to_file(args.c, challonge_file)
-
-  if args.s != None:
-    print("Parsing slippi data from %s" % args.s)
-    data.parse_all_slp_drives(args.s, slippi_file)
-
-  if args.l:
-    replayLabeller = ReplayLabeller(args.p, challonge_file, slippi_file)
-
-    print("Computing labels for %s matches..." % len(replayLabeller.matches))
-    all_labels = replayLabeller.compute_all_labels()
-    sl_objval, single_labels = replayLabeller.mip_solve(all_labels)
-    probs_labels = replayLabeller.get_all_labels_probs(all_labels, threshold=0.05)
-
-    matches = replayLabeller.matches
-    setups = replayLabeller.setups
-
-    def display_time(dt):
-      return dt.astimezone(pytz.timezone(config.TIME_ZONE)).strftime('%Y-%m-%d %H:%M:%S')
-
-    def print_match(fp, mi, match):
-      fp.write("Match %s: %s vs %s [%s],  from %s to %s\n" %
-        (mi,
-         replayLabeller.playerid_map[match['player1-id']],
-         replayLabeller.playerid_map[match['player2-id']],
-         match['scores-csv'],
-         display_time(match['started-at']),
-         display_time(match['completed-at'])))
-
-    def print_label(fp, ll, si, ri, ngames, prob=None, format_pct = False):
-      llstr = ('%.2f%%' % (ll*100)) if format_pct else ('%.3f' % ll)
-      probstr = '' if prob == None else (' (%.2f%%)' % (prob*100))
-      fp.write("    %s%s: s%s %s Games %s-%s:  %s to %s\n" %
-        (llstr, probstr, si, setups[si]['drive'], ri, ri+ngames-1,
-         display_time(setups[si]['replays'][ri]['start_time']),
-         display_time(setups[si]['replays'][ri+ngames-1]['end_time'])))
-
-    def print_replay(fp, replay):
-      chars = [p['char'] for p in replay['ports'] if p != None]
-      wins = ['L' if p['dead_at_end'] else 'W' for p in replay['ports'] if p != None]
-      fp.write("        %s to %s:  [%s]  %s (%s) vs. %s (%s)\n" %
-        (display_time(replay['start_time']),
-         display_time(replay['end_time']), replay['stage'], chars[0],
-         wins[0], chars[1], wins[1]))
-
-    # displays a solution with (up to) a single solution for each match, in the
-    # format given e.g. by compute_greedy_labels and analyze_LP_soln. Returns
-    # the average match ll of the solution and the number of missed matches.
-    def print_single_soln(fp, soln):
-      missed_mis = {mi for mi, lbl in enumerate(soln) if lbl == None}
-      labels = {(mi,lbl) for mi, lbl in enumerate(soln) if lbl != None}
-      for mi, (ll, si, ri) in sorted(labels, key = lambda x: x[1], reverse=True):
-        print_match(fp, mi, matches[mi])
-        print_label(fp, ll, si, ri, matches[mi]['num_games'])
-        for k in range(matches[mi]['num_games']):
-          print_replay(fp, setups[si]['replays'][ri+k])
-        fp.write("\n")
-
-      fp.write("\nMissed %s matches:\n" % len(missed_mis))
-      for mi in missed_mis:
-        print_match(fp, mi, matches[mi])
-
-    # displays a solution with zero or more solutions for each match, in the
-    # format of all_labels
-    def print_full_soln(fp, soln, format_pct = False, sort_score = False):
-      mims = list(enumerate(matches))
-      if sort_score:
-        mims.sort(key = lambda x: soln[x[0]][0], reverse=True)
-      for mi, match in mims:
-        print_match(fp, mi, match)
-        for ll, si, ri in soln[mi]:
-          if si != None:
-            print_label(fp, ll, si, ri, match['num_games'], format_pct = format_pct)
-            for k in range(match['num_games']):
-              print_replay(fp, setups[si]['replays'][ri+k])
-          else:
-            fp.write("    %.2f%%: NO LABEL\n" % (ll*100))
-        fp.write("\n")
-
-    with open(full_output_file, 'w') as fp:
-      print_full_soln(fp, all_labels)
-
-    with open(single_output_file, 'w') as fp:
-      print_single_soln(fp, single_labels)
-
-    print("Wrote label output to %s and %s" % (full_output_file, single_output_file))
-
-    with open(prob_output_file, 'w') as fp:
-      print_full_soln(fp, probs_labels, format_pct = True, sort_score = True)
-
-  else:
-    usage()
+  slippi_cache_file = os.path.join(args.output_dir, config.SLIPPI_CACHE_FILE)
+  challonge_cache_file = os.path.join(args.output_dir, config.CHALLONGE_CACHE_FILE)
+  label_cache_file = os.path.join(args.output_dir, config.LABEL_CACHE_FILE)
+  profile_file = os.path.join(args.output_dir, config.PROFILE_OUTPUT_FILE)
+
+  # run each requested step once, or with --watch, repeat them every
+  # args.watch seconds. The labeller's results are kept between passes and
+  # runs, so that only new or changed matches and replays are scored and only
+  # the components of the MIP they affect are re-solved (unless --no-cache
+  # is given, in which case every pass starts from scratch)
+  label_cache = None
+  if args.l and not args.no_cache:
+    label_cache = load_label_cache(label_cache_file)
+  while True:
+    if args.profile:
+      profiling.enable(cprofile = args.profile_dump != None)
+    try:
+      if args.c != None:
+        print("Fetching challonge brackets: %s" % (', '.join(args.c)))
+        with profiling.stage('fetch'):
+          data.fetch_brackets_to_file(args.c, challonge_file, since = args.since,
+            cache_file = None if args.no_cache else challonge_cache_file)
+
+      if args.s != None:
+        print("Parsing slippi data from %s" % args.s)
+        with profiling.stage('parse'):
+          data.parse_all_slp_drives(args.s, slippi_file, jobs = args.jobs,
+            cache_file = None if args.no_cache else slippi_cache_file)
+
+      if args.l:
+        with profiling.stage('label'):
+          label_replays(args, label_cache)
+          if label_cache != None:
+            save_label_cache(label_cache, label_cache_file)
+      elif args.watch == None:
+        usage()
+    except Exception as e:
+      # a failed pass (e.g. challonge being unreachable) shouldn't stop
+      # watching; the next pass will retry
+      if args.watch == None:
+        raise
+      print("WARNING: watch pass failed: %r" % e)
+
+    if args.profile:
+      profiling.report(profile_file, args.profile_dump)
+
+    if args.watch == None:
+      break
+    print("Watching for new replays and matches; next pass in %s seconds" % args.watch)
+    time.sleep(args.watch)
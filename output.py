@@ -0,0 +1,178 @@
+# writers of the label output files of mmrl.py. A writer writes the block of
+# each match (its labels, and the replays of each label) as soon as it's
+# given, so that a long probability pass can be followed while it runs and the
+# labels never need to be held in memory all at once. TextWriter writes the
+# human-readable format of full_output.txt etc., and JsonlWriter writes one
+# JSON object per match, for other programs to read
+import os
+import json
+import contextlib
+import pytz
+
+import config
+import store
+
+# open fname for writing. If atomic, it's written through a temporary file
+# that replaces it once written, so that anything reading the output files
+# (e.g. while running with --watch) never sees a half-written file; otherwise
+# each block is visible as soon as it's written
+@contextlib.contextmanager
+def open_output(fname, atomic = False):
+  if not atomic:
+    with open(fname, 'w') as fp:
+      yield fp
+    return
+
+  tmp = fname + '.tmp'
+  with open(tmp, 'w') as fp:
+    yield fp
+  os.replace(tmp, fname)
+
+class TextWriter:
+  # fp is the file to write to, and labeller the ReplayLabeller whose labels
+  # are written
+  def __init__(self, fp, labeller):
+    self.fp = fp
+    self.labeller = labeller
+    self.tz = pytz.timezone(config.TIME_ZONE)
+    self.times = {} # dict mapping an epoch time to its display string
+
+  # display a UTC epoch time in TIME_ZONE. The same replay times are displayed
+  # many times over, so they're only formatted once
+  def display_time(self, t):
+    if t not in self.times:
+      self.times[t] = store.epoch_datetime(t).astimezone(self.tz).strftime('%Y-%m-%d %H:%M:%S')
+    return self.times[t]
+
+  def write_match_header(self, mi):
+    match = self.labeller.matches[mi]
+    self.fp.write("Match %s: %s vs %s [%s],  from %s to %s\n" %
+      (mi,
+       self.labeller.playerid_map[match.player_ids[0]],
+       self.labeller.playerid_map[match.player_ids[1]],
+       match.scores_csv,
+       self.display_time(match.start),
+       self.display_time(match.end)))
+
+  def write_label(self, ll, si, ri, ngames, format_pct = False):
+    replays = self.labeller.setups[si]['replays']
+    llstr = ('%.2f%%' % (ll*100)) if format_pct else ('%.3f' % ll)
+    self.fp.write("    %s: s%s %s Games %s-%s:  %s to %s\n" %
+      (llstr, si, self.labeller.setups[si]['drive'], ri, ri+ngames-1,
+       self.display_time(replays[ri].start),
+       self.display_time(replays[ri+ngames-1].end)))
+    for replay in replays[ri : ri+ngames]:
+      self.write_replay(replay)
+
+  def write_replay(self, replay):
+    chars = [self.labeller.char_names[p.char] for p in replay.ports if p != None]
+    wins = ['L' if p.dead_at_end else 'W' for p in replay.ports if p != None]
+    self.fp.write("        %s to %s:  [%s]  %s (%s) vs. %s (%s)\n" %
+      (self.display_time(replay.start),
+       self.display_time(replay.end), replay.stage, chars[0],
+       wins[0], chars[1], wins[1]))
+
+  # write the block of match mi, with zero or more labels in the format of
+  # all_labels (where a label (ll, None, None) is the option of leaving the
+  # match unlabelled). If format_pct, the label scores are probabilities
+  def write_match(self, mi, labels, format_pct = False):
+    self.write_match_header(mi)
+    for ll, si, ri in labels:
+      if si != None:
+        self.write_label(ll, si, ri, self.labeller.matches[mi].num_games, format_pct = format_pct)
+      else:
+        self.fp.write("    %.2f%%: NO LABEL\n" % (ll*100))
+    self.fp.write("\n")
+    self.fp.flush()
+
+  # write a solution with (up to) a single label for each match, as given by
+  # ReplayLabeller.mip_solve: the labelled matches, from the best label down,
+  # and then the matches that were left unlabelled
+  def write_single_soln(self, soln):
+    labels = [(mi, lbl) for mi, lbl in enumerate(soln) if lbl != None]
+    for mi, (ll, si, ri) in sorted(labels, key = lambda x: x[1], reverse=True):
+      self.write_match_header(mi)
+      self.write_label(ll, si, ri, self.labeller.matches[mi].num_games)
+      self.fp.write("\n")
+
+    missed = [mi for mi, lbl in enumerate(soln) if lbl == None]
+    self.fp.write("\nMissed %s matches:\n" % len(missed))
+    for mi in missed:
+      self.write_match_header(mi)
+    self.fp.flush()
+
+class JsonlWriter:
+  def __init__(self, fp, labeller):
+    self.fp = fp
+    self.labeller = labeller
+    self.tz = pytz.timezone(config.TIME_ZONE)
+    self.times = {} # dict mapping an epoch time to its ISO 8601 string
+
+  # an ISO 8601 string of a UTC epoch time in TIME_ZONE, formatted once per
+  # time like TextWriter.display_time
+  def iso_time(self, t):
+    if t not in self.times:
+      self.times[t] = store.epoch_datetime(t).astimezone(self.tz).isoformat()
+    return self.times[t]
+
+  def replay_json(self, replay):
+    ports = [p for p in replay.ports if p != None]
+    return {
+      'filename' : replay.filename,
+      'start'    : self.iso_time(replay.start),
+      'end'      : self.iso_time(replay.end),
+      'stage'    : replay.stage,
+      'chars'    : [self.labeller.char_names[p.char] for p in ports],
+      'wins'     : [not p.dead_at_end for p in ports],
+    }
+
+  # the JSON of a label of match mi, where score is its log-likelihood or
+  # probability
+  def label_json(self, mi, score, si, ri, score_name):
+    if si == None:
+      return {score_name : score, 'setup' : None}
+    ngames = self.labeller.matches[mi].num_games
+    replays = self.labeller.setups[si]['replays'][ri : ri+ngames]
+    return {
+      score_name   : score,
+      'setup'      : self.labeller.setups[si]['drive'],
+      'first_game' : ri,
+      'last_game'  : ri+ngames-1,
+      'replays'    : [self.replay_json(replay) for replay in replays],
+    }
+
+  def write_line(self, mi, labels, score_name):
+    match = self.labeller.matches[mi]
+    self.fp.write(json.dumps({
+      'match'   : mi,
+      'id'      : match.id,
+      'player1' : self.labeller.playerid_map[match.player_ids[0]],
+      'player2' : self.labeller.playerid_map[match.player_ids[1]],
+      'scores'  : match.scores_csv,
+      'start'   : self.iso_time(match.start),
+      'end'     : self.iso_time(match.end),
+      'labels'  : [self.label_json(mi, ll, si, ri, score_name) for ll, si, ri in labels],
+    }) + "\n")
+    self.fp.flush()
+
+  # write the line of match mi; see TextWriter.write_match
+  def write_match(self, mi, labels, format_pct = False):
+    self.write_line(mi, labels, 'prob' if format_pct else 'll')
+
+  # write a line for each match of a single solution, with an empty list of
+  # labels for the matches left unlabelled
+  def write_single_soln(self, soln):
+    for mi, lbl in enumerate(soln):
+      self.write_line(mi, [] if lbl == None else [lbl], 'll')
+
+# open the writers of an output file fname for labeller: a TextWriter, and if
+# jsonl, a JsonlWriter of the file with the extension .jsonl. Returns the list
+# of writers
+@contextlib.contextmanager
+def open_writers(fname, labeller, jsonl = False, atomic = False):
+  with contextlib.ExitStack() as stack:
+    writers = [TextWriter(stack.enter_context(open_output(fname, atomic)), labeller)]
+    if jsonl:
+      jsonl_fname = os.path.splitext(fname)[0] + '.jsonl'
+      writers.append(JsonlWriter(stack.enter_context(open_output(jsonl_fname, atomic)), labeller))
+    yield writers
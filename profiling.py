@@ -0,0 +1,96 @@
+# timing instrumentation for the stages of the mmrl.py pipeline, for
+# mmrl.py --profile. Code marks out a stage with the stage() context manager,
+# and records counts in the innermost stage (e.g. of replays parsed) with
+# count(); report() then gives the wall and CPU time, counts and rates of
+# each stage, and the peak memory use. Nothing is recorded until enable() is
+# called, so the instrumentation costs next to nothing otherwise
+import sys
+import time
+import json
+import resource
+import cProfile
+import contextlib
+
+enabled = False
+stages = [] # the finished stages, as dicts, in the order they were started
+active = [] # the stages that are running, innermost last
+profiler = None # a cProfile.Profile, if one was requested
+
+# start recording stages, clearing any recorded before. If cprofile is true,
+# everything is also run under cProfile until report()
+def enable(cprofile=False):
+  global enabled, stages, active, profiler
+  enabled = True
+  stages = []
+  active = []
+  profiler = None
+  if cprofile:
+    profiler = cProfile.Profile()
+    profiler.enable()
+
+# time the stage called name, with any extra info (e.g. problem sizes) to go
+# with it
+@contextlib.contextmanager
+def stage(name, **info):
+  if not enabled:
+    yield
+    return
+
+  record = {'stage' : name, 'depth' : len(active), 'counts' : {}}
+  record.update(info)
+  stages.append(record)
+  active.append(record)
+  wall, cpu = time.perf_counter(), time.process_time()
+  try:
+    yield
+  finally:
+    record['wall'] = time.perf_counter() - wall
+    record['cpu'] = time.process_time() - cpu
+    active.pop()
+
+# add n to the count called name of the innermost running stage
+def count(name, n):
+  if enabled and len(active) > 0:
+    counts = active[-1]['counts']
+    counts[name] = counts.get(name, 0) + n
+
+# the peak resident set size of this process and of its largest child process
+# (e.g. a worker of a process pool), in MB. ru_maxrss is in KB on Linux, but
+# in bytes on macOS
+def peak_rss():
+  scale = 1024.0 * 1024 if sys.platform == 'darwin' else 1024.0
+  return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale,
+          resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale)
+
+# the recorded stages, with the rate (per second of wall time) of each count,
+# and the peak memory use, as a dict
+def summary():
+  for record in stages:
+    record['rates'] = {name : n / record['wall'] if record['wall'] > 0 else None
+                       for name, n in record['counts'].items()}
+  self_rss, child_rss = peak_rss()
+  return {'stages' : stages, 'peak_rss_mb' : self_rss, 'peak_child_rss_mb' : child_rss}
+
+# print a human-readable report of the recorded stages, and write it as JSON
+# to json_file. If cProfile was enabled, its stats are dumped to cprofile_file
+def report(json_file, cprofile_file=None):
+  if profiler != None:
+    profiler.disable()
+    profiler.dump_stats(cprofile_file)
+
+  dat = summary()
+  with open(json_file, 'w') as fp:
+    json.dump(dat, fp, indent=2)
+
+  print("Profile (wall s / CPU s):")
+  for record in dat['stages']:
+    details = ['%s %s (%.1f/s)' % (n, name, record['rates'][name] or 0)
+               for name, n in record['counts'].items()]
+    details += ['%s %s' % (key, val) for key, val in record.items()
+                if key not in ['stage', 'depth', 'counts', 'rates', 'wall', 'cpu']]
+    print("  %s%-*s %9.3f %9.3f  %s" % ('  ' * record['depth'], 20 - 2*record['depth'],
+      record['stage'], record['wall'], record['cpu'], ', '.join(details)))
+  print("  peak RSS: %.1f MB (largest child process: %.1f MB)" %
+    (dat['peak_rss_mb'], dat['peak_child_rss_mb']))
+  print("Wrote profile to %s%s" % (json_file,
+    '' if profiler == None else ' and cProfile stats to %s' % cprofile_file))
@@ -0,0 +1,45 @@
+# estimation of the clock offsets of the setups, for mmrl.py --estimate-skew.
+# The labels of a setup are scored against a grid of clock offsets at once,
+# as a matrix lls where lls[g, j] is the time log-likelihood of label j (in
+# order of time) if the setup's clock is off by grid[g], and the best offset
+# is the one with the highest summed log-likelihood. A setup's labels can also
+# be split into pieces in time with different offsets, e.g. for a drive that
+# was moved to another Wii during the day
+import numpy as np
+
+# a grid of offsets from -max_offset to max_offset seconds in steps of step,
+# smallest first, so that the smallest of equally good offsets is picked
+def offset_grid(max_offset, step):
+  grid = np.arange(-max_offset, max_offset + step, step)
+  return grid[np.argsort(np.abs(grid), kind='stable')]
+
+# the best offsets of the labels of lls, as a list of pairs (j, g) meaning
+# labels from j on (up to the next pair) have offset grid[g], where grid[0] is
+# no offset (as in offset_grid). An offset is only taken if it beats no offset
+# by more than min_gain in summed log-likelihood. The labels are split in two
+# at the point that gives the highest summed log-likelihood with the best
+# offset on each side, as long as that beats a single offset by more than
+# min_gain and leaves at least min_labels labels on each side, and the sides
+# are then split the same way
+def fit_pieces(lls, min_labels, min_gain):
+  total = lls.sum(axis=1)
+  g = int(np.argmax(total))
+  if total[g] - total[0] <= min_gain:
+    g = 0
+  n = lls.shape[1]
+  if n < 2*min_labels:
+    return [(0, g)]
+
+  # the summed log-likelihoods of every split at once; a split at b puts
+  # labels b and on in the second piece
+  splits = np.arange(min_labels, n - min_labels + 1)
+  left = np.cumsum(lls, axis=1)[:, splits - 1]
+  right = total[:, None] - left
+  gains = left.max(axis=0) + right.max(axis=0) - total[g]
+  k = int(np.argmax(gains))
+  if gains[k] <= min_gain:
+    return [(0, g)]
+
+  b = int(splits[k])
+  return (fit_pieces(lls[:, :b], min_labels, min_gain) +
+          [(b + j, g) for j, g in fit_pieces(lls[:, b:], min_labels, min_gain)])
@@ -0,0 +1,273 @@
+# columnar on-disk stores for the parsed replays and challonge brackets. A
+# store is a directory with one .npy file per column, which are memory-mapped
+# when the store is loaded, so that loading is fast and only the columns (and
+# parts of them) that are actually used are read from disk. Times are stored as
+# UTC epoch seconds, and characters and stages as small integer codes into
+# string tables stored alongside them. The pickles of lists and dicts written by
+# earlier versions can still be loaded; they are converted to the same columns
+# in memory
+import os
+import shutil
+import pickle
+import calendar
+import datetime
+import pytz
+import numpy as np
+
+import config
+
+# bumped whenever the columns of a store change
+STORE_VERSION = 1
+
+# convert a timezone-aware datetime to UTC epoch seconds, and back
+def epoch(dt):
+  return calendar.timegm(dt.utctimetuple())
+
+def epoch_datetime(t):
+  return datetime.datetime.fromtimestamp(int(t), pytz.utc)
+
+# write a dict of numpy arrays to the store directory store_dir, replacing
+# whatever was there. The columns are written to a temporary directory that
+# is then moved into place, so a store is never seen half-written; the old
+# store is moved aside first and only deleted once the new one is in place
+def write_columns(store_dir, columns):
+  tmp_dir = store_dir + '.tmp'
+  old_dir = store_dir + '.old'
+  shutil.rmtree(tmp_dir, ignore_errors=True)
+  os.makedirs(tmp_dir)
+  for name, col in columns.items():
+    np.save(os.path.join(tmp_dir, name + '.npy'), col)
+  with open(os.path.join(tmp_dir, 'VERSION'), 'w') as fp:
+    fp.write('%s\n' % STORE_VERSION)
+
+  shutil.rmtree(old_dir, ignore_errors=True)
+  if os.path.exists(store_dir):
+    os.replace(store_dir, old_dir)
+  os.replace(tmp_dir, store_dir)
+  shutil.rmtree(old_dir, ignore_errors=True)
+
+# memory-map the columns of the store directory store_dir
+def read_columns(store_dir):
+  with open(os.path.join(store_dir, 'VERSION')) as fp:
+    version = int(fp.read())
+  if version != STORE_VERSION:
+    raise Exception("Store %s has version %s, but version %s is needed; rerun -c/-s to rewrite it" %
+      (store_dir, version, STORE_VERSION))
+
+  return {fname[:-len('.npy')] : np.load(os.path.join(store_dir, fname), mmap_mode='r')
+          for fname in os.listdir(store_dir) if fname.endswith('.npy')}
+
+# the path to load a store from: store_path itself, or if it doesn't exist,
+# the pickle written there by earlier versions. While write_columns is moving
+# a new store into place, the pickle is stale, and store_path is returned
+def find_store(store_path):
+  if (not os.path.exists(store_path) and os.path.exists(store_path + '.p') and
+      not os.path.exists(store_path + '.tmp')):
+    return store_path + '.p'
+  return store_path
+
+# encode a list of strings as codes into a sorted table of the distinct
+# strings. Returns the codes and the table
+def intern_strings(strs, dtype):
+  table = sorted(set(strs))
+  index = {s : code for code, s in enumerate(table)}
+  return np.array([index[s] for s in strs], dtype=dtype), np.array(table, dtype=str)
+
+# the columns of a list of setups in the format written by
+# data.parse_all_slp_drives. The replays of all setups are concatenated, and
+# the replays of setup si are those from setup_offsets[si] to
+# setup_offsets[si+1]. Each replay has 4 ports, where port_char is -1 for
+# unused ports
+def replay_columns(setups):
+  replays = [r for setup in setups for r in setup['replays']]
+
+  port_chars = [p['char'] if p != None else None for r in replays for p in r['ports']]
+  char_names = sorted({c for c in port_chars if c != None})
+  char_index = {c : code for code, c in enumerate(char_names)}
+  port_char = np.array([-1 if c == None else char_index[c] for c in port_chars],
+                       dtype=np.int8).reshape((len(replays), 4))
+  port_dead = np.array([p != None and p['dead_at_end'] for r in replays for p in r['ports']],
+                       dtype=bool).reshape((len(replays), 4))
+  stage, stage_names = intern_strings([str(r['stage']) for r in replays], np.int8)
+
+  return {
+    'setup_offsets' : np.cumsum([0] + [len(setup['replays']) for setup in setups], dtype=np.int64),
+    'drive'         : np.array([setup['drive'] for setup in setups], dtype=str),
+    'drive_dir'     : np.array([setup['replays'][0]['drive'] if len(setup['replays']) > 0 else ''
+                                for setup in setups], dtype=str),
+    'filename'      : np.array([r['filename'] for r in replays], dtype=str),
+    'start'         : np.array([epoch(r['start_time']) for r in replays], dtype=np.int64),
+    'end'           : np.array([epoch(r['end_time']) for r in replays], dtype=np.int64),
+    'numplayers'    : np.array([r['numplayers'] for r in replays], dtype=np.int8),
+    'stage'         : stage,
+    'stage_names'   : stage_names,
+    'port_char'     : port_char,
+    'port_dead'     : port_dead,
+    'char_names'    : np.array(char_names, dtype=str),
+  }
+
+def write_setups(setups, store_dir):
+  write_columns(store_dir, replay_columns(setups))
+
+# replays pickled by earlier versions were tagged with TIME_ZONE through
+# replace(tzinfo=...), which gives them the zone's LMT offset rather than its
+# actual one; such datetimes are localized again to get it
+def fix_lmt(dt):
+  tz = pytz.timezone(config.TIME_ZONE)
+  if dt.tzinfo is tz:
+    return tz.localize(dt.replace(tzinfo=None))
+  return dt
+
+# load the replay columns from a store directory, or from a pickled list of
+# setups
+def load_setups(path):
+  if os.path.isdir(path):
+    return read_columns(path)
+  with open(path, 'rb') as fp:
+    setups = pickle.load(fp)
+  for setup in setups:
+    for r in setup['replays']:
+      r['start_time'] = fix_lmt(r['start_time'])
+      r['end_time'] = fix_lmt(r['end_time'])
+  return replay_columns(setups)
+
+# compact records of the ports and replays of a replay store, and of the
+# matches of a challonge store. Characters are codes into the store's
+# char_names, and times are UTC epoch seconds
+class Port:
+  __slots__ = ['char', 'dead_at_end']
+
+  def __init__(self, char, dead_at_end):
+    self.char = char
+    self.dead_at_end = dead_at_end
+
+class Replay:
+  __slots__ = ['start', 'end', 'filename', 'drive', 'ports', 'stage', 'numplayers']
+
+  def __init__(self, start, end, filename, drive, ports, stage, numplayers):
+    self.start = start
+    self.end = end
+    self.filename = filename
+    self.drive = drive
+    self.ports = ports # one Port per controller port, or None for unused ports
+    self.stage = stage
+    self.numplayers = numplayers
+
+class Match:
+  __slots__ = ['id', 'player_ids', 'scores', 'num_games', 'scores_csv', 'start', 'end', 'updated']
+
+  def __init__(self, id, player_ids, scores, scores_csv, start, end, updated):
+    self.id = id
+    self.player_ids = player_ids # (player 1's id, player 2's id)
+    self.scores = scores # (player 1's score, player 2's score)
+    self.num_games = sum(scores)
+    self.scores_csv = scores_csv
+    self.start = start
+    self.end = end
+    self.updated = updated # None if the match was never updated
+
+# the replays of one setup of a replay store, as a read-only sequence of
+# Replays. Each Replay is built the first time it's accessed
+class ReplayList:
+  def __init__(self, columns, si, stage_names):
+    self.columns = columns
+    self.first = int(columns['setup_offsets'][si])
+    self.replays = [None for _ in range(int(columns['setup_offsets'][si+1]) - self.first)]
+    self.drive_dir = str(columns['drive_dir'][si])
+    self.stage_names = stage_names
+
+  def __len__(self):
+    return len(self.replays)
+
+  def __iter__(self):
+    return (self[ri] for ri in range(len(self)))
+
+  def __getitem__(self, ri):
+    if isinstance(ri, slice):
+      return [self[k] for k in range(*ri.indices(len(self)))]
+    if self.replays[ri] == None:
+      self.replays[ri] = self.make_replay(self.first + range(len(self))[ri])
+    return self.replays[ri]
+
+  def make_replay(self, i):
+    cols = self.columns
+    ports = tuple([None if char < 0 else Port(char, dead)
+                   for char, dead in zip(cols['port_char'][i].tolist(), cols['port_dead'][i].tolist())])
+    return Replay(float(cols['start'][i]), float(cols['end'][i]), str(cols['filename'][i]),
+                  self.drive_dir, ports, self.stage_names[cols['stage'][i]], int(cols['numplayers'][i]))
+
+# the setups of replay columns, in the format written by
+# data.parse_all_slp_drives but with the replays of each setup in a ReplayList
+def setup_list(columns):
+  stage_names = columns['stage_names'].tolist()
+  return [{'drive' : str(drive), 'replays' : ReplayList(columns, si, stage_names)}
+          for si, drive in enumerate(columns['drive'].tolist())]
+
+# the columns of challonge data in the format written by
+# data.fetch_brackets_to_file. Matches that were never updated have updated=-1
+def challonge_columns(dat):
+  matches = dat['matches']
+  participants = dat['participants']
+  return {
+    'match_id'       : np.array([m['id'] for m in matches], dtype=np.int64),
+    'player1_id'     : np.array([m['player1-id'] for m in matches], dtype=np.int64),
+    'player2_id'     : np.array([m['player2-id'] for m in matches], dtype=np.int64),
+    'player1_score'  : np.array([m['player1_score'] for m in matches], dtype=np.int8),
+    'player2_score'  : np.array([m['player2_score'] for m in matches], dtype=np.int8),
+    'scores_csv'     : np.array([m['scores-csv'] for m in matches], dtype=str),
+    'started'        : np.array([epoch(m['started-at']) for m in matches], dtype=np.int64),
+    'completed'      : np.array([epoch(m['completed-at']) for m in matches], dtype=np.int64),
+    'updated'        : np.array([epoch(m['updated-at']) if m.get('updated-at') != None else -1
+                                 for m in matches], dtype=np.int64),
+    'participant_id' : np.array([p['id'] for p in participants], dtype=np.int64),
+    'display_name'   : np.array([p['display-name'] for p in participants], dtype=str),
+  }
+
+def write_challonge(dat, store_dir):
+  write_columns(store_dir, challonge_columns(dat))
+
+# load the challonge columns from a store directory, or from a pickled dict of
+# matches and participants
+def load_challonge(path):
+  if os.path.isdir(path):
+    return read_columns(path)
+  with open(path, 'rb') as fp:
+    return challonge_columns(pickle.load(fp))
+
+# the matches and participants of challonge columns, as dicts in the format
+# written by data.fetch_brackets_to_file
+def challonge_dicts(columns):
+  matches = []
+  for mid, p1, p2, s1, s2, scores, started, completed, updated in zip(
+      *[columns[name].tolist() for name in ['match_id', 'player1_id', 'player2_id',
+                                            'player1_score', 'player2_score', 'scores_csv',
+                                            'started', 'completed', 'updated']]):
+    matches.append({
+      'id'            : mid,
+      'player1-id'    : p1,
+      'player2-id'    : p2,
+      'player1_score' : s1,
+      'player2_score' : s2,
+      'num_games'     : s1 + s2,
+      'scores-csv'    : scores,
+      'started-at'    : epoch_datetime(started),
+      'completed-at'  : epoch_datetime(completed),
+      'updated-at'    : epoch_datetime(updated) if updated >= 0 else None,
+    })
+  participants = [{'id' : pid, 'display-name' : name}
+                  for pid, name in zip(columns['participant_id'].tolist(),
+                                       columns['display_name'].tolist())]
+  return {'matches' : matches, 'participants' : participants}
+
+# the matches of challonge columns, as Matches
+def match_list(columns):
+  return [Match(mid, (p1, p2), (s1, s2), scores, float(started), float(completed),
+                float(updated) if updated >= 0 else None)
+          for mid, p1, p2, s1, s2, scores, started, completed, updated in zip(
+            *[columns[name].tolist() for name in ['match_id', 'player1_id', 'player2_id',
+                                                  'player1_score', 'player2_score', 'scores_csv',
+                                                  'started', 'completed', 'updated']])]
+
+# dict mapping each participant id of challonge columns to their display name
+def participant_names(columns):
+  return dict(zip(columns['participant_id'].tolist(), columns['display_name'].tolist()))
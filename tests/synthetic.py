@@ -0,0 +1,143 @@
+# generator of small synthetic tournaments for the tests: matches played on a
+# few setups, with replays that roughly follow the timing model of the
+# labeller, some unrelated replays (e.g. friendlies) in between, and some
+# replays with the wrong number of players; and of minimal .slp replay files
+import datetime
+import pickle
+import random
+import struct
+
+import pytz
+import slippi.id
+
+import config
+import data
+
+CHARS = ['FOX', 'FALCO', 'MARTH', 'SHEIK', 'CAPTAIN_FALCON', 'PEACH', 'JIGGLYPUFF']
+
+def make_replay(rnd, start, duration, chars, loser, numplayers=2):
+  ports = [None, None, None, None]
+  used = sorted(rnd.sample(range(4), numplayers))
+  for k, port in enumerate(used):
+    ports[port] = {'char' : chars[k % len(chars)], 'dead_at_end' : k != 1 - loser}
+  return {
+    'start_time' : start,
+    'end_time'   : start + datetime.timedelta(seconds = duration),
+    'filename'   : 'game_%s.slp' % rnd.getrandbits(48),
+    'drive'      : None,
+    'ports'      : ports,
+    'stage'      : 'BATTLEFIELD',
+    'numplayers' : numplayers,
+  }
+
+# returns the challonge data and list of setups of a tournament, in the
+# formats written by data.fetch_brackets_to_file and data.parse_all_slp_drives
+def make_tournament(nmatches=30, nsetups=3, nplayers=12, seed=0):
+  rnd = random.Random(seed)
+  tz = pytz.timezone(config.TIME_ZONE)
+  participants = [{'id' : 1000+i, 'display-name' : 'Player %s' % i} for i in range(nplayers)]
+  mains = [rnd.choice(CHARS) for _ in range(nplayers)]
+
+  setups = [{'drive' : 'Drive #%s' % (si+1), 'replays' : []} for si in range(nsetups)]
+  free = [tz.localize(datetime.datetime(2019, 5, 18, 12, 0, 0)) for _ in range(nsetups)]
+  matches = []
+  for mi in range(nmatches):
+    si = min(range(nsetups), key = lambda s: free[s])
+    replays = setups[si]['replays']
+    t = free[si] + datetime.timedelta(seconds = rnd.uniform(30, 300))
+    if rnd.random() < 0.2:
+      replays.append(make_replay(rnd, t, rnd.uniform(60, 300), rnd.sample(CHARS, 2), 0,
+                                 rnd.choice([1, 2, 3])))
+      t += datetime.timedelta(seconds = rnd.uniform(320, 400))
+
+    a, b = rnd.sample(range(nplayers), 2)
+    bo5 = rnd.random() < 0.2
+    wins = 3 if bo5 else 2
+    losses = rnd.randrange(wins)
+    # the loser's wins come first, so the winner wins the last game
+    results = [1]*losses + [0]*wins
+    start = t
+    for result in results:
+      duration = rnd.uniform(120, 420)
+      chars = [mains[a], mains[b]] if rnd.random() < 0.9 else rnd.sample(CHARS, 2)
+      replays.append(make_replay(rnd, t, duration, chars, result))
+      t += datetime.timedelta(seconds = duration + rnd.uniform(10, 60))
+    free[si] = t
+
+    p1, p2 = (a, b) if rnd.random() < 0.5 else (b, a)
+    s1, s2 = (wins, losses) if p1 == a else (losses, wins)
+    matches.append({
+      'id'            : 5000 + mi,
+      'player1-id'    : 1000 + p1,
+      'player2-id'    : 1000 + p2,
+      'scores-csv'    : '%s-%s' % (s1, s2),
+      'player1_score' : s1,
+      'player2_score' : s2,
+      'num_games'     : s1 + s2,
+      'started-at'    : start - datetime.timedelta(seconds = rnd.gauss(60, 120)),
+      'completed-at'  : t + datetime.timedelta(seconds = rnd.gauss(30, 120)),
+    })
+
+  for setup in setups:
+    setup['replays'].sort(key = lambda r: r['start_time'])
+  return {'matches' : matches, 'participants' : participants}, setups
+
+# write a tournament to challonge/slippi pickles in outdir, returning the two
+# file names
+def write_tournament(outdir, **kwargs):
+  challonge_data, setups = make_tournament(**kwargs)
+  challonge_file = str(outdir / 'challonge_data.p')
+  slippi_file = str(outdir / 'slippi_data.p')
+  with open(challonge_file, 'wb') as fp:
+    pickle.dump(challonge_data, fp)
+  with open(slippi_file, 'wb') as fp:
+    pickle.dump(setups, fp)
+  return challonge_file, slippi_file
+
+# a string in UBJSON, with a uint8 length
+def ubjson_str(s):
+  return b'U' + bytes([len(s)]) + s.encode()
+
+# write a minimal .slp replay file to path, with nframes frames on the given
+# stage, chars[port] (or None) playing on each port, by in-game character
+# name (e.g. POPO for the Ice Climbers), ending the game with
+# stocks[port] stocks, and metadata with the startAt date start_at. Only the
+# events that data.read_slp_summary and slippi.Game need are written
+def write_slp(path, start_at, chars, stocks, nframes=300, stage='BATTLEFIELD'):
+  sizes = {0x36 : 0x1a0, 0x37 : 0x3f, 0x38 : 0x34, 0x39 : 0x1}
+  raw = bytes([0x35, 1 + 3*len(sizes)]) + b''.join(
+    [bytes([cmd]) + struct.pack('>H', size) for cmd, size in sizes.items()])
+
+  # Game Start: version 1.0.0, then the stage and each port's character and
+  # player type (0 for human, 3 for empty)
+  start = bytearray(1 + sizes[0x36])
+  start[0:5] = bytes([0x36, 1, 0, 0, 0])
+  struct.pack_into('>H', start, 0x13, slippi.id.Stage[stage].value)
+  for port, char in enumerate(chars):
+    css_char = 'ICE_CLIMBERS' if char == 'POPO' else char
+    start[0x65 + 0x24*port] = 0 if char == None else slippi.id.CSSCharacter[css_char].value
+    start[0x66 + 0x24*port] = 3 if char == None else 0
+  raw += bytes(start)
+
+  # a Pre-Frame and a Post-Frame Update for each port on each frame; every
+  # player has 4 stocks until the last frame
+  for frame in range(data.FIRST_FRAME_INDEX, data.FIRST_FRAME_INDEX + nframes):
+    for port, char in enumerate(chars):
+      if char == None:
+        continue
+      pre = bytearray(1 + sizes[0x37])
+      pre[0] = 0x37
+      struct.pack_into('>iB?', pre, 1, frame, port, False)
+      post = bytearray(1 + sizes[0x38])
+      post[0] = 0x38
+      struct.pack_into('>iB?B', post, 1, frame, port, False, slippi.id.InGameCharacter[char].value)
+      struct.pack_into('>f', post, 0x12, 1.0) # damage taken multiplier
+      post[0x21] = stocks[port] if frame == data.FIRST_FRAME_INDEX + nframes - 1 else 4
+      raw += bytes(pre) + bytes(post)
+  raw += bytes([0x39, 2]) # Game End, by stocks
+
+  metadata = (b'U\x08metadata{U\x07startAtS' + ubjson_str(start_at) +
+              b'U\x09lastFramel' + struct.pack('>i', data.FIRST_FRAME_INDEX + nframes - 1) +
+              b'U\x08playedOnS' + ubjson_str('dolphin') + b'U\x07players{}}')
+  with open(path, 'wb') as fp:
+    fp.write(b'{U\x03raw[$U#l' + struct.pack('>I', len(raw)) + raw + metadata + b'}')
@@ -0,0 +1,28 @@
+# tests of the synthetic tournaments of bench.py
+import bench
+
+def test_truth_points_at_each_matchs_replays():
+  challonge_data, setups, main_map, truth = bench.make_tournament(entrants=20, setups=3, best_of=5,
+                                                                  skew=30.0, seed=4)
+  matches = challonge_data['matches']
+  assert len(matches) == 19
+  assert len(main_map) == 20
+
+  replays = {(setup['drive'], r['filename']) : (setup, ri)
+             for setup in setups for ri, r in enumerate(setup['replays'])}
+  for match, label in zip(matches, truth):
+    setup, ri = replays[label]
+    games = setup['replays'][ri : ri + match['num_games']]
+    assert len(games) == match['num_games']
+    assert max(match['player1_score'], match['player2_score']) == 3
+
+    # the players' wins on their ports add up to the match's score
+    ports = [p for p, port in enumerate(games[0]['ports']) if port != None]
+    wins = sorted([sum([not g['ports'][p]['dead_at_end'] for g in games]) for p in ports])
+    assert wins == sorted([match['player1_score'], match['player2_score']])
+
+def test_run_reports_times_and_accuracy():
+  result = bench.run(probs=False, entrants=12, setups=2, seed=1)
+  for key in ['load', 'compute_all_labels', 'mip_solve']:
+    assert result[key] >= 0
+  assert 0 <= result['accuracy'] <= result['labelled'] <= 1
@@ -0,0 +1,109 @@
+# tests of the challonge API client in data.py, against a local stub server
+import hashlib
+import http.server
+import json
+import threading
+
+import pytest
+
+import config
+import data
+import store
+
+MATCHES = [{"match" : {"id" : 1, "scores_csv" : "2-1",
+                       "completed_at" : "2019-01-19T19:20:00.000-08:00"}}]
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+  def do_GET(self):
+    self.server.requests.append((self.path, self.headers.get('If-None-Match')))
+    body = json.dumps(self.server.bodies.get(self.path, MATCHES)).encode()
+    etag = '"%s"' % hashlib.md5(body).hexdigest()
+    if self.headers.get('If-None-Match') == etag:
+      self.send_response(304)
+      self.end_headers()
+      return
+    self.send_response(200)
+    self.send_header('ETag', etag)
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, *args):
+    pass
+
+@pytest.fixture
+def stub(monkeypatch):
+  server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+  server.requests = []
+  server.bodies = {} # the JSON served for each path, instead of MATCHES
+  thread = threading.Thread(target=server.serve_forever, daemon=True)
+  thread.start()
+  monkeypatch.setattr(config, 'CHALLONGE_API_URL', 'http://127.0.0.1:%s/v1/' % server.server_port)
+  monkeypatch.setattr(config, 'CHALLONGE_USER', 'user')
+  monkeypatch.setattr(config, 'CHALLONGE_API_KEY', 'key')
+  yield server
+  server.shutdown()
+  server.server_close()
+
+def test_get_caches_response(stub, monkeypatch):
+  monkeypatch.setattr(config, 'CHALLONGE_CACHE_TTL', 0)
+  http_cache = {}
+  body = data.challonge_get('tournaments/t/matches.json', http_cache)
+
+  assert json.loads(body) == MATCHES
+  assert stub.requests == [('/v1/tournaments/t/matches.json', None)]
+  (cached,) = http_cache.values()
+  assert cached['body'] == body and cached['etag'] != None
+
+def test_get_revalidates_with_etag(stub, monkeypatch):
+  monkeypatch.setattr(config, 'CHALLONGE_CACHE_TTL', 0)
+  http_cache = {}
+  body = data.challonge_get('tournaments/t/matches.json', http_cache)
+  (cached,) = http_cache.values()
+  fetched = cached['fetched']
+
+  assert data.challonge_get('tournaments/t/matches.json', http_cache) == body
+  assert stub.requests[1] == ('/v1/tournaments/t/matches.json', cached['etag'])
+  assert cached['fetched'] >= fetched
+
+def test_get_within_ttl_skips_request(stub, monkeypatch):
+  monkeypatch.setattr(config, 'CHALLONGE_CACHE_TTL', 3600)
+  http_cache = {}
+  body = data.challonge_get('tournaments/t/matches.json', http_cache)
+
+  assert data.challonge_get('tournaments/t/matches.json', http_cache) == body
+  assert len(stub.requests) == 1
+
+def test_record_keys_and_times():
+  (record,) = [data.challonge_record(obj) for obj in MATCHES]
+  assert record['scores-csv'] == '2-1'
+  assert record['completed-at'].utcoffset().total_seconds() == -8*3600
+
+# a challonge match record for test_fetch_since_merges_updated_matches
+def match_obj(mid, scores_csv, updated_at):
+  return {"match" : {"id" : mid, "player1_id" : 10, "player2_id" : 11, "scores_csv" : scores_csv,
+                     "started_at" : "2019-01-19T19:00:00.000-08:00",
+                     "completed_at" : "2019-01-19T19:20:00.000-08:00",
+                     "updated_at" : updated_at}}
+
+def test_fetch_since_merges_updated_matches(stub, tmp_path):
+  outfile = str(tmp_path / 'challonge_data')
+  stub.bodies['/v1/tournaments/t/participants.json'] = [
+    {"participant" : {"id" : 10, "display_name" : "A"}},
+    {"participant" : {"id" : 11, "display_name" : "B"}}]
+  stub.bodies['/v1/tournaments/t/matches.json'] = [
+    match_obj(1, "2-1", "2019-01-19T19:20:00.000-08:00"),
+    match_obj(2, "0-2", "2019-01-19T19:21:00.000-08:00")]
+  data.fetch_brackets_to_file(['t'], outfile)
+
+  # match 1 is corrected and match 3 is added after the last update, while
+  # match 2 is served with a stale score and match 4 without an update time;
+  # neither of those replaces what's in outfile
+  stub.bodies['/v1/tournaments/t/matches.json'] = [
+    match_obj(1, "2-0", "2019-01-19T19:30:00.000-08:00"),
+    match_obj(2, "1-2", "2019-01-19T19:21:00.000-08:00"),
+    match_obj(3, "2-1", "2019-01-19T19:40:00.000-08:00"),
+    match_obj(4, "2-1", None)]
+  data.fetch_brackets_to_file(['t'], outfile, since='last')
+
+  matches = store.challonge_dicts(store.load_challonge(outfile))['matches']
+  assert sorted([(m['id'], m['scores-csv']) for m in matches]) == [(1, '2-0'), (2, '0-2'), (3, '2-1')]
@@ -0,0 +1,111 @@
+# tests of the player file and replay parsing in data.py
+import re
+import datetime
+import pytest
+import pytz
+import slippi
+
+import data
+from synthetic import write_slp
+
+# the real characters of slippi.event.CSSCharacter
+ROSTER = ['CAPTAIN_FALCON', 'DONKEY_KONG', 'FOX', 'GAME_AND_WATCH', 'KIRBY', 'BOWSER', 'LINK',
+          'LUIGI', 'MARIO', 'MARTH', 'MEWTWO', 'NESS', 'PEACH', 'PIKACHU', 'ICE_CLIMBERS',
+          'JIGGLYPUFF', 'SAMUS', 'YOSHI', 'ZELDA', 'SHEIK', 'FALCO', 'YOUNG_LINK', 'DR_MARIO',
+          'ROY', 'PICHU', 'GANONDORF', 'POPO', 'SANDBAG']
+
+# the characters in charstr, found by searching for each character's regex
+# separately
+def search_each(charstr):
+  chars = set()
+  for name in ROSTER:
+    regex = data.char_special_cases.get(name.lower(), name.lower())
+    if name.lower() not in data.invalid_chars and re.search(regex, charstr.lower()):
+      chars.add(name)
+  return chars
+
+def test_combined_regex_finds_the_same_chars():
+  regex = data.char_regex(ROSTER)
+  for charstr in ['Fox', 'Falco, Falcon', 'falcon/falco', 'Dr. Mario', 'Dr Mario, Mario',
+                  'Young Link, Link', 'YL', 'Ice Climbers (Popo)', 'Pichu, Pikachu', 'G&W',
+                  'Ganon', 'DK, doc', 'Yoshi', 'young yoshi', 'Jigglypuff/Puff', 'Peach Sheik Zelda',
+                  'ylink', 'drmario', 'Sandbag', 'none', '']:
+    assert {m.lastgroup for m in regex.finditer(charstr.lower())} == search_each(charstr)
+
+def test_player_file_is_cached_by_contents(tmp_path, monkeypatch):
+  monkeypatch.setattr(data, 'all_chars_regex', data.char_regex(ROSTER))
+  player_file = tmp_path / 'players.csv'
+  player_file.write_text('TAG,Main,Secondaries\n'
+                         'Mang0,"Fox, Falco",Puff\n'
+                         'Hungrybox,Puff,\n'
+                         ',Marth,\n'
+                         'Armada,Peach,"Young Link, Fox"\n')
+
+  cache = {}
+  players = data.parse_player_file(str(player_file), cache)
+  assert players == {'mang0' : ({'FOX', 'FALCO'}, {'JIGGLYPUFF'}),
+                     'hungrybox' : ({'JIGGLYPUFF'}, set()),
+                     'armada' : ({'PEACH'}, {'YOUNG_LINK', 'FOX'})}
+  assert data.parse_player_file(str(player_file), cache) is players
+
+  player_file.write_text('TAG,Main,Secondaries\nLeffen,Fox,\n')
+  assert data.parse_player_file(str(player_file), cache) == {'leffen' : ({'FOX'}, set())}
+  assert len(cache) == 1
+
+def test_replay_times_are_localized_to_utc(monkeypatch):
+  # the Wii claims its wall-clock time is UTC
+  def summary(slp_file):
+    date = datetime.datetime(*slp_file, 12, 0, 0, tzinfo=datetime.timezone.utc)
+    return date, 60*60, 'BATTLEFIELD', [('FOX', 0), ('MARTH', 2), None, None]
+  monkeypatch.setattr(data, 'read_slp_summary', summary)
+  monkeypatch.setattr(data.config, 'DRIVE_TIME_OFFSETS', {'Drive #1' : 60})
+
+  # a drive with an offset, by its folder name, and one without, in summer
+  # and winter time
+  for date, drive, utc in [((2019, 5, 18), '/replays/Drive #1', (2019, 5, 18, 18, 59)),
+                           ((2019, 5, 18), '/replays/Drive #2', (2019, 5, 18, 19, 0)),
+                           ((2019, 1, 19), '/replays/Drive #1', (2019, 1, 19, 19, 59))]:
+    replay = data.parse_slp_file(date, drive)
+    assert replay['start_time'] == pytz.utc.localize(datetime.datetime(*utc))
+    assert replay['end_time'] - replay['start_time'] == datetime.timedelta(seconds=60)
+
+@pytest.mark.parametrize('start_at, chars, stocks', [
+  ('2019-05-18T21:10:28Z', ['FOX', 'MARTH', None, None], [0, 2, 0, 0]),
+  ('2019-05-18T21:10:28.123+0100', [None, 'CAPTAIN_FALCON', None, 'SHEIK'], [0, 3, 0, 0]),
+  ('2019-05-18T21:10:28', ['POPO', None, 'PEACH', None], [1, 0, 0, 0]),
+])
+def test_fast_parse_matches_slippi(tmp_path, monkeypatch, start_at, chars, stocks):
+  slp_file = str(tmp_path / 'game.slp')
+  write_slp(slp_file, start_at, chars, stocks)
+
+  game = slippi.Game(slp_file)
+  assert data.read_slp_summary(slp_file) == (
+    game.metadata.date, game.metadata.duration, game.start.stage.name,
+    [None if port == None else (port.leader.post.character.name, port.leader.post.stocks)
+     for port in game.frames[-1].ports])
+
+  monkeypatch.setattr(data.config, 'SLP_FAST_PARSE', True)
+  fast = data.parse_slp_file(slp_file, '/replays/Drive #1')
+  monkeypatch.setattr(data.config, 'SLP_FAST_PARSE', False)
+  assert fast == data.parse_slp_file(slp_file, '/replays/Drive #1')
+
+def test_fast_parse_falls_back_to_slippi(tmp_path, monkeypatch):
+  slp_file = str(tmp_path / 'game.slp')
+  write_slp(slp_file, '2019-05-18T21:10:28Z', ['FOX', 'MARTH', None, None], [0, 2, 0, 0])
+  expected = data.parse_slp_file(slp_file, '/replays/Drive #1')
+
+  def unreadable(slp_file):
+    raise ValueError("missing Event Payloads event")
+  monkeypatch.setattr(data, 'read_slp_summary', unreadable)
+  assert data.parse_slp_file(slp_file, '/replays/Drive #1') == expected
+
+  # a file neither can read is skipped
+  (tmp_path / 'bad.slp').write_bytes(b'not a replay')
+  assert data.parse_slp_file(str(tmp_path / 'bad.slp'), '/replays/Drive #1') == None
+
+def test_fast_parse_reads_negative_offsets(tmp_path):
+  slp_file = str(tmp_path / 'game.slp')
+  write_slp(slp_file, '2019-05-18T16:10:28-0530', ['FOX', 'MARTH', None, None], [0, 2, 0, 0])
+  date = data.read_slp_summary(slp_file)[0]
+  assert date.utcoffset() == -datetime.timedelta(hours=5, minutes=30)
+  assert date == datetime.datetime(2019, 5, 18, 21, 40, 28, tzinfo=datetime.timezone.utc)
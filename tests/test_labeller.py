@@ -0,0 +1,75 @@
+# tests of the scoring in ReplayLabeller, on synthetic tournaments
+import numpy as np
+import pytest
+
+import data
+from ReplayLabeller import ReplayLabeller, port_runs
+from synthetic import CHARS, write_tournament
+
+@pytest.mark.parametrize('seed', range(5))
+def test_vectorized_scoring_matches_reference(tmp_path, seed):
+  challonge_file, slippi_file = write_tournament(tmp_path, nmatches=25, nsetups=3, seed=seed)
+  labeller = ReplayLabeller(None, challonge_file, slippi_file)
+
+  all_labels = labeller.compute_all_labels()
+  reference = labeller.compute_all_labels_reference()
+
+  assert sum([len(lbls) for lbls in all_labels]) > 0
+  assert [[lbl[1:] for lbl in lbls] for lbls in all_labels] == \
+         [[lbl[1:] for lbl in lbls] for lbls in reference]
+  for lbls, ref in zip(all_labels, reference):
+    assert [lbl[0] for lbl in lbls] == pytest.approx([lbl[0] for lbl in ref], abs=1e-9)
+
+def test_char_tables_match_reference(tmp_path, monkeypatch):
+  challonge_file, slippi_file = write_tournament(tmp_path, nmatches=25, nsetups=3, seed=7)
+
+  # players with mains and secondaries, only one of them, neither, or no entry
+  # at all (e.g. 'player 11')
+  main_map = {
+    'player0' : ({'FOX'}, {'FALCO', 'MARTH'}),
+    'player1' : ({'SHEIK', 'MARTH'}, set()),
+    'player2' : (set(), {'PEACH'}),
+    'player3' : (set(), set()),
+  }
+  for i in range(4, 11):
+    main_map['player%s' % i] = ({CHARS[i % len(CHARS)]}, {CHARS[(i+3) % len(CHARS)]})
+  monkeypatch.setattr(data, 'parse_player_file', lambda fname, cache=None: main_map)
+  labeller = ReplayLabeller('players.csv', challonge_file, slippi_file)
+
+  all_labels = labeller.compute_all_labels()
+  reference = labeller.compute_all_labels_reference()
+
+  assert [[lbl[1:] for lbl in lbls] for lbls in all_labels] == \
+         [[lbl[1:] for lbl in lbls] for lbls in reference]
+  for lbls, ref in zip(all_labels, reference):
+    assert [lbl[0] for lbl in lbls] == pytest.approx([lbl[0] for lbl in ref], abs=1e-9)
+
+@pytest.mark.parametrize('k', [1, 2, 3])
+def test_pruned_labels_keep_the_optimum(tmp_path, k):
+  challonge_file, slippi_file = write_tournament(tmp_path, nmatches=40, nsetups=3, seed=3)
+  labeller = ReplayLabeller(None, challonge_file, slippi_file)
+  all_labels = labeller.compute_all_labels()
+  objval, soln = labeller.mip_solve(all_labels)
+
+  pruned = labeller.prune_labels(all_labels, k)
+  for lbls, kept in zip(all_labels, pruned):
+    assert lbls[:k] == kept[:k]
+    assert kept == [lbl for lbl in lbls if lbl in kept]
+  assert labeller.mip_solve(pruned)[0] == pytest.approx(objval, abs=1e-9)
+
+def test_port_runs():
+  # ports 0 and 2 for three replays, then a 3-player replay, then ports 1
+  # and 2 for two replays
+  port_char = np.array([[0, -1, 1, -1], [0, -1, 1, -1], [2, -1, 1, -1], [0, 1, 2, -1],
+                        [-1, 0, 1, -1], [-1, 0, 1, -1]])
+  port_dead = np.array([[False, False, True, False], [True, False, False, False],
+                        [False, False, True, False], [False, True, True, False],
+                        [False, True, False, False], [False, False, True, False]])
+  numplayers = np.array([2, 2, 2, 3, 2, 2])
+  run_ends, pair_ports, wins, win_counts = port_runs(port_char, port_dead, numplayers)
+
+  assert run_ends.tolist() == [3, 3, 3, 3, 6, 6]
+  assert pair_ports[[0, 4]].tolist() == [[0, 2], [1, 2]]
+  assert wins[:, 0].tolist() == [True, False, True, True, False, False]
+  assert (win_counts[3] - win_counts[0]).tolist() == [2, 0, 1, 0]
+  assert (win_counts[6] - win_counts[4]).tolist() == [0, 1, 1, 0]
@@ -0,0 +1,39 @@
+# tests of the label marginals in marginals.py
+import math
+
+import pytest
+
+import config
+import marginals
+
+def test_marginals_of_one_contested_replay():
+  # every match can only be labelled with the same replay, so the best
+  # assignment is far below the sum of the matches' best labels
+  num_games = [1 for _ in range(45)]
+  all_labels = [[(-1.0, 0, 0)] for _ in num_games]
+  probs = marginals.label_marginals(num_games, all_labels)
+
+  # each assignment labelling one match is exp(-1 - NOLABEL_OBJVAL) times as
+  # likely as leaving every match unlabelled
+  gain = math.exp(-1.0 - config.NOLABEL_OBJVAL)
+  for lbls in probs:
+    by_setup = {si : p for p, si, _ in lbls}
+    assert by_setup[0] == pytest.approx(gain / (45*gain + 1))
+    assert by_setup[None] == pytest.approx(1 - gain / (45*gain + 1))
+
+def test_enumeration_and_sampling_agree(monkeypatch):
+  num_games = [2, 1, 1, 2]
+  all_labels = [[(-3.0, 0, 0), (-4.0, 0, 1)],
+                [(-2.0, 0, 1), (-5.0, 0, 2)],
+                [(-2.5, 0, 2), (-3.5, 0, 3)],
+                [(-1.0, 0, 3), (-6.0, 0, 0)]]
+  exact = marginals.label_marginals(num_games, all_labels)
+
+  monkeypatch.setattr(config, 'EXACT_ENUM_LIMIT', 0)
+  sampled = marginals.label_marginals(num_games, all_labels)
+
+  for ex, sa in zip(exact, sampled):
+    ex = {tuple(lbl[1:]) : lbl[0] for lbl in ex}
+    sa = {tuple(lbl[1:]) : lbl[0] for lbl in sa}
+    for key in ex:
+      assert sa.get(key, 0.0) == pytest.approx(ex[key], abs=0.05)
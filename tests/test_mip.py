@@ -0,0 +1,82 @@
+# tests of the solvers and the label pruning of mip.py
+import pytest
+
+import bench
+import store
+from mip import DecomposedMIP, LabelMIP, LagrangianSolver, label_components, lp_duals, prune_labels
+from ReplayLabeller import ReplayLabeller
+
+# a small instance on which the LP bound used to fall below the LP optimum,
+# since the dual values of the variables' upper bounds weren't counted, and
+# pruning to the best label of each match lost the optimum
+NUM_GAMES = [2, 3, 2, 2, 3, 2, 2, 3]
+ALL_LABELS = [
+  [(-5.801, 0, 7), (-6.518, 0, 2)],
+  [(-8.581, 0, 9), (-9.317, 0, 6), (-12.447, 0, 1), (-15.439, 0, 8), (-24.252, 0, 10)],
+  [(-7.95, 0, 0), (-10.069, 0, 11), (-13.126, 0, 8), (-21.858, 0, 1), (-22.715, 0, 7)],
+  [(-5.386, 0, 3), (-9.993, 0, 10), (-17.091, 0, 4), (-19.985, 0, 0)],
+  [(-7.538, 0, 8), (-10.439, 0, 5), (-12.316, 0, 1)],
+  [(-5.377, 0, 0), (-11.047, 0, 1), (-12.765, 0, 10), (-15.8, 0, 3)],
+  [(-5.035, 0, 2), (-8.147, 0, 9), (-8.772, 0, 8), (-10.821, 0, 11), (-15.231, 0, 10)],
+  [(-5.594, 0, 7), (-12.7, 0, 8), (-18.643, 0, 10)],
+]
+
+def optimum(labels):
+  model = DecomposedMIP(NUM_GAMES, labels)
+  return sum([objval for objval, _ in model.unforced_solutions()])
+
+def test_lp_bound_is_above_the_optimum():
+  match_duals, replay_duals = lp_duals(NUM_GAMES, ALL_LABELS)
+  assert sum(match_duals) + sum(replay_duals.values()) >= optimum(ALL_LABELS) - 1e-9
+
+@pytest.mark.parametrize('k', [1, 2])
+def test_pruned_labels_keep_the_optimum(k):
+  pruned, final_k, _ = prune_labels(NUM_GAMES, ALL_LABELS, k, optimum)
+  # the bounds alone keep the optimum, without widening k
+  assert final_k == k
+  assert optimum(pruned) == pytest.approx(optimum(ALL_LABELS), abs=1e-9)
+
+def test_prune_labels_widens_k_when_the_optimum_is_lost():
+  # an optimum slightly worse unless every label is kept, which the LP bounds
+  # can't account for, must make prune_labels widen k until nothing is
+  # dropped
+  def picky_optimum(labels):
+    return optimum(labels) - (0.0 if labels == ALL_LABELS else 1e-5)
+  pruned, final_k, _ = prune_labels(NUM_GAMES, ALL_LABELS, 1, picky_optimum)
+  assert final_k > 1
+  assert pruned == ALL_LABELS
+
+def test_lagrangian_solves_like_glpk(tmp_path):
+  challonge_data, setups, _, _ = bench.make_tournament(entrants=64, setups=4, seed=0)
+  store.write_challonge(challonge_data, str(tmp_path / 'challonge_data'))
+  store.write_setups(setups, str(tmp_path / 'slippi_data'))
+  labeller = ReplayLabeller(None, str(tmp_path / 'challonge_data'), str(tmp_path / 'slippi_data'))
+  all_labels = labeller.compute_all_labels()
+  comp = max(label_components([m.num_games for m in labeller.matches], all_labels), key=len)
+  num_games = [labeller.matches[mi].num_games for mi in comp]
+  all_labels = [all_labels[mi] for mi in comp]
+
+  lagrangian = LagrangianSolver(num_games, all_labels)
+  glpk = LabelMIP(num_games, all_labels)
+  for forced_labels in [set(), {(0, None)}, {(1,) + all_labels[1][-1][1:]},
+                        {(2,) + all_labels[2][1][1:], (3, None)}]:
+    objval, soln = lagrangian.solve(forced_labels)
+    assert objval == pytest.approx(glpk.solve(forced_labels)[0], abs=1e-9)
+    for lbl in forced_labels:
+      assert soln[lbl[0]] == (None if lbl[1] == None else
+                              next(l for l in all_labels[lbl[0]] if l[1:] == lbl[1:]))
+  # the relaxation's bound was met every time, without glpk
+  assert lagrangian.fallback == None
+
+def test_lagrangian_keeps_falling_back(monkeypatch):
+  # the LP relaxation of ALL_LABELS isn't integral, so the relaxation's bound
+  # never meets a feasible solution, and the first solve falls back to glpk.
+  # Later ones go straight to it
+  solver = LagrangianSolver(NUM_GAMES, ALL_LABELS)
+  assert solver.solve()[0] == pytest.approx(optimum(ALL_LABELS), abs=1e-9)
+  assert solver.fallback != None
+
+  def relaxation(*args):
+    raise AssertionError("relaxation solved after falling back")
+  monkeypatch.setattr(solver, 'relaxation', relaxation)
+  assert solver.solve({(1, 0, 6)})[0] == pytest.approx(LabelMIP(NUM_GAMES, ALL_LABELS).solve({(1, 0, 6)})[0])
@@ -0,0 +1,50 @@
+# tests of the clock offset estimation of skew.py and
+# ReplayLabeller.estimate_clock_offsets
+import datetime
+import numpy as np
+
+import bench
+import data
+import skew
+import store
+from ReplayLabeller import ReplayLabeller
+
+def test_fit_pieces_finds_a_change_of_offset():
+  grid = skew.offset_grid(100, 10)
+  assert grid[0] == 0
+
+  # 20 labels that fit an offset of -30 best, then 10 that fit +50
+  best = np.array([-30]*20 + [50]*10)
+  lls = -((grid[:, None] - best[None, :]) / 20.0)**2
+  assert [(j, grid[g]) for j, g in skew.fit_pieces(lls, 5, 2.0)] == [(0, -30), (20, 50)]
+
+  # too few labels on each side to split, so the best single offset of the
+  # mean -3.3 is none, and too little gain to move from no offset
+  assert [(j, grid[g]) for j, g in skew.fit_pieces(lls, 16, 2.0)] == [(0, 0)]
+  assert [(j, grid[g]) for j, g in skew.fit_pieces(lls[:, :20], 5, 2.0)] == [(0, -30)]
+  assert skew.fit_pieces(lls[:, :20] / 1000, 5, 2.0) == [(0, 0)]
+
+def test_estimated_offsets_recover_a_moved_drive(tmp_path, monkeypatch):
+  challonge_data, setups, main_map, truth = bench.make_tournament(entrants=512, setups=4, seed=2)
+  main_map = {data.tag_fingerprint(tag) : mains for tag, mains in main_map.items()}
+  monkeypatch.setattr(data, 'parse_player_file', lambda fname, cache=None: main_map)
+  replays = setups[0]['replays']
+  half = len(replays) // 2
+  for r in replays[half:]:
+    r['start_time'] += datetime.timedelta(seconds=400)
+    r['end_time'] += datetime.timedelta(seconds=400)
+  store.write_challonge(challonge_data, str(tmp_path / 'challonge_data'))
+  store.write_setups(setups, str(tmp_path / 'slippi_data'))
+
+  labeller = ReplayLabeller('players.csv', str(tmp_path / 'challonge_data'), str(tmp_path / 'slippi_data'))
+  accuracy = bench.accuracy(labeller, labeller.mip_solve(labeller.compute_all_labels())[1], truth)
+  offsets = labeller.estimate_clock_offsets()
+
+  # the offsets are near 0 before the drive moved and near 400 after it
+  # (apart from the games around the move), and 0 on the other setups
+  assert np.abs(offsets[0][:half - 20]).max() <= 60
+  assert np.abs(offsets[0][half + 20:] - 400).max() <= 60
+  assert all([not offs.any() for offs in offsets[1:]])
+  assert labeller.setups[0]['replays'][half + 20].start == \
+         store.epoch(replays[half + 20]['start_time']) - offsets[0][half + 20]
+  assert bench.accuracy(labeller, labeller.mip_solve(labeller.compute_all_labels())[1], truth) > accuracy
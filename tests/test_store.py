@@ -0,0 +1,100 @@
+# tests of the columnar stores in store.py
+import os
+import pickle
+import pytz
+
+import config
+import store
+from ReplayLabeller import ReplayLabeller
+from synthetic import make_tournament, write_tournament
+
+def test_replays_round_trip(tmp_path):
+  _, setups = make_tournament(seed=1)
+  store.write_setups(setups, str(tmp_path / 'slippi_data'))
+  columns = store.load_setups(str(tmp_path / 'slippi_data'))
+  char_names = columns['char_names'].tolist()
+  loaded = store.setup_list(columns)
+
+  assert [s['drive'] for s in loaded] == [s['drive'] for s in setups]
+  for setup, loaded_setup in zip(setups, loaded):
+    assert len(loaded_setup['replays']) == len(setup['replays'])
+    for replay, loaded_replay in zip(setup['replays'], loaded_setup['replays']):
+      assert loaded_replay.filename == replay['filename']
+      assert loaded_replay.stage == replay['stage']
+      assert loaded_replay.numplayers == replay['numplayers']
+      assert loaded_replay.start == store.epoch(replay['start_time'])
+      assert loaded_replay.end == store.epoch(replay['end_time'])
+      assert [None if p == None else (char_names[p.char], p.dead_at_end) for p in loaded_replay.ports] == \
+             [None if p == None else (p['char'], p['dead_at_end']) for p in replay['ports']]
+
+def test_lmt_tagged_pickles_are_localized(tmp_path):
+  # earlier versions tagged replay times with replace(tzinfo=...)
+  _, setups = make_tournament(seed=1)
+  tz = pytz.timezone(config.TIME_ZONE)
+  starts = [store.epoch(r['start_time']) for setup in setups for r in setup['replays']]
+  for setup in setups:
+    for r in setup['replays']:
+      for key in ['start_time', 'end_time']:
+        r[key] = r[key].astimezone(tz).replace(tzinfo=tz)
+  with open(tmp_path / 'slippi_data.p', 'wb') as fp:
+    pickle.dump(setups, fp)
+
+  assert store.load_setups(str(tmp_path / 'slippi_data.p'))['start'].tolist() == starts
+
+def test_challonge_round_trip(tmp_path):
+  challonge_data, _ = make_tournament(seed=2)
+  store.write_challonge(challonge_data, str(tmp_path / 'challonge_data'))
+  columns = store.load_challonge(str(tmp_path / 'challonge_data'))
+
+  assert store.participant_names(columns) == \
+         {p['id'] : p['display-name'] for p in challonge_data['participants']}
+  for match, loaded in zip(challonge_data['matches'], store.match_list(columns)):
+    assert loaded.id == match['id']
+    assert loaded.player_ids == (match['player1-id'], match['player2-id'])
+    assert loaded.scores == (match['player1_score'], match['player2_score'])
+    assert loaded.num_games == match['num_games']
+    assert loaded.scores_csv == match['scores-csv']
+    assert loaded.start == store.epoch(match['started-at'])
+    assert loaded.end == store.epoch(match['completed-at'])
+
+  # the dicts that data.fetch_brackets_to_file merges new matches into
+  dicts = store.challonge_dicts(columns)
+  assert dicts['participants'] == challonge_data['participants']
+  for match, loaded in zip(challonge_data['matches'], dicts['matches']):
+    for key in ['id', 'player1-id', 'player2-id', 'player1_score', 'player2_score',
+                'num_games', 'scores-csv']:
+      assert loaded[key] == match[key]
+
+def test_store_and_pickle_label_the_same(tmp_path):
+  challonge_file, slippi_file = write_tournament(tmp_path, seed=3)
+  with open(challonge_file, 'rb') as fp:
+    store.write_challonge(pickle.load(fp), str(tmp_path / 'challonge_data'))
+  with open(slippi_file, 'rb') as fp:
+    store.write_setups(pickle.load(fp), str(tmp_path / 'slippi_data'))
+
+  from_pickle = ReplayLabeller(None, challonge_file, slippi_file).compute_all_labels()
+  from_store = ReplayLabeller(None, str(tmp_path / 'challonge_data'),
+                              str(tmp_path / 'slippi_data')).compute_all_labels()
+  assert from_store == from_pickle
+  assert store.find_store(str(tmp_path / 'challonge_data')) == str(tmp_path / 'challonge_data')
+
+def test_rewriting_a_store_never_exposes_the_pickle(tmp_path, monkeypatch):
+  challonge_file, _ = write_tournament(tmp_path, seed=3)
+  store_path = str(tmp_path / 'challonge_data')
+  os.replace(challonge_file, store_path + '.p')
+  with open(store_path + '.p', 'rb') as fp:
+    challonge_data = pickle.load(fp)
+  store.write_challonge(challonge_data, store_path)
+
+  # rewrite the store, checking where it would be loaded from at each move
+  found = []
+  replace = os.replace
+  def checked_replace(src, dst):
+    found.append(store.find_store(store_path))
+    replace(src, dst)
+    found.append(store.find_store(store_path))
+  monkeypatch.setattr(store.os, 'replace', checked_replace)
+  store.write_challonge(challonge_data, store_path)
+
+  assert found == [store_path] * 4
+  assert sorted(os.listdir(tmp_path)) == ['challonge_data', 'challonge_data.p', 'slippi_data.p']